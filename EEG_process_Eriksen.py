@@ -129,7 +129,7 @@ ica.apply(raw) # directly changes raw data set
 
 # As this is for the Flanker task and we are interested in error processing 
 # We need time 0 to be when the response was made, not stimulus onset. 
-events2 = events 
+events2 = events.copy() # a copy, so events stays stimulus-locked
 events2[:,0] = events2[:,0] + rts #add reaction time to event marker
 
 # Option to define a cut-off for the maximum voltage 
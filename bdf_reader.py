@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped reader for Biosemi .bdf files.
+
+mne.io.read_raw_bdf(path, preload=True) decodes every channel of the whole
+recording into float64, including EXG2-EXG8 which are dropped later on.
+This reader memory-maps the 24 bit data records and only decodes the
+channels and the part of the recording that are asked for, a block of
+records at a time, so the memory used is roughly the size of the returned
+array.
+
+A .bdf file is a 256 byte header, 256 bytes of header per channel, then
+data records. Each record holds the next n_samples[ch] samples of every
+channel in turn, each sample a 3 byte little-endian two's complement
+integer.
+
+@author: James Bartlett
+"""
+
+import numpy as np
+import mne
+
+# number of data records decoded at a time (one record is one second on the Biosemi)
+BLOCK_RECORDS = 64
+
+# trigger bits of the Status channel - the bits above are Biosemi system bits
+TRIGGER_MASK = 0xFFFF
+
+
+def read_header(path):
+    """Read the header of a .bdf file into a dictionary."""
+    with open(path, "rb") as f:
+        main = f.read(256)
+        n_channels = int(main[252:256].decode("ascii"))
+        header = {
+            "header_bytes": int(main[184:192].decode("ascii")),
+            "n_records": int(main[236:244].decode("ascii")),
+            "record_duration": float(main[244:252].decode("ascii")),
+            "n_channels": n_channels,
+        }
+        ext = f.read(256 * n_channels)
+
+    def field(start, width):
+        # each channel field is stored for all channels one after another
+        offset = start * n_channels
+        return [ext[offset + i * width:offset + (i + 1) * width].decode("ascii").strip()
+                for i in range(n_channels)]
+
+    header["labels"] = field(0, 16)
+    header["units"] = field(16 + 80, 8)
+    header["phys_min"] = np.array(field(16 + 80 + 8, 8), dtype=float)
+    header["phys_max"] = np.array(field(16 + 80 + 16, 8), dtype=float)
+    header["dig_min"] = np.array(field(16 + 80 + 24, 8), dtype=float)
+    header["dig_max"] = np.array(field(16 + 80 + 32, 8), dtype=float)
+    header["n_samples"] = np.array(field(16 + 80 + 40 + 80, 8), dtype=int)
+    # sample offset of each channel within a record
+    header["offsets"] = np.concatenate([[0], np.cumsum(header["n_samples"])[:-1]])
+    header["record_bytes"] = 3 * int(header["n_samples"].sum())
+    header["sfreq"] = header["n_samples"][0] / header["record_duration"]
+    return header
+
+
+def _decode_int24(block):
+    """Little-endian 24 bit two's complement bytes (..., 3) to int32."""
+    value = (block[..., 0].astype(np.int32) |
+             (block[..., 1].astype(np.int32) << 8) |
+             (block[..., 2].astype(np.int32) << 16))
+    # sign extend bit 23
+    return (value ^ 0x800000) - 0x800000
+
+
+def read_ints(path, channels, start=0, stop=None, header=None):
+    """Raw integer samples of some channels between two sample numbers.
+
+    Returns an int32 array of shape (len(channels), stop - start).
+    """
+    if header is None:
+        header = read_header(path)
+    idx = [header["labels"].index(ch) for ch in channels]
+    return _read(path, header, idx, start, stop, None)
+
+
+def read_channels(path, channels, start=0, stop=None, dtype=np.float64, header=None):
+    """Samples of some channels between two sample numbers in volts.
+
+    Channels measured in uV are converted to V as MNE does; channels with
+    other units (e.g. the Status channel) are returned as the raw integers.
+    """
+    if header is None:
+        header = read_header(path)
+    idx = [header["labels"].index(ch) for ch in channels]
+    return _read(path, header, idx, start, stop, dtype)
+
+
+def scaling(header, dtype=np.float64):
+    """Gain and offset of every channel from digital values to V, and which to leave as integers.
+
+    value * gain + base, where base is worked out first, so float32 output
+    does not lose digits adding and removing the +-262144 uV of the
+    physical range. Status and other non-voltage channels are kept as
+    integers.
+    """
+    gain = ((header["phys_max"] - header["phys_min"]) /
+            (header["dig_max"] - header["dig_min"]))
+    scale = np.array([1e-6 if header["units"][i] in ("uV", "µV") else 1.0
+                      for i in range(header["n_channels"])])
+    base = ((header["phys_min"] - header["dig_min"] * gain) * scale).astype(dtype)
+    gain = (gain * scale).astype(dtype)
+    raw_int = np.array([header["units"][i] not in ("uV", "µV", "mV", "V")
+                        for i in range(header["n_channels"])])
+    return gain, base, raw_int
+
+
+def _read(path, header, idx, start, stop, dtype):
+    """Decode channels idx between samples start and stop, scaled if dtype is given."""
+    n_per_record = header["n_samples"][idx]
+    if len(set(n_per_record)) > 1:
+        raise ValueError("Channels must share a sampling rate")
+    n_per_record = int(n_per_record[0])
+    n_total = header["n_records"] * n_per_record
+    stop = n_total if stop is None else min(stop, n_total)
+    start = max(start, 0)
+
+    if dtype is None:
+        out = np.empty((len(idx), stop - start), dtype=np.int32)
+    else:
+        out = np.empty((len(idx), stop - start), dtype=dtype)
+        # digital to physical units, including uV to V
+        gain, base, raw_int = scaling(header, dtype)
+
+    first_record = start // n_per_record
+    last_record = -(-stop // n_per_record)  # ceiling division
+    for block_start in range(first_record, last_record, BLOCK_RECORDS):
+        block_stop = min(block_start + BLOCK_RECORDS, last_record)
+        # map only this block of records - dropped again at the end of the loop
+        records = np.memmap(path, dtype=np.uint8, mode="r",
+                            offset=header["header_bytes"] + block_start * header["record_bytes"],
+                            shape=(block_stop - block_start, header["record_bytes"]))
+        # samples of this block that fall inside [start, stop)
+        block_first = block_start * n_per_record
+        lo = max(start - block_first, 0)
+        hi = min(stop - block_first, (block_stop - block_start) * n_per_record)
+        for row, ch in enumerate(idx):
+            offset = 3 * header["offsets"][ch]
+            raw = records[:, offset:offset + 3 * n_per_record]
+            value = _decode_int24(raw.reshape(-1, n_per_record, 3)).reshape(-1)[lo:hi]
+            dest = out[row, block_first + lo - start:block_first + hi - start]
+            dest[:] = value
+            if dtype is not None and not raw_int[ch]:
+                dest *= gain[ch]
+                dest += base[ch]
+        del records
+    return out
+
+
+def decode_triggers(status, mask=TRIGGER_MASK):
+    """Every trigger in a Status channel as an (n, 3) array of onset, offset, code.
+
+    The Status word of the Biosemi holds the trigger code in its low 16 bits
+    and system bits (CMS in range, battery, speed mode) above it, which is
+    why the channel looks negative to MNE. The system bits are masked off
+    and a trigger is any run of samples with the same non-zero code: onset
+    is its first sample and offset the first sample after it.
+    """
+    code = np.asarray(status) & mask
+    # samples where the code changes start a new run
+    change = np.flatnonzero(code[1:] != code[:-1]) + 1
+    starts = np.concatenate([[0], change])
+    stops = np.concatenate([change, [len(code)]])
+    codes = code[starts]
+    keep = codes != 0
+    return np.column_stack([starts[keep], stops[keep], codes[keep]]).astype(np.int64)
+
+
+def read_triggers(path, mask=TRIGGER_MASK, header=None):
+    """Decode the triggers straight from the Status channel of a .bdf file."""
+    return decode_triggers(read_ints(path, ["Status"], header=header)[0], mask)
+
+
+def status_span(path, margin, tmax, header=None):
+    """First and last sample worth reading - the triggers plus a margin.
+
+    margin (in seconds) leaves room for the filter to settle before the
+    first trigger, and after the last trigger plus tmax.
+    """
+    if header is None:
+        header = read_header(path)
+    n_total = header["n_records"] * header["n_samples"][header["labels"].index("Status")]
+    triggers = read_triggers(path, header=header)
+    if len(triggers) == 0:
+        return 0, n_total
+    sfreq = header["sfreq"]
+    start = int(triggers[0, 0] - margin * sfreq)
+    stop = int(triggers[-1, 0] + (margin + tmax) * sfreq)
+    return max(start, 0), min(stop, n_total)
+
+
+def raw_array(data, info, first_samp=0):
+    """An MNE RawArray around data of any dtype, without RawArray's float64 copy."""
+    if data.dtype == np.float64:
+        return mne.io.RawArray(data, info, first_samp=first_samp)
+    # a float64 placeholder that takes no memory, swapped for the data afterwards
+    raw = mne.io.RawArray(np.broadcast_to(np.zeros(1), data.shape), info,
+                          first_samp=first_samp)
+    raw._data = data
+    return raw
+
+
+def read_raw_bdf(path, channels, start=0, stop=None, dtype=np.float64):
+    """Read some channels of a .bdf file into an MNE Raw object.
+
+    EEG and EXG channels are typed eeg as mne.io.read_raw_bdf does and Status is a
+    stim channel. The returned Raw keeps the sample numbers of the file
+    (raw.first_samp == start), so events found in it line up with events
+    found in the whole recording. The data keeps dtype (e.g. np.float32).
+    """
+    header = read_header(path)
+    channels = list(channels)
+    data = read_channels(path, channels, start, stop, dtype=dtype, header=header)
+    ch_types = ["stim" if ch == "Status" else "eeg" for ch in channels]
+    info = mne.create_info(channels, header["sfreq"], ch_types)
+    return raw_array(data, info, first_samp=start)
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+Check that the triggers of a recording match the trials of its OpenSesame file.
+
+The pipeline takes the i-th trial marker in the Status channel to be row i
+of the OpenSesame .csv (the old scripts forced this by slicing, e.g.
+events0[1:,:] or eventscalc[:208]). A trigger the parallel port dropped, or
+an extra one, shifts every later trial onto the wrong epoch, and used to
+show up only as a printed event count after the ICA had run. This check
+runs first, on the Status channel alone, and the batch stops the
+participant before any heavy stage if the two do not line up.
+
+The intervals between the trials are compared rather than the times
+themselves, as the behavioural PC's clock starts at another time and runs
+slightly fast or slow against the amplifier's:
+
+- with the stimulus time of every trial in the .csv (the task's
+  "timestamp" column), the trial intervals are slid past the trigger
+  intervals, at every lag at once as one (lags, intervals) array, and the
+  lag where most intervals agree within TOLERANCE lines the two up. A line
+  fitted through the longest run of agreeing intervals (odd intervals agree
+  by chance too) maps the .csv clock onto the recording (its slope is the
+  clock drift), every trial is matched to the nearest trigger, and the line
+  is fitted again through all the matches. This finds missing and extra
+  triggers anywhere.
+- without timestamps, trials that last until the response make the
+  trigger intervals follow the response times, so the lag with the highest
+  correlation between the two is used instead. This only finds a shift,
+  not where it happened.
+
+    python eeg_align.py eriksen
+
+@author: James Bartlett
+"""
+
+import argparse
+import os
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+import bdf_reader
+# both import this module as well - only used inside the functions
+import eeg_batch
+import eeg_pipeline
+
+# largest difference (s) between matching intervals, or a trial and its trigger
+TOLERANCE = 0.025
+
+# furthest the trials and triggers are searched for an offset, in trials
+MAX_LAG = 10
+
+# weakest correlation of the intervals with the response times that counts
+MIN_CORRELATION = 0.3
+
+
+def lagged(intervals, n, max_lag=MAX_LAG):
+    """(2 * max_lag + 1, n) view of intervals, row j starting at interval j - max_lag.
+
+    Intervals before the first or after the last are NaN.
+    """
+    padded = np.concatenate([np.full(max_lag, np.nan), intervals,
+                             np.full(max_lag + max(n - len(intervals), 0), np.nan)])
+    return sliding_window_view(padded, n)[:2 * max_lag + 1]
+
+
+def interval_matches(trigger_intervals, trial_intervals, max_lag=MAX_LAG, tolerance=TOLERANCE):
+    """Number of trial intervals that match a trigger interval at every lag.
+
+    At lag k trial i is paired with trigger i + k, for k from -max_lag to
+    max_lag.
+    """
+    windows = lagged(trigger_intervals, len(trial_intervals), max_lag)
+    with np.errstate(invalid="ignore"):
+        return (np.abs(windows - trial_intervals) <= tolerance).sum(axis=1)
+
+
+def response_correlation(trigger_intervals, rts, max_lag=MAX_LAG):
+    """Correlation of the trigger intervals with the response times at every lag."""
+    windows = lagged(trigger_intervals, len(rts), max_lag)
+    valid = ~np.isnan(windows)
+    n = valid.sum(axis=1)
+    x = np.where(valid, windows, 0.0)
+    y = np.where(valid, rts, 0.0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        x_mean, y_mean = x.sum(axis=1) / n, y.sum(axis=1) / n
+        x = np.where(valid, x - x_mean[:, None], 0.0)
+        y = np.where(valid, y - y_mean[:, None], 0.0)
+        r = (x * y).sum(axis=1) / np.sqrt((x ** 2).sum(axis=1) * (y ** 2).sum(axis=1))
+    return np.nan_to_num(r, nan=-1.0)
+
+
+def match_trials(onsets, predicted, tolerance=TOLERANCE):
+    """Index of the trigger nearest every predicted onset, or -1 if none is close enough."""
+    right = np.clip(np.searchsorted(onsets, predicted), 1, len(onsets) - 1)
+    nearest = np.where(np.abs(onsets[right - 1] - predicted) <= np.abs(onsets[right] - predicted),
+                       right - 1, right)
+    return np.where(np.abs(onsets[nearest] - predicted) <= tolerance, nearest, -1)
+
+
+def align_trials(onsets, timestamps=None, rts=None, max_lag=MAX_LAG, tolerance=TOLERANCE):
+    """Match the trials of an OpenSesame file to the trial triggers.
+
+    onsets are the trigger times in the recording and timestamps the
+    stimulus times logged for the trials, rts their response times (all in
+    seconds). Returns a dictionary with the method used ("timestamps" or
+    "response_time"), the offset ("lag", trigger i + lag is trial i), the
+    trial numbers without a trigger ("missing", from 1), the triggers
+    matching no trial ("extra", from 1), the clock drift in ppm, the
+    largest difference between a trial and its trigger ("residual", s), the
+    trials whose response comes after the next trigger ("late") and whether
+    trial i is trigger i for every trial ("ok").
+    """
+    onsets = np.asarray(onsets, dtype=float)
+    n = len(timestamps if timestamps is not None else rts)
+    report = {"trials": n, "triggers": len(onsets), "missing": [], "extra": [],
+              "drift_ppm": None, "residual": None}
+    if len(onsets) < 2:
+        report.update(method="none", lag=0, late=0, ok=len(onsets) == n == 1)
+        return report
+    intervals = np.diff(onsets)
+
+    if timestamps is not None:
+        timestamps = np.asarray(timestamps, dtype=float)
+        trial_intervals = np.diff(timestamps)
+        lag = int(np.argmax(interval_matches(intervals, trial_intervals, max_lag, tolerance)))
+        lag -= max_lag
+        # the longest run of trials whose intervals agree with the triggers' at that lag
+        windows = lagged(intervals, len(trial_intervals), max_lag)[lag + max_lag]
+        with np.errstate(invalid="ignore"):
+            agree = np.concatenate([[False], np.abs(windows - trial_intervals) <= tolerance,
+                                    [False]]).astype(int)
+        edges = np.diff(agree)
+        starts, stops = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+        matched = np.full(n, -1)
+        if len(starts):
+            longest = np.argmax(stops - starts)
+            # interval i runs from trial i to trial i + 1
+            pairs = np.arange(starts[longest], stops[longest] + 1)
+            matched[pairs] = pairs + lag
+            # fit the clock on the pairs, match every trial, and fit again on all the matches
+            for _ in range(2):
+                good = matched >= 0
+                slope, intercept = np.polyfit(timestamps[good], onsets[matched[good]], 1)
+                matched = match_trials(onsets, intercept + slope * timestamps, tolerance)
+            good = matched >= 0
+            residual = onsets[matched[good]] - (intercept + slope * timestamps[good])
+            report.update(drift_ppm=(slope - 1.0) * 1e6, residual=float(np.abs(residual).max()))
+        report.update(method="timestamps", lag=lag,
+                      missing=list(np.flatnonzero(matched < 0) + 1),
+                      extra=list(np.setdiff1d(np.arange(len(onsets)), matched) + 1))
+        ok = np.array_equal(matched, np.arange(n))
+    else:
+        r = response_correlation(intervals, np.asarray(rts, dtype=float)[:n - 1], max_lag)
+        lag = int(np.argmax(r)) - max_lag
+        # trials of a fixed length say nothing about the lag - only count the triggers
+        if r.max() < MIN_CORRELATION:
+            lag = 0
+        report.update(method="response_time", lag=lag, correlation=float(r.max()))
+        ok = lag == 0 and len(onsets) >= n
+
+    report["late"] = 0
+    if rts is not None:
+        # trial i taken to be trigger i, as the pipeline does
+        k = min(n, len(onsets) - 1)
+        late = onsets[:k] + np.asarray(rts, dtype=float)[:k] >= onsets[1:k + 1]
+        report["late"] = int(late.sum())
+    report["ok"] = bool(ok)
+    return report
+
+
+def check_participant(task, filepath):
+    """align_trials() of one participant, from their .csv file and the Status channel."""
+    config = eeg_pipeline.TASKS[task]
+    name = eeg_pipeline.participant_name(filepath)
+    eegpath = os.path.join(config["eeg"], name + '.bdf')
+    header = bdf_reader.read_header(eegpath)
+    triggers = bdf_reader.read_triggers(eegpath, header=header)
+    onsets = triggers[triggers[:, 2] == eeg_pipeline.SETTINGS["trigger_code"], 0] / header["sfreq"]
+    rtdata = pd.read_csv(filepath, sep=',')
+    timestamps = None
+    if config["timestamp"] in rtdata.columns:
+        timestamps = rtdata[config["timestamp"]].values / 1000.0
+    report = align_trials(onsets, timestamps, rtdata["response_time"].values / 1000.0)
+    report["participant"] = name
+    return report
+
+
+def describe(report):
+    """One line summary of an alignment report."""
+    text = (str(report["trials"]) + " trials, " + str(report["triggers"]) + " triggers (" +
+            report["method"] + ")")
+    if report["lag"]:
+        text += ", triggers shifted by " + str(report["lag"])
+    if report["missing"]:
+        text += ", no trigger for trials " + _numbers(report["missing"])
+    if report["extra"]:
+        text += ", extra triggers " + _numbers(report["extra"])
+    if report["drift_ppm"] is not None:
+        text += ", clock drift {:+.0f} ppm, largest residual {:.1f} ms".format(
+            report["drift_ppm"], report["residual"] * 1e3)
+    if report["late"]:
+        text += ", " + str(report["late"]) + " responses after the next trigger"
+    return text
+
+
+def _numbers(values, most=10):
+    values = [str(int(v)) for v in values]
+    return " ".join(values[:most]) + (" ..." if len(values) > most else "")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check the triggers against the OpenSesame trials.")
+    parser.add_argument("task", choices=sorted(eeg_pipeline.TASKS))
+    parser.add_argument("files", nargs="*", help="OpenSesame .csv files (default every participant)")
+    args = parser.parse_args(argv)
+    failed = 0
+    for filepath in args.files or eeg_batch.participant_files(args.task):
+        report = check_participant(args.task, filepath)
+        failed += not report["ok"]
+        print(("ok        " if report["ok"] else "MISMATCH  ") + report["participant"] + ": " +
+              describe(report))
+    if failed:
+        print(str(failed) + " participants do not line up")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""
+Batch driver for the pre-processing pipeline.
+
+Runs eeg_pipeline.process_participant() for every participant of a task
+that does not have a .mat file (or a row in the epoch store) yet. With --jobs N the participants are
+spread over N worker processes; a participant that crashes is reported at
+the end and does not stop the rest of the run. The console output of each
+participant is printed in the order the files were submitted. Run one
+at a time, the next participants' recordings are read and decoded in a
+background thread once the current one's is filtered, while it is in the
+ICA or epoching, as many ahead as fit in --prefetch GB (not with
+--profile). With --journal DIR every stage is
+checkpointed as it completes, and a rerun after a crash picks each
+unfinished participant up after their last completed stage.
+
+Usage:
+    python eeg_batch.py eriksen --jobs 8
+
+@author: James Bartlett
+"""
+
+import argparse
+import contextlib
+import functools
+import glob
+import io
+import logging
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import eeg_pipeline
+from eeg_cache import StageCache, DEFAULT_MAX_BYTES
+from eeg_journal import StageJournal
+from eeg_profile import write_records
+
+# memory the recordings read ahead of the participant in hand may take up
+PREFETCH_BYTES = 2 * 1024 ** 3
+
+
+def participant_files(task):
+    """OpenSesame .csv files of every participant of a task."""
+    return sorted(glob.glob(os.path.join(eeg_pipeline.TASKS[task]["behavioural"], "*.csv")))
+
+
+def prefetch_stages(task, filepath, options=None):
+    """Load a participant's recording for process_participant(prefetched=...).
+
+    Nothing is loaded if the filtered data is cached or processed in chunks.
+    """
+    graph = eeg_pipeline.participant_stages(task, filepath, options)
+    if "load" not in graph.stages or graph.cached("filter"):
+        return {}
+    return {"load": graph.get("load")}
+
+
+def prefetch_participants(task, filelist, options=None, max_bytes=PREFETCH_BYTES):
+    """Yield every file, its prefetched stages and a function that starts reading ahead.
+
+    The next participants are prefetched in a background thread while their
+    recordings fit in max_bytes together. A failed prefetch is left to fail
+    again when the participant is processed.
+    """
+    options = options or eeg_pipeline.Options()
+    config = eeg_pipeline.TASKS[task]
+    sizes = []
+    for filepath in filelist:
+        eegpath = os.path.join(config["eeg"], eeg_pipeline.participant_name(filepath) + '.bdf')
+        try:
+            size = eeg_pipeline.load_size(eegpath, options.lazy_load, options.float32)
+        except (OSError, ValueError):
+            size = None  # not readable - left to fail when it is processed
+        sizes.append(None if options.chunk else size)
+    futures = {}
+    submitted = 0
+    with ThreadPoolExecutor(max_workers=1) as pool:
+
+        def read_ahead(i):
+            # read ahead of participant i while the waiting recordings fit
+            nonlocal submitted
+            submitted = max(submitted, i + 1)
+            waiting = sum(sizes[j] for j in futures)
+            while submitted < len(filelist):
+                size = sizes[submitted]
+                if size is not None and size <= max_bytes:
+                    if waiting + size > max_bytes:
+                        break
+                    futures[submitted] = pool.submit(prefetch_stages, task, filelist[submitted],
+                                                     options)
+                    waiting += size
+                submitted += 1
+
+        for i, filepath in enumerate(filelist):
+            prefetched = {}
+            if i in futures:
+                try:
+                    prefetched = futures.pop(i).result()
+                except Exception:
+                    pass
+            yield filepath, prefetched, functools.partial(read_ahead, i)
+            # in case the participant never got as far as the filter
+            read_ahead(i)
+            # let go of this participant's recording before the next is handed out
+            prefetched = None
+
+
+def run_participant(task, filepath, interactive=True, capture=False, options=None,
+                    prefetched=None, read_ahead=None):
+    """Process one participant, catching any error.
+
+    Returns the result of eeg_pipeline.process_participant() with the
+    participant name, status ("done" or "failed"), the traceback of a
+    failure and, if capture is True, everything printed while processing.
+    """
+    result = {"participant": eeg_pipeline.participant_name(filepath),
+              "status": "done", "outputs": [], "components": None,
+              "new_components": False, "profile": None, "error": None, "log": ""}
+    buffer = io.StringIO()
+    redirect = contextlib.ExitStack()
+    if capture:
+        # MNE logs through its own handler, so give it one that writes to the buffer
+        handler = logging.StreamHandler(buffer)
+        logging.getLogger("mne").addHandler(handler)
+        redirect.enter_context(contextlib.redirect_stdout(buffer))
+        redirect.enter_context(contextlib.redirect_stderr(buffer))
+    with redirect:
+        try:
+            result.update(eeg_pipeline.process_participant(task, filepath, options,
+                                                            interactive=interactive,
+                                                            prefetched=prefetched,
+                                                            read_ahead=read_ahead))
+        except Exception:
+            result["status"] = "failed"
+            result["error"] = traceback.format_exc()
+            print(result["error"])
+    if capture:
+        logging.getLogger("mne").removeHandler(handler)
+        result["log"] = buffer.getvalue()
+    return result
+
+
+def run_batch(task, jobs=1, options=None, overwrite=False, profile_path=None,
+              prefetch_bytes=PREFETCH_BYTES):
+    """Process every participant of a task that has not been processed yet.
+
+    With jobs=1 the participants run one after another in this process,
+    reading ahead within prefetch_bytes, and missing ICA components are
+    asked for at the prompt. With more jobs up to that many participants
+    run at once in worker processes. options is an eeg_pipeline.Options;
+    participants unfinished in its journal are processed again. With
+    profile_path the stage profiles are appended to that JSON-lines file.
+    Returns the list of results in submission order.
+    """
+    options = options or eeg_pipeline.Options()
+    journal = options.journal
+    # participants with checkpoints died part way, maybe after some of their files were written
+    unfinished = {}
+    if journal:
+        journal = StageJournal(journal)
+        unfinished = dict((name, journal.completed(task, name))
+                          for t, name in journal.participants(task))
+    filelist = [f for f in participant_files(task) if overwrite or
+                eeg_pipeline.participant_name(f) in unfinished or
+                not eeg_pipeline.is_processed(task, eeg_pipeline.participant_name(f),
+                                              options.output)]
+    print("Processing " + str(len(filelist)) + " participants with " + str(jobs) + " job(s)")
+    for filepath in filelist:
+        stages = unfinished.get(eeg_pipeline.participant_name(filepath))
+        if stages:
+            print("  resuming " + eeg_pipeline.participant_name(filepath) + " after " +
+                  ", ".join(stage for stage, path, finished in stages))
+
+    def record(result):
+        # only this process writes the profile, so the lines never interleave
+        if profile_path and result.get("profile"):
+            write_records(profile_path, result["participant"], task, result["profile"],
+                          status=result["status"])
+        results.append(result)
+
+    results = []
+    if jobs == 1:
+        if options.profile:
+            # the /proc counters would charge the background reads to this participant
+            prefetch_bytes = 0
+        for filepath, prefetched, read_ahead in prefetch_participants(task, filelist, options,
+                                                                      prefetch_bytes):
+            record(run_participant(task, filepath, options=options, prefetched=prefetched,
+                                   read_ahead=read_ahead))
+            del prefetched  # not held while the next participants are read ahead
+        return results
+
+    with ThreadPoolExecutor(max_workers=jobs) as threads:
+        futures = [threads.submit(run_isolated, task, filepath, options) for filepath in filelist]
+        # collect in submission order so the logs read like a serial run
+        for future in futures:
+            result = future.result()
+            print("----- " + result["participant"] + " -----")
+            print(result["log"])
+            record(result)
+    return results
+
+
+def run_isolated(task, filepath, options=None):
+    """Process one participant in its own worker process.
+
+    Each participant gets a fresh single-worker pool, so a worker that dies
+    (e.g. killed for running out of memory) only fails that participant.
+    """
+    with ProcessPoolExecutor(max_workers=1) as pool:
+        future = pool.submit(run_participant, task, filepath, False, True, options)
+        try:
+            return future.result()
+        except Exception:
+            return {"participant": eeg_pipeline.participant_name(filepath),
+                    "status": "failed", "outputs": [], "components": None,
+                    "new_components": False, "profile": None,
+                    "error": traceback.format_exc(), "log": ""}
+
+
+def summarise(results):
+    """Print how many participants were processed and which ones failed."""
+    failed = [r["participant"] for r in results if r["status"] == "failed"]
+    print(str(len(results) - len(failed)) + " participants processed, " +
+          str(len(failed)) + " failed")
+    for participant in failed:
+        print("  failed: " + participant)
+
+
+def main(task=None, argv=None):
+    parser = argparse.ArgumentParser(description="Pre-process the EEG data of a task.")
+    if task is None:
+        parser.add_argument("task", choices=sorted(eeg_pipeline.TASKS))
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="number of participants processed at the same time")
+    parser.add_argument("--cache", metavar="DIR",
+                        help="save the output of every stage here and reuse it on reruns")
+    parser.add_argument("--cache-size", type=float, default=DEFAULT_MAX_BYTES / 1024.0 ** 3,
+                        help="maximum size of the cache in GB (default %(default)s)")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="re-process participants that already have a .mat file")
+    parser.add_argument("--lazy-load", action="store_true",
+                        help="only decode the channels and time span the pipeline needs")
+    parser.add_argument("--auto-eog", action="store_true",
+                        help="choose the blink ICA components automatically instead of at the prompt")
+    parser.add_argument("--output", choices=["mat", "store"], default="mat",
+                        help="write .mat files or add the epochs to the task's HDF5 "
+                             "epoch store (default %(default)s)")
+    parser.add_argument("--sfreq", type=float,
+                        help="down-sample to this rate (Hz) after filtering, e.g. 256 - "
+                             "default the recorded 1024 Hz")
+    parser.add_argument("--float32", action="store_true",
+                        help="process and save the data in single precision, "
+                             "best with --lazy-load (see eeg_float32.py)")
+    parser.add_argument("--chunk", type=float, metavar="SECONDS",
+                        help="filter, clean and epoch the recording this many seconds at a "
+                             "time instead of loading it whole, e.g. 60, for long sessions "
+                             "(see eeg_chunked.py)")
+    parser.add_argument("--reject", choices=eeg_pipeline.REJECT_MODES, default="fixed",
+                        help="reject trials above 100 uV peak-to-peak, or above a threshold "
+                             "chosen by cross-validation for each participant or each "
+                             "channel (default %(default)s, see eeg_reject.py)")
+    parser.add_argument("--locks", nargs="+", metavar="LOCK",
+                        help="also epoch these lock points in the same pass: stimulus, "
+                             "response or either with a shift in ms, e.g. response-100 "
+                             "(written to a <lock>-locked folder or store)")
+    parser.add_argument("--no-align", action="store_true",
+                        help="skip the check of the triggers against the OpenSesame trials "
+                             "(see eeg_align.py)")
+    parser.add_argument("--prefetch", type=float, default=PREFETCH_BYTES / 1024.0 ** 3,
+                        metavar="GB",
+                        help="with one job, read the next participants' recordings in the "
+                             "background while they fit in this much memory, 0 to turn it "
+                             "off (default %(default)s, off with --profile)")
+    parser.add_argument("--journal", metavar="DIR",
+                        help="checkpoint every stage here as it completes, so a rerun after "
+                             "a crash resumes each participant after their last completed "
+                             "stage (see eeg_journal.py)")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="append the time, memory and I/O of every stage of every "
+                             "participant to this JSON-lines file")
+    args = parser.parse_args(argv)
+    try:
+        eeg_pipeline.task_locks(task or args.task, args.locks)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.chunk and args.sfreq:
+        parser.error("--chunk cannot be used with --sfreq")
+    options = eeg_pipeline.Options(
+        cache=StageCache(args.cache, max_bytes=int(args.cache_size * 1024 ** 3))
+        if args.cache else None,
+        lazy_load=args.lazy_load, float32=args.float32, sfreq=args.sfreq, chunk=args.chunk,
+        locks=args.locks, journal=args.journal, auto_eog=args.auto_eog, output=args.output,
+        reject=args.reject, align=not args.no_align, profile=bool(args.profile),
+        # the CPUs the participants running at the same time leave free
+        reject_jobs=max(1, (os.cpu_count() or 1) // args.jobs))
+    results = run_batch(task or args.task, jobs=args.jobs, options=options,
+                        overwrite=args.overwrite, profile_path=args.profile,
+                        prefetch_bytes=int(args.prefetch * 1024 ** 3))
+    summarise(results)
+    return results
+
+
+if __name__ == "__main__":
+    main()
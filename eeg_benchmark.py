@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Time and memory of every stage of the pipeline on synthetic recordings.
+
+For each recording length, synthetic participants are written to a
+temporary folder (see eeg_synthetic.py) and processed stage by stage as in
+eeg_pipeline.process_participant(), with the components chosen
+automatically. For every stage the wall time and the peak memory allocated
+while it ran (as seen by tracemalloc, which includes NumPy arrays) are
+appended to benchmarks/results.jsonl together with the git version of the
+code, so runs of different versions can be compared. tracemalloc slows
+down stages that make many small Python objects (e.g. writing the ROI
+table), so use --no-memory for times alone.
+
+    python eeg_benchmark.py run eriksen --minutes 12 30 --participants 2
+    python eeg_benchmark.py compare
+
+@author: James Bartlett
+"""
+
+import argparse
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import pandas as pd
+
+import eeg_align
+import eeg_pipeline
+import eeg_synthetic
+from eeg_eog import find_eog_components
+
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks", "results.jsonl")
+
+# a stage this much slower (or bigger) than in the previous version is flagged
+REGRESSION = 1.10
+
+
+def code_version():
+    """git commit of the pipeline code, with -dirty if it has local changes."""
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+class StageTimer(object):
+    """Wall time and peak traced memory of each stage run through measure()."""
+
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.rows = []
+
+    def measure(self, stage, function, *args, **kwargs):
+        if self.memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            peak = None
+            if self.memory:
+                peak = tracemalloc.get_traced_memory()[1] / 1024.0 ** 2
+                tracemalloc.stop()
+            self.rows.append({"stage": stage, "seconds": seconds, "peak_mb": peak})
+
+
+def profile_participant(task, filepath, lazy_load=False, output="mat", memory=True, sfreq=None,
+                        float32=False, chunk=None):
+    """Process one participant a stage at a time; returns the StageTimer rows."""
+    timer = StageTimer(memory)
+    name = eeg_pipeline.participant_name(filepath)
+    timer.measure("align", eeg_align.check_participant, task, filepath)
+    options = eeg_pipeline.Options(lazy_load=lazy_load, sfreq=sfreq, float32=float32, chunk=chunk)
+    graph = timer.measure("hash", eeg_pipeline.participant_stages, task, filepath, options)
+    # each stage is fetched after the ones it depends on, so it is timed on its own
+    for stage in [s for s in ("load", "events", "reference", "filter", "ica_sample", "ica_fit",
+                              "resample") if s in graph.stages]:
+        timer.measure(stage, graph.get, stage)
+    raw, decim = eeg_pipeline.component_data(graph)
+    eog_inds = timer.measure("eog", find_eog_components, graph.get("ica_fit"), raw, decim=decim)
+    eeg_pipeline.add_clean_stages(task, graph, eog_inds, options)
+    for stage in [s for s in ("ica_apply", "epochs") if s in graph.stages]:
+        timer.measure(stage, graph.get, stage)
+    epochs = graph.get("epochs")[eeg_pipeline.task_lock(task)]
+    if output == "store":
+        timer.measure("save", eeg_pipeline.store_epochs, task, name, epochs)
+    else:
+        timer.measure("save", eeg_pipeline.save_epochs, task, name, epochs)
+    timer.measure("roi", eeg_pipeline.save_roi, task, name, epochs)
+    return timer.rows
+
+
+def run(task, minutes, participants, lazy_load=False, output="mat", label="",
+        results=RESULTS, memory=True, sfreq=None, float32=False, chunk=None):
+    """Benchmark every recording length and append the rows to results."""
+    version = code_version()
+    date = datetime.datetime.now().isoformat(timespec="seconds")
+    cwd = os.getcwd()
+    rows = []
+    for length in minutes:
+        folder = tempfile.mkdtemp(prefix="eeg-benchmark-")
+        try:
+            for subject in range(1001, 1001 + participants):
+                eeg_synthetic.write_participant(task, folder, subject, length)
+            # the pipeline's paths are relative to the analysis folder
+            os.chdir(folder)
+            for subject in range(1001, 1001 + participants):
+                filepath = os.path.join(eeg_pipeline.TASKS[task]["behavioural"],
+                                        str(subject) + "-" + task + ".csv")
+                for row in profile_participant(task, filepath, lazy_load, output, memory, sfreq,
+                                               float32, chunk):
+                    row.update({"version": version, "date": date, "label": label,
+                                "task": task, "minutes": length, "participant": subject,
+                                "lazy_load": lazy_load, "output": output, "sfreq": sfreq,
+                                "float32": float32, "chunk": chunk})
+                    rows.append(row)
+                    line = "{minutes:>6} min  {participant}  {stage:<10} {seconds:8.2f} s"
+                    if row["peak_mb"] is not None:
+                        line += " {peak_mb:9.1f} MB"
+                    print(line.format(**row))
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(folder, ignore_errors=True)
+
+    folder = os.path.dirname(results)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+    with open(results, "a") as f:
+        for row in rows:
+            f.write(json.dumps(row, sort_keys=True) + "\n")
+    return rows
+
+
+def compare(results=RESULTS, versions=None):
+    """Median time and memory of every stage for two versions, flagging regressions.
+
+    versions defaults to the last two versions in the results file.
+    """
+    table = pd.read_json(results, lines=True)
+    order = list(pd.unique(table["version"]))
+    versions = versions or order[-2:]
+    table = table[table["version"].isin(versions)]
+    # results from before --sfreq, --float32 and --chunk
+    if "sfreq" not in table:
+        table["sfreq"] = None
+    if "float32" not in table:
+        table["float32"] = False
+    if "chunk" not in table:
+        table["chunk"] = None
+    table["float32"] = table["float32"].fillna(False).astype(bool)
+    # rows without a rate were run at the recorded rate - keep them as a group
+    summary = table.groupby(["task", "minutes", "lazy_load", "output", "sfreq", "float32",
+                             "chunk", "stage", "version"], dropna=False)[["seconds", "peak_mb"]]
+    summary = summary.median().unstack("version")
+    if len(versions) == 2:
+        old, new = versions
+        for measure in ("seconds", "peak_mb"):
+            ratio = summary[(measure, new)] / summary[(measure, old)]
+            summary[(measure, "ratio")] = ratio
+        summary["regression"] = ((summary[("seconds", "ratio")] > REGRESSION) |
+                                 (summary[("peak_mb", "ratio")] > REGRESSION))
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic data.")
+    sub = parser.add_subparsers(dest="command")
+    bench = sub.add_parser("run", help="time every stage and append to the results")
+    bench.add_argument("task", choices=sorted(eeg_pipeline.TASKS))
+    bench.add_argument("--minutes", type=float, nargs="+", default=[12.0],
+                       help="recording lengths to benchmark")
+    bench.add_argument("--participants", type=int, default=1)
+    bench.add_argument("--lazy-load", action="store_true")
+    bench.add_argument("--output", choices=["mat", "store"], default="mat")
+    bench.add_argument("--sfreq", type=float, help="down-sample to this rate after filtering")
+    bench.add_argument("--float32", action="store_true", help="process in single precision")
+    bench.add_argument("--chunk", type=float, metavar="SECONDS",
+                       help="process the recording in chunks of this length")
+    bench.add_argument("--no-memory", action="store_true",
+                       help="only time the stages, without tracemalloc")
+    bench.add_argument("--label", default="", help="note stored with the results")
+    bench.add_argument("--results", default=RESULTS)
+    comp = sub.add_parser("compare", help="compare the stages of two versions")
+    comp.add_argument("versions", nargs="*", help="two versions (default the last two)")
+    comp.add_argument("--results", default=RESULTS)
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        run(args.task, args.minutes, args.participants, args.lazy_load, args.output,
+            args.label, args.results, not args.no_memory, args.sfreq, args.float32, args.chunk)
+    elif args.command == "compare":
+        with pd.option_context("display.width", 200, "display.max_rows", None):
+            print(compare(args.results, args.versions or None))
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed cache for the stages of the pre-processing pipeline.
+
+Every stage (raw load, re-reference, filter, ICA fit, ICA apply, epochs) is
+given a key that is a hash of its parameters and the keys of the stages it
+depends on, starting from a hash of the .bdf and .csv file contents. The
+output of each stage is saved under its key, so changing one parameter
+(e.g. the reject threshold or tmax) only changes the keys of that stage and
+the stages after it - everything before it is loaded from the cache.
+
+The cache directory is kept below a maximum size by deleting the least
+recently used entries.
+
+@author: James Bartlett
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import uuid
+import numpy as np
+import mne
+from eeg_profile import measure
+
+# 50 GB - a one hour recording is roughly 1 GB per raw stage
+DEFAULT_MAX_BYTES = 50 * 1024 ** 3
+
+# file name of the saved output for each kind of stage
+# raw32 is a Raw holding float32 data (see eeg_float32.py), locks a dictionary
+# of npz-like dictionaries, one per lock point
+FILENAMES = {"raw": "stage_raw.fif", "raw32": "stage_raw.fif", "ica": "stage-ica.fif",
+             "epochs": "stage-epo.fif", "array": "stage.npy", "npz": "stage.npz",
+             "locks": "stage-locks.npz"}
+
+_file_hashes = {}
+
+
+def file_hash(path):
+    """sha256 of a file's contents, remembered while the file is unchanged."""
+    stat = os.stat(path)
+    memo = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    if memo not in _file_hashes:
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(block)
+        _file_hashes[memo] = sha.hexdigest()
+    return _file_hashes[memo]
+
+
+def stage_key(name, parents, params):
+    """Hash of a stage name, the keys of its inputs and its parameters."""
+    text = json.dumps({"stage": name, "parents": list(parents), "params": params},
+                      sort_keys=True, default=repr)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def save_value(value, kind, path):
+    """Write a stage output with the MNE (or NumPy) writer for its kind."""
+    if kind == "raw":
+        value.save(path, fmt="double")
+    elif kind == "raw32":
+        value.save(path, fmt="single")
+    elif kind == "ica":
+        value.save(path)
+    elif kind == "epochs":
+        value.save(path)
+    elif kind == "array":
+        np.save(path, value)
+    elif kind == "npz":
+        np.savez(path, **value)
+    elif kind == "locks":
+        np.savez(path, **{lock + "/" + k: v for lock, d in value.items() for k, v in d.items()})
+    else:
+        raise ValueError("Unknown stage kind " + kind)
+
+
+def load_value(kind, path):
+    """Read a stage output written by save_value()."""
+    if kind == "raw":
+        return mne.io.read_raw_fif(path, preload=True)
+    elif kind == "raw32":
+        # MNE reads the single precision .fif back as float64
+        raw = mne.io.read_raw_fif(path, preload=True)
+        raw._data = raw._data.astype(np.float32)
+        return raw
+    elif kind == "ica":
+        return mne.preprocessing.read_ica(path)
+    elif kind == "epochs":
+        return mne.read_epochs(path, preload=True)
+    elif kind == "array":
+        return np.load(path)
+    elif kind == "npz":
+        with np.load(path) as f:
+            return dict(f)
+    elif kind == "locks":
+        value = {}
+        with np.load(path) as f:
+            for name in f.files:
+                lock, k = name.rsplit("/", 1)
+                value.setdefault(lock, {})[k] = f[name]
+        return value
+    raise ValueError("Unknown stage kind " + kind)
+
+
+def persistent_record(path):
+    """Name of the .json file recording which stage key is saved at path."""
+    return os.path.splitext(path)[0] + ".json"
+
+
+def is_persistent(path, key):
+    """Whether the stage output saved at path is the one for key."""
+    record = persistent_record(path)
+    if not (os.path.isfile(path) and os.path.isfile(record)):
+        return False
+    with open(record) as f:
+        return json.load(f).get("key") == key
+
+
+def load_persistent(path, kind, key):
+    """Stage output saved at path, or None if it is missing or out of date."""
+    if not is_persistent(path, key):
+        return None
+    try:
+        return load_value(kind, path)
+    except Exception:
+        # unreadable - forget the record so the output is saved again
+        try:
+            os.remove(persistent_record(path))
+        except OSError:
+            pass
+        return None
+
+
+def save_persistent(value, path, kind, key, name, params):
+    """Save a stage output at path along with the key it was computed for."""
+    if is_persistent(path, key):
+        return
+    record = persistent_record(path)
+    folder = os.path.dirname(path) or "."
+    if not os.path.isdir(folder):
+        os.makedirs(folder, exist_ok=True)
+    # write under the final name in a folder next to it and move the files in:
+    # MNE splits a raw over 2 GB into parts that refer to each other by name
+    base = os.path.basename(path)
+    tmp = os.path.join(folder, "tmp-" + uuid.uuid4().hex)
+    os.makedirs(tmp)
+    try:
+        save_value(value, kind, os.path.join(tmp, base))
+        # the first part last, so it is never there without the rest
+        for part in sorted(os.listdir(tmp), key=lambda f: f == base):
+            os.replace(os.path.join(tmp, part), os.path.join(folder, part))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    with open(record + ".tmp", "w") as f:
+        json.dump({"stage": name, "key": key, "params": params}, f,
+                  sort_keys=True, indent=2, default=repr)
+    os.replace(record + ".tmp", record)
+
+
+class StageCache(object):
+    """Directory of stage outputs keyed by stage_key().
+
+    Each entry is a folder <directory>/<key[:2]>/<key>. An entry's
+    modification time is updated whenever it is read, and once the
+    directory grows above max_bytes the least recently used entries are
+    deleted. The directory is only scanned on the first put() and when the
+    entries put since then take it past max_bytes; entries put by other
+    processes in the meantime are counted at the next scan.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # size of the cache at the last scan plus what was put since, None before a scan
+        self.total = None
+
+    def entry(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def has(self, key, kind):
+        """Whether a stage output is saved under key (it may still be evicted)."""
+        return os.path.isfile(os.path.join(self.entry(key), FILENAMES[kind]))
+
+    def get(self, key, kind):
+        """Stage output saved under key, or None if it is not cached."""
+        path = os.path.join(self.entry(key), FILENAMES[kind])
+        if not os.path.isfile(path):
+            return None
+        try:
+            value = load_value(kind, path)
+        except Exception:
+            # evicted by another worker while we were reading it, or a broken entry
+            return None
+        try:
+            os.utime(self.entry(key), None)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, kind, value):
+        """Save a stage output under key and keep the cache below max_bytes."""
+        entry = self.entry(key)
+        if os.path.isdir(entry):
+            return
+        # write to a temporary folder first so other workers never see half an entry
+        tmp = os.path.join(self.directory, "tmp-" + uuid.uuid4().hex)
+        os.makedirs(tmp)
+        try:
+            save_value(value, kind, os.path.join(tmp, FILENAMES[kind]))
+            if not os.path.isdir(os.path.dirname(entry)):
+                os.makedirs(os.path.dirname(entry), exist_ok=True)
+            os.rename(tmp, entry)
+        except OSError:
+            # another worker saved the same entry first
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        try:
+            size = sum(f.stat().st_size for f in os.scandir(entry) if f.is_file())
+        except OSError:
+            size = 0  # evicted by another worker straight away
+        if self.total is None or self.total + size > self.max_bytes:
+            self.evict()
+        else:
+            self.total += size
+
+    def entries(self):
+        """(last used, size in bytes, path) of every entry in the cache."""
+        found = []
+        if not os.path.isdir(self.directory):
+            return found
+        for prefix in os.scandir(self.directory):
+            if not prefix.is_dir() or prefix.name.startswith("tmp-"):
+                continue
+            for entry in os.scandir(prefix.path):
+                size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+                found.append((entry.stat().st_mtime, size, entry.path))
+        return found
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits in max_bytes."""
+        entries = sorted(self.entries())
+        total = sum(size for used, size, path in entries)
+        for used, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+        self.total = total
+
+
+class StageGraph(object):
+    """The stages of one participant and their dependencies.
+
+    Stages are only computed when asked for with get(). If a stage is in the
+    cache it is loaded and the stages it depends on are never touched;
+    otherwise its inputs are fetched (from the cache or by computing them)
+    and its output is saved to the cache. Without a cache every stage is
+    simply computed once. A stage may modify its input in place, so each
+    stage output should only be used by the stages listed after it.
+
+    With an eeg_profile.StageProfiler every stage that is computed or loaded
+    is measured on its own, without the stages it depends on. With the
+    journal of the participant (see eeg_journal.py) every computed stage is
+    checkpointed, and a checkpoint with the right key is used like a cached
+    output.
+    """
+
+    def __init__(self, cache=None, profiler=None, journal=None):
+        self.cache = cache
+        self.profiler = profiler
+        self.journal = journal
+        self.stages = {}
+        self.keys = {}
+        self.values = {}
+        # anything the stages share that is not a stage output (e.g. the
+        # chunked recording of eeg_pipeline.participant_stages())
+        self.context = {}
+        self.hooks = {}
+
+    def add(self, name, kind, compute, deps=(), params=None, path=None):
+        """Register a stage computed as compute(*[outputs of deps]).
+
+        If path is given the stage output is also kept at that fixed path,
+        outside the cache so it is never evicted, and reused while its key
+        still matches.
+        """
+        self.stages[name] = (kind, compute, tuple(deps), params or {}, path)
+
+    def on_output(self, name, callback):
+        """Call callback() once the output of a stage has been computed or loaded."""
+        self.hooks.setdefault(name, []).append(callback)
+
+    def provide(self, name, value):
+        """Use value, worked out elsewhere (e.g. prefetched), as the output of a stage."""
+        with measure(self.profiler, name) as record:
+            record["source"] = "prefetched"
+        self.values[name] = value
+
+    def cached(self, name):
+        """Whether a stage output can be had without computing it."""
+        kind, compute, deps, params, path = self.stages[name]
+        return (name in self.values or
+                (path is not None and is_persistent(path, self.key(name))) or
+                (self.cache is not None and self.cache.has(self.key(name), kind)) or
+                (self.journal is not None and self.journal.has(name, self.key(name))))
+
+    def key(self, name):
+        if name not in self.keys:
+            kind, compute, deps, params, path = self.stages[name]
+            self.keys[name] = stage_key(name, [self.key(d) for d in deps], params)
+        return self.keys[name]
+
+    def get(self, name):
+        """Output of a stage, loading or computing only what is needed."""
+        if name in self.values:
+            return self.values[name]
+        kind, compute, deps, params, path = self.stages[name]
+        with measure(self.profiler, name) as record:
+            value = None
+            if path is not None:
+                value = load_persistent(path, kind, self.key(name))
+                record["source"] = "saved"
+            if value is None and self.cache is not None:
+                value = self.cache.get(self.key(name), kind)
+                record["source"] = "cache"
+            if value is None and self.journal is not None:
+                value = self.journal.load(name, kind, self.key(name))
+                record["source"] = "journal"
+            # a miss is not a stage of its own - it is measured with the compute below
+            record["skip"] = value is None
+        if value is None:
+            inputs = [self.get(d) for d in deps]
+            with measure(self.profiler, name) as record:
+                record["source"] = "computed"
+                value = compute(*inputs)
+                if self.cache is not None:
+                    self.cache.put(self.key(name), kind, value)
+                if path is not None:
+                    save_persistent(value, path, kind, self.key(name), name, params)
+                if self.journal is not None:
+                    self.journal.save(name, kind, self.key(name), value, params, path)
+        self.values[name] = value
+        for callback in self.hooks.pop(name, []):
+            callback()
+        return value
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Process a recording a chunk at a time, for sessions too long to hold in memory.
+
+The normal pipeline loads the whole recording, filters it and applies the
+ICA to all of it at once, so its memory grows with the length of the
+session. With --chunk the continuous data is never held as a whole:
+
+- the pipeline channels are decoded from the .bdf a chunk of CHUNK seconds
+  at a time, with half the length of the band-pass filter read on either
+  side of the chunk. Filtering a chunk with its overlap gives exactly the
+  samples of filtering the whole recording, and at the ends of the
+  recording the data is padded with its odd reflection as raw.filter pads
+  it. The filter is MNE's (the same design as raw.filter), applied as in
+  eeg_float32.band_pass()
+- the ICA is fitted on a decimated sample of the filtered data, every
+  SETTINGS["decim"]-th sample as in the normal pipeline, or fewer for
+  recordings long enough to make the sample bigger than ICA_SAMPLES. It is
+  not the ICA of the normal pipeline (a FastICA fit that does not converge
+  turns even rounding differences into other components), so components in
+  the exclusion ledger chosen without --chunk are chosen again (see
+  eeg_pipeline.read_exclusions())
+- the chunks are filtered again for the epochs, cleaned with the ICA as one
+  matrix (see eeg_float32.ica_operator()), re-referenced to the average and
+  the epochs ending in each chunk are cut from it plus the last samples of
+  the chunk before
+
+The peak memory is a few chunks plus the ICA sample and the epochs
+themselves, whatever the length of the recording. The recording is read
+twice, once for the ICA and once for the epochs, and the ICA is only
+fitted (and the first read done) if the saved ICA is out of date. Resampling
+(--sfreq) is not supported in this mode.
+
+@author: James Bartlett
+"""
+
+import numpy as np
+import scipy.signal
+import mne
+
+import bdf_reader
+import eeg_float32
+# eeg_pipeline imports this module as well - only used inside the methods
+import eeg_pipeline
+from eeg_epochs import epoch_samples, extract_epochs
+
+# seconds of data processed at a time
+CHUNK = 60.0
+
+# most samples the ICA is fitted on - about 70 MB of float64 for 33 channels
+ICA_SAMPLES = 2 ** 18
+
+
+class ChunkedRecording(object):
+    """The EEG channels of a .bdf file, band-pass filtered a chunk at a time.
+
+    With lazy only the part of the recording around the triggers is used,
+    as eeg_pipeline.load_raw(lazy=True) reads it, else the whole recording.
+    The data is decoded and filtered in dtype and chunk is in seconds.
+    """
+
+    def __init__(self, eegpath, lazy=False, dtype=np.float64, chunk=CHUNK):
+        header = bdf_reader.read_header(eegpath)
+        channels, start, stop = eeg_pipeline.lazy_selection(eegpath)
+        if not lazy:
+            start, stop = 0, header["n_records"] * int(header["n_samples"][0])
+        self.eegpath = eegpath
+        self.header = header
+        self.channels = [ch for ch in channels if ch != "Status"]
+        self.start, self.stop = start, stop
+        self.sfreq = header["sfreq"]
+        self.dtype = dtype
+        self.chunk = int(chunk * self.sfreq)
+        settings = eeg_pipeline.SETTINGS
+        self.kernel = mne.filter.create_filter(None, self.sfreq, settings["l_freq"],
+                                               settings["h_freq"]).astype(dtype)
+
+    def filtered(self):
+        """Every chunk of the band-pass filtered data, with its first sample number."""
+        half = (len(self.kernel) - 1) // 2
+        for first in range(self.start, self.stop, self.chunk):
+            last = min(first + self.chunk, self.stop)
+            lo, hi = max(first - half, self.start), min(last + half, self.stop)
+            data = bdf_reader.read_channels(self.eegpath, self.channels, lo, hi,
+                                            dtype=self.dtype, header=self.header)
+            # what is missing of the overlap is beyond the ends of the recording
+            pad = (half - (first - lo), half - (hi - last))
+            out = np.empty((len(self.channels), last - first), dtype=self.dtype)
+            for ch in range(len(self.channels)):
+                padded = np.pad(data[ch], pad, mode="reflect", reflect_type="odd")
+                out[ch] = scipy.signal.oaconvolve(padded, self.kernel, mode="valid")
+            yield first, out
+
+    def ica_sample(self):
+        """Raw of the filtered data the ICA is fitted on, decimated as fit_ica() would.
+
+        Every SETTINGS["decim"]-th sample, counted from the first, or every
+        n-th to keep it within ICA_SAMPLES. The rate of the Raw is the
+        decimated rate, and it gets the reference of eeg_pipeline.reference().
+        """
+        decim = max(eeg_pipeline.SETTINGS["decim"], -(-(self.stop - self.start) // ICA_SAMPLES))
+        sample = np.empty((len(self.channels), len(range(self.start, self.stop, decim))),
+                          dtype=self.dtype)
+        for first, data in self.filtered():
+            # samples counted from the first of the recording, not of the chunk
+            offset = -(first - self.start) % decim
+            kept = data[:, offset::decim]
+            done = -(-(first - self.start) // decim)
+            sample[:, done:done + kept.shape[1]] = kept
+        info = mne.create_info(self.channels, self.sfreq / decim, "eeg")
+        return eeg_pipeline.reference(bdf_reader.raw_array(sample, info))
+
+    def epochs(self, task, ica, eog_inds, events, reject="fixed", jobs=1, locks=None):
+        """Clean the recording a chunk at a time and cut the epochs of every lock point.
+
+        Everything is as in eeg_pipeline.make_epochs(), apart from where the
+        continuous data comes from.
+        """
+        settings = eeg_pipeline.SETTINGS
+        tmin, tmax = settings["tmin"], settings["tmax"]
+        trials, codes, keep = eeg_pipeline.task_trials(task, events)
+        n_locks, n_trials = trials.shape[:2]
+        start, n_samples = epoch_samples(tmin, tmax, self.sfreq)
+        firsts = trials[:, :, 0] + start
+        lasts = firsts + n_samples
+        fixed = settings["reject"]["eeg"] if reject == "fixed" else None
+
+        info = mne.create_info(self.channels, self.sfreq, "eeg")
+        picks, matrix, offset = eeg_float32.ica_operator(ica, info, eog_inds, self.dtype)
+        out = np.full((n_locks, len(self.channels), n_trials, n_samples), np.nan,
+                      dtype=self.dtype)
+        valid = np.zeros((n_locks, n_trials), dtype=bool)
+        previous = np.empty((len(self.channels), 0), dtype=self.dtype)
+        for first, data in self.filtered():
+            data[picks] = np.matmul(matrix, data[picks]) + offset[:, None]
+            data -= data.mean(axis=0)
+            # the end of the chunk before, for epochs that start in it
+            segment = np.concatenate([previous, data], axis=1)
+            begin, end = first - previous.shape[1], first + data.shape[1]
+            for lock in range(n_locks):
+                # every epoch is cut from the chunk it ends in
+                inside = keep & (lasts[lock] > first) & (lasts[lock] <= end) & \
+                    (firsts[lock] >= begin)
+                idx = np.flatnonzero(inside)
+                if len(idx) == 0:
+                    continue
+                eps, selection = extract_epochs(segment, trials[lock, idx, 0], tmin, tmax,
+                                                self.sfreq, first_samp=begin,
+                                                baseline=settings["baseline"], reject=fixed)
+                out[lock][:, idx] = eps
+                valid[lock, idx[selection]] = True
+            previous = segment[:, max(segment.shape[1] - (n_samples - 1), 0):].copy()
+
+        locked = [(out[lock], np.flatnonzero(valid[lock])) for lock in range(n_locks)]
+        return eeg_pipeline.locked_epochs(task, locked, codes, self.channels, self.sfreq,
+                                          reject, jobs, locks)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Automatic selection of the ICA components that capture eye blinks.
+
+Instead of looking at ica.plot_components() and typing the blink component
+in, every ICA source is scored against the frontal/EOG channels in two ways
+at once for all components:
+
+- the correlation of the source with each frontal channel, and
+- how well the source's average waveform around detected blinks matches the
+  average blink seen at the frontal channels.
+
+Components whose correlation stands out from the rest (z-score above
+Z_THRESHOLD) and whose blink waveform matches (correlation above
+TEMPLATE_THRESHOLD) are excluded, up to MAX_COMPONENTS of them.
+
+@author: James Bartlett
+"""
+
+import numpy as np
+from scipy import signal
+
+# channels closest to the eyes - EXG1 is the electrode under the eye
+EOG_CHANNELS = ['Fp1', 'Fp2', 'AF3', 'AF4', 'EXG1']
+
+# blinks are mostly between 1 and 10 Hz
+BLINK_BAND = (1.0, 10.0)
+
+Z_THRESHOLD = 3.0
+TEMPLATE_THRESHOLD = 0.8
+MAX_COMPONENTS = 3
+
+# seconds of data turned into sources at a time
+CHUNK_SECONDS = 60.0
+
+
+def _zscore_rows(x):
+    """Standardise each row to mean 0 and standard deviation 1."""
+    x = x - x.mean(axis=-1, keepdims=True)
+    sd = x.std(axis=-1, keepdims=True)
+    sd[sd == 0] = 1.0
+    return x / sd
+
+
+def _row_corr(a, b):
+    """Correlation of every row of a with every row of b."""
+    return _zscore_rows(a).dot(_zscore_rows(b).T) / a.shape[-1]
+
+
+def ica_sources(ica, raw, decim):
+    """ICA sources and frontal channels of raw, keeping every decim-th sample.
+
+    The sources are computed a chunk at a time so the whole recording is
+    never unmixed at full rate in memory.
+    """
+    frontal = [ch for ch in EOG_CHANNELS if ch in raw.ch_names]
+    if len(frontal) == 0:
+        raise ValueError("None of the EOG channels " + str(EOG_CHANNELS) + " were recorded")
+    picks = [raw.ch_names.index(ch) for ch in frontal]
+    chunk = int(CHUNK_SECONDS * raw.info['sfreq'])
+    sources, refs = [], []
+    for start in range(0, raw.n_times, chunk):
+        stop = min(start + chunk, raw.n_times)
+        sources.append(ica.get_sources(raw, start=start, stop=stop).get_data()[:, ::decim])
+        refs.append(raw.get_data(picks, start=start, stop=stop)[:, ::decim])
+    return np.concatenate(sources, axis=1), np.concatenate(refs, axis=1), frontal
+
+
+def score_components(sources, refs, sfreq):
+    """Correlation and blink template scores of every ICA source.
+
+    sources is (n_components, n_times) and refs (n_frontal, n_times) at the
+    sampling rate sfreq. Returns the absolute correlation of each component
+    with its best matching frontal channel and the correlation of each
+    component's average blink with the frontal average blink.
+    """
+    sos = signal.butter(4, BLINK_BAND, btype='bandpass', fs=sfreq, output='sos')
+    sources = signal.sosfiltfilt(sos, sources, axis=-1)
+    refs = signal.sosfiltfilt(sos, refs, axis=-1)
+
+    # all components against all frontal channels in one product
+    corr = np.abs(_row_corr(sources, refs)).max(axis=1)
+
+    # blinks are large deflections of the frontal average at least 0.5 s apart
+    frontal = refs.mean(axis=0)
+    frontal = frontal * np.sign(frontal[np.argmax(np.abs(frontal))])
+    peaks, _ = signal.find_peaks(frontal, height=frontal.mean() + 3 * frontal.std(),
+                                 distance=int(0.5 * sfreq))
+    half = int(0.25 * sfreq)
+    peaks = peaks[(peaks >= half) & (peaks < len(frontal) - half)]
+    if len(peaks) == 0:
+        return corr, np.zeros(len(sources))
+
+    # (components, blinks, samples) cut with one fancy index
+    window = peaks[:, None] + np.arange(-half, half + 1)[None, :]
+    source_blinks = sources[:, window].mean(axis=1)
+    frontal_blink = frontal[window].mean(axis=0)
+    template = np.abs(_row_corr(source_blinks, frontal_blink[None, :]))[:, 0]
+    return corr, template
+
+
+def select_components(corr, template):
+    """Indices of the blink components, strongest first.
+
+    Outlying correlations are found as in MNE's find_bads_eog: components
+    above the z-score threshold are set aside and the z-scores recomputed
+    on the rest until no more stand out.
+    """
+    outlier = np.zeros(len(corr), dtype=bool)
+    while not outlier.all():
+        rest = corr[~outlier]
+        z = (corr - rest.mean()) / (rest.std() or 1.0)
+        new = (z > Z_THRESHOLD) & ~outlier
+        if not new.any():
+            break
+        outlier |= new
+    chosen = np.where(outlier & (template > TEMPLATE_THRESHOLD))[0]
+    chosen = chosen[np.argsort(-corr[chosen])]
+    return [int(i) for i in chosen[:MAX_COMPONENTS]]
+
+
+def find_eog_components(ica, raw, decim=3):
+    """Choose the ICA components to exclude for a participant."""
+    sources, refs, frontal = ica_sources(ica, raw, decim)
+    corr, template = score_components(sources, refs, raw.info['sfreq'] / decim)
+    eog_inds = select_components(corr, template)
+    print("Automatic EOG components " + str(eog_inds) + " from " + ", ".join(frontal))
+    return eog_inds
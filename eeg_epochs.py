@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Epoch extraction straight from the continuous data array.
+
+mne.Epochs(..., preload=True) copies every epoch out of the raw data, the
+batch scripts then copied it again into a NaN-filled (trials, channels,
+samples) array and a third time with np.moveaxis for savemat. Here the
+epochs are a strided view over the filtered, ICA-cleaned continuous data,
+and are copied once, straight into the (channels, trials, samples) layout
+of the .mat files. Baseline correction and peak-to-peak rejection then work
+on that block in place, and rejected epochs are set to NaN as before.
+Several lock points of every trial (e.g. stimulus and response) are cut in
+the same pass.
+
+@author: James Bartlett
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def epoch_samples(tmin, tmax, sfreq):
+    """First sample offset and number of samples of an epoch, as MNE rounds them."""
+    start = int(round(tmin * sfreq))
+    stop = int(round(tmax * sfreq))
+    return start, stop - start + 1
+
+
+def epoch_rate(tmin, tmax, n_samples):
+    """Sampling rate of epochs of n_samples from tmin to tmax, as saved in the .mat files."""
+    return (n_samples - 1) / float(tmax - tmin)
+
+
+def epoch_times(tmin, tmax, sfreq):
+    """Time of every sample of an epoch in seconds."""
+    start, n_samples = epoch_samples(tmin, tmax, sfreq)
+    return (start + np.arange(n_samples)) / float(sfreq)
+
+
+def extract_epochs(data, onsets, tmin, tmax, sfreq, first_samp=0,
+                   baseline=(None, 0), reject=None, keep=None):
+    """Cut epochs out of continuous data.
+
+    data is the (channels, samples) continuous array, onsets the sample
+    number of time 0 of every trial (counted like raw.first_samp). Epochs
+    that run off either end of the data, that are not in keep (a boolean
+    mask over trials) or whose peak-to-peak amplitude exceeds reject on any
+    channel are filled with NaN.
+
+    Returns the (channels, trials, samples) array and the indices of the
+    retained trials, like epochs.selection.
+    """
+    return extract_locked(data, [onsets], tmin, tmax, sfreq, first_samp,
+                          baseline, reject, keep)[0]
+
+
+def extract_locked(data, onsets, tmin, tmax, sfreq, first_samp=0,
+                   baseline=(None, 0), reject=None, keep=None):
+    """Cut the epochs of several lock points of every trial in one pass.
+
+    onsets is a (lock points, trials) array, e.g. the stimulus onset and the
+    response of every trial, and everything else is as in extract_epochs().
+    The epochs of all the lock points are copied in the order they appear
+    in the data, so the continuous data is read once from start to end.
+
+    Returns a list with the (channels, trials, samples) array and the
+    retained trials of every lock point.
+    """
+    start, n_samples = epoch_samples(tmin, tmax, sfreq)
+    n_times = data.shape[1]
+    starts = np.asarray(onsets) - first_samp + start
+    n_locks, n_trials = starts.shape
+    valid = (starts >= 0) & (starts + n_samples <= n_times)
+    if keep is not None:
+        valid &= keep
+
+    # (channels, windows, samples) view of every possible epoch - nothing is copied yet
+    windows = sliding_window_view(data, n_samples, axis=1)
+    out = np.empty((n_locks, data.shape[0], n_trials, n_samples), dtype=data.dtype)
+    # the one copy, window by window straight into the output layout (np.take
+    # or fancy indexing would first make the view contiguous or a temporary)
+    firsts = np.clip(starts, 0, n_times - n_samples)
+    for flat in np.argsort(firsts, axis=None, kind="stable"):
+        lock, trial = divmod(int(flat), n_trials)
+        out[lock, :, trial, :] = windows[:, firsts[lock, trial], :]
+
+    if baseline is not None:
+        times = (start + np.arange(n_samples)) / float(sfreq)
+        bmin = times[0] if baseline[0] is None else baseline[0]
+        bmax = times[-1] if baseline[1] is None else baseline[1]
+        # the baseline samples are contiguous, so take a slice rather than a masked copy
+        base = np.flatnonzero((times >= bmin) & (times <= bmax))
+        out -= out[..., base[0]:base[-1] + 1].mean(axis=3, keepdims=True)
+
+    if reject is not None:
+        # peak-to-peak of every channel of every epoch at once
+        ptp = out.max(axis=3) - out.min(axis=3)
+        valid &= ~(ptp > reject).any(axis=1)
+
+    epochs = []
+    for lock in range(n_locks):
+        out[lock][:, ~valid[lock], :] = np.nan
+        epochs.append((out[lock], np.flatnonzero(valid[lock])))
+    return epochs
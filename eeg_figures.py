@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+ERP figures of every participant and electrode, without a display.
+
+EEG_process_Eriksen.py and EEG_process_GoNoGO.py draw a two panel figure
+(both conditions, then the difference wave) for one participant and one
+electrode and stop at plt.show(). This draws the same figure for every
+electrode of every processed participant with the Agg backend, from the
+pipeline output (the .mat files or the epoch store), so nothing is
+pre-processed again:
+
+    python eeg_figures.py eriksen --jobs 4
+    python eeg_figures.py gonogo --electrodes Fz Cz Pz --output store
+
+Participants are spread over worker processes, each reading its
+participant's epochs once. A participant is skipped when all of their
+figures exist and their epochs have not been written since they were drawn.
+
+@author: James Bartlett
+"""
+
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import scipy.io as sio
+import matplotlib
+matplotlib.use("Agg")  # no display, and no window to close
+import matplotlib.pyplot as plt
+
+import eeg_pipeline
+import eeg_store
+from eeg_batch import participant_files
+from eeg_epochs import epoch_rate
+from eeg_grand_average import source_signature
+
+# the two lines of the top panel (label, event codes) - the difference wave is second - first
+FIGURES = {
+    "eriksen": {"folder": "ERP-plots/Eriksen", "prefix": "Eriksen",
+                "title": "Eriksen Flanker task Participant ",
+                "lines": [("Correct", [1]), ("Incorrect", [2])]},
+    "gonogo": {"folder": "ERP-plots/Go-NoGo", "prefix": "GoNoGo",
+               "title": "Go/NoGo task Participant ",
+               "lines": [("Go", [1]), ("NoGo", [2])]},
+    "smokingnogo": {"folder": "ERP-plots/Smoking-NoGo", "prefix": "SmokingNoGo",
+                    "title": "Smoking Go/NoGo task Participant ",
+                    "lines": [("Go", [1, 2]), ("NoGo", [3, 4])]},
+}
+
+DPI = 300
+
+
+def condition_averages(task, name, output="mat"):
+    """Average (channels, samples) epochs and trial count of every event code with trials.
+
+    Returns a dictionary code: (average, n_trials), the channel names and the
+    epoch times.
+    """
+    config = eeg_pipeline.TASKS[task]
+    tmin, tmax = eeg_pipeline.SETTINGS["tmin"], eeg_pipeline.SETTINGS["tmax"]
+    averages = {}
+    if output == "store":
+        data, meta = eeg_store.read_epochs(config["store"], participants=[name])
+        data, codes, retained = data[0], meta["codes"][0], meta["retained"][0]
+        for code in np.unique(codes[retained]):
+            trials = data[retained & (codes == code)]
+            averages[int(code)] = (trials.mean(axis=0), len(trials))
+        return averages, meta["channels"], meta["times"]
+
+    paths = eeg_pipeline.output_paths(task, name)
+    if None not in paths:
+        # one file per condition holding only its retained trials
+        codes = dict((cond, code) for cond, code, criteria in config["conditions"])
+        for cond, path in paths.items():
+            mat = sio.loadmat(path)
+            ch_names = [k for k in mat if not k.startswith("__")]
+            data = np.concatenate([mat[ch] for ch in ch_names], axis=0)
+            if data.shape[1]:  # a condition with no trials left has no average
+                averages[codes[cond]] = (data.mean(axis=1), data.shape[1])
+        times = eeg_pipeline.epoch_times(tmin, tmax, epoch_rate(tmin, tmax, data.shape[2]))
+        return averages, ch_names, times
+
+    mat = sio.loadmat(paths[None])
+    ch_names = [k for k in mat if not k.startswith("__")]
+    data = np.concatenate([mat[ch] for ch in ch_names], axis=0)
+    # the .mat files keep no codes - label the trials from the OpenSesame file again
+    rtdata = pd.read_csv(os.path.join(config["behavioural"], name + ".csv"), sep=',')
+    codes = eeg_pipeline.trial_codes(task, rtdata)[config["epoch_trials"]]
+    retained = ~np.isnan(data[0, :, 0])
+    times = eeg_pipeline.epoch_times(tmin, tmax, epoch_rate(tmin, tmax, data.shape[2]))
+    for code in np.unique(codes[retained]):
+        trials = data[:, retained & (codes == code)]
+        averages[int(code)] = (trials.mean(axis=1), trials.shape[1])
+    return averages, ch_names, times
+
+
+def figure_path(task, name, electrode):
+    figures = FIGURES[task]
+    return os.path.join(figures["folder"], figures["prefix"] + "-" + name.split("-")[0] +
+                        "-" + electrode + ".png")
+
+
+def draw(task, name, electrode, lines, times, dpi=DPI):
+    """Draw and save the two panel figure of one electrode.
+
+    lines is a list of (label, (channels-averaged) waveform in V, n_trials)
+    for the two conditions.
+    """
+    x = times * 1e3
+    windows = eeg_pipeline.TASKS[task]["roi_windows"]
+    fig, ax = plt.subplots(2, figsize=(7, 10))
+
+    # top panel - both conditions
+    for label, wave, n in lines:
+        ax[0].plot(x, wave * 1e6, '-', linewidth=2, label=label + ' (' + str(n) + ')')
+    ypos = ax[0].get_ylim()[1] - (ax[0].get_ylim()[1] - ax[0].get_ylim()[0]) * 0.1
+    for component, (start, end, polarity) in windows.items():
+        ax[0].text(start * 1e3 + 5, ypos, component, fontsize=15)
+    ax[0].legend(loc='lower right')
+    ax[0].set_title(FIGURES[task]["title"] + name.split("-")[0] + " " + electrode)
+
+    # bottom panel - the difference wave
+    ax[1].plot(x, (lines[1][1] - lines[0][1]) * 1e6, linewidth=2, label='Difference')
+    ax[1].legend(loc='lower right')
+
+    for panel in ax:
+        for start, end, polarity in windows.values():
+            panel.axvspan(start * 1e3, end * 1e3, color='red', alpha=0.5)  # ROI
+        panel.axhline(y=0, color='black', linestyle='dashed')
+        panel.axvline(x=0, color='black', linestyle='dashed')
+        panel.grid(False)
+
+    path = figure_path(task, name, electrode)
+    fig.savefig(path, dpi=dpi)
+    plt.close(fig)
+    return path
+
+
+def record_path(task, name):
+    """File remembering which epochs a participant's figures were drawn from."""
+    return os.path.join(FIGURES[task]["folder"], "." + name + ".json")
+
+
+def is_current(task, name, electrodes, signature, dpi=DPI):
+    """True if the figures exist and were drawn from the current epochs."""
+    path = record_path(task, name)
+    if not os.path.isfile(path):
+        return False
+    with open(path) as f:
+        record = json.load(f)
+    if record.get("signature") != signature or record.get("dpi") != dpi:
+        return False
+    return all(os.path.isfile(figure_path(task, name, ch)) for ch in electrodes or record["electrodes"])
+
+
+def render_participant(task, name, electrodes=None, output="mat", dpi=DPI, force=False):
+    """Draw the figures of one participant; returns the number drawn (0 if up to date)."""
+    signature = source_signature(task, name, output)
+    if not force and is_current(task, name, electrodes, signature, dpi):
+        return 0
+    averages, ch_names, times = condition_averages(task, name, output)
+    electrodes = electrodes or list(ch_names)
+    n_channels = len(ch_names)
+    lines = []
+    for label, codes in FIGURES[task]["lines"]:
+        # pool the conditions of a line, weighting each by its trials
+        found = [averages[c] for c in codes if c in averages and averages[c][1]]
+        n = sum(count for average, count in found)
+        total = sum(average * count for average, count in found) if n else \
+            np.full((n_channels, len(times)), np.nan)
+        lines.append((label, total / max(n, 1), n))
+    if not os.path.isdir(FIGURES[task]["folder"]):
+        os.makedirs(FIGURES[task]["folder"], exist_ok=True)
+    for electrode in electrodes:
+        ch = list(ch_names).index(electrode)
+        draw(task, name, electrode, [(label, wave[ch], n) for label, wave, n in lines],
+             np.asarray(times), dpi)
+    with open(record_path(task, name), "w") as f:
+        json.dump({"signature": signature, "dpi": dpi, "electrodes": electrodes}, f)
+    return len(electrodes)
+
+
+def render_all(task, names, electrodes=None, output="mat", dpi=DPI, force=False, jobs=1):
+    """Draw the figures of every participant in names, jobs at a time."""
+    args = [(task, name, electrodes, output, dpi, force) for name in names]
+    if jobs == 1:
+        counts = [render_participant(*a) for a in args]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            counts = list(pool.map(render_participant, *zip(*args)))
+    return dict(zip(names, counts))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Draw the ERP figures of every participant.")
+    parser.add_argument("task", choices=sorted(FIGURES))
+    parser.add_argument("--electrodes", nargs="+", help="default every electrode")
+    parser.add_argument("--output", choices=["mat", "store"], default="mat",
+                        help="read the .mat files or the task's epoch store")
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--dpi", type=int, default=DPI)
+    parser.add_argument("--force", action="store_true", help="redraw figures that are up to date")
+    args = parser.parse_args(argv)
+    names = [eeg_pipeline.participant_name(f) for f in participant_files(args.task)]
+    names = [n for n in names if eeg_pipeline.is_processed(args.task, n, args.output)]
+    counts = render_all(args.task, names, args.electrodes, args.output, args.dpi,
+                        args.force, args.jobs)
+    drawn = [n for n, c in counts.items() if c]
+    print("Drew " + str(sum(counts.values())) + " figures of " + str(len(drawn)) +
+          " participants, " + str(len(names) - len(drawn)) + " up to date")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Single precision versions of the pipeline steps MNE only runs in float64.
+
+With --float32 the continuous data is held as float32 from the .bdf
+decoder to the .mat files or epoch store, which halves the memory of every
+stage and the size of the output. Amplitudes are a few hundred microvolts
+at most, so float32 (about 7 significant digits) keeps them to well below
+a nanovolt. MNE converts data to float64 whenever it builds a Raw or
+filters it, so in this mode:
+
+- band_pass() applies MNE's own FIR filter (the same design as
+  raw.filter) channel by channel with an FFT convolution in float32
+- resample() down-samples with a polyphase anti-aliasing filter in the
+  precision of the data and builds a new Raw around the result (float64
+  data is resampled the same way, so the two paths stay comparable)
+- apply_ica() applies the ICA cleaning as one (channels x channels) matrix,
+  worked out once from the fitted ICA, a block of samples at a time
+
+The rest of the pipeline (re-referencing, epoching, baseline correction,
+rejection and writing) already keeps the dtype of the data it is given.
+The ICA is still fitted by MNE, which works in float64 internally.
+
+    python eeg_float32.py check eriksen Raw_data/Behavioural/Eriksen/1001-eriksen.csv
+
+runs one participant through both paths, with the same fitted ICA and
+excluded components, and reports how far the float32 epochs and ROI amplitudes are from the
+float64 ones.
+
+@author: James Bartlett
+"""
+
+import argparse
+from fractions import Fraction
+import numpy as np
+import scipy.signal
+import mne
+
+from bdf_reader import raw_array
+# eeg_pipeline imports this module as well - only used inside compare()
+import eeg_pipeline
+from eeg_eog import find_eog_components
+from eeg_roi import roi_table
+
+DTYPE = np.float32
+
+# samples cleaned at a time by apply_ica() - about 4 MB of float32 for 33 channels
+ICA_BLOCK = 32768
+
+# the float32 epochs count as equivalent to the float64 ones if the largest
+# difference is below this fraction of the root mean square of the epochs
+TOLERANCE = 1e-4
+
+
+def as_float32(raw):
+    """Convert the data of a Raw to float32 in place."""
+    if raw._data.dtype != DTYPE:
+        raw._data = raw._data.astype(DTYPE)
+    return raw
+
+
+def filter_picks(raw):
+    """Channels raw.filter() filters by default - everything but the stim channel."""
+    return mne.pick_types(raw.info, meg=False, eeg=True, eog=True, exclude=[])
+
+
+def band_pass(raw, l_freq, h_freq):
+    """Zero-phase FIR band-pass filter of the float32 data (modifies raw in place).
+
+    The filter is the one raw.filter(l_freq, h_freq) designs, and the edges
+    are padded with the odd reflection of the signal as raw.filter does.
+    """
+    h = mne.filter.create_filter(None, raw.info['sfreq'], l_freq, h_freq).astype(DTYPE)
+    half = (len(h) - 1) // 2
+    for ch in filter_picks(raw):
+        padded = np.pad(raw._data[ch], half, mode="reflect", reflect_type="odd")
+        raw._data[ch] = scipy.signal.oaconvolve(padded, h, mode="valid")
+    return raw
+
+
+def resample(raw, sfreq):
+    """Anti-aliased polyphase resampling to sfreq Hz, keeping the dtype of the data.
+
+    Returns a new Raw with the same channels and first_samp scaled as
+    raw.resample() scales it, but no projections or montage (see
+    eeg_pipeline.resample()).
+    """
+    ratio = Fraction(sfreq / raw.info['sfreq']).limit_denominator(1000)
+    up, down = ratio.numerator, ratio.denominator
+    dtype = raw._data.dtype
+    # scipy's default kaiser window, made here so the filter (and so the result) keeps dtype
+    half_len = 10 * max(up, down)
+    h = scipy.signal.firwin(2 * half_len + 1, 1.0 / max(up, down),
+                            window=("kaiser", 5.0)).astype(dtype)
+    stim = mne.pick_types(raw.info, meg=False, stim=True, exclude=[])
+    n_new = -(-raw._data.shape[1] * up // down)
+    data = np.empty((len(raw.ch_names), n_new), dtype=dtype)
+    for ch in range(len(raw.ch_names)):
+        if ch in stim:
+            # trigger codes are picked, not filtered
+            data[ch] = raw._data[ch, np.arange(n_new) * down // up]
+        else:
+            data[ch] = scipy.signal.resample_poly(raw._data[ch], up, down, window=h)
+    ch_types = [mne.channel_type(raw.info, i) for i in range(len(raw.ch_names))]
+    info = mne.create_info(raw.ch_names, sfreq, ch_types)
+    return raw_array(data, info, first_samp=int(np.round(raw.first_samp * float(ratio))))
+
+
+def ica_operator(ica, info, eog_inds, dtype=DTYPE):
+    """Matrix and offset that apply the ICA cleaning to the ICA's channels.
+
+    ICA.apply() is linear in the data apart from the PCA mean, so applying
+    it to a zero sample and to one sample per channel gives the whole
+    transform: cleaned = matrix @ data + offset. Also returns the indices
+    of the ICA's channels in info.
+    """
+    picks = mne.pick_channels(info['ch_names'], ica.ch_names)
+    probe = np.zeros((len(info['ch_names']), len(picks) + 1))
+    probe[picks, np.arange(1, len(picks) + 1)] = 1.0
+    probe_raw = mne.io.RawArray(probe, info)
+    ica = ica.copy()
+    ica.exclude = list(eog_inds)
+    ica.apply(probe_raw)
+    cleaned = probe_raw._data[picks]
+    offset = cleaned[:, 0]
+    return picks, (cleaned[:, 1:] - offset[:, None]).astype(dtype), offset.astype(dtype)
+
+
+def apply_ica(raw, ica, eog_inds):
+    """Remove the chosen ICA components from the float32 data (modifies raw in place)."""
+    picks, matrix, offset = ica_operator(ica, raw.info, eog_inds)
+    data = raw._data
+    for start in range(0, data.shape[1], ICA_BLOCK):
+        stop = min(start + ICA_BLOCK, data.shape[1])
+        block = np.matmul(matrix, data[picks, start:stop])
+        block += offset[:, None]
+        data[picks, start:stop] = block
+    return raw
+
+
+def compare(task, filepath, eog_inds=None, lazy_load=True, sfreq=None):
+    """Run one participant through the float64 and float32 paths and compare the epochs.
+
+    eog_inds defaults to the participant's components in the exclusion
+    ledger, else they are chosen automatically. Both paths use the ICA
+    fitted in the float64 path and the same components, so the difference
+    is down to the precision alone. Returns a dictionary with the largest
+    difference, the root mean square of the float64 epochs (both in V), the
+    largest difference of the ROI mean amplitudes (uV), whether the same
+    trials were rejected and whether the difference is within TOLERANCE.
+    """
+    name = eeg_pipeline.participant_name(filepath)
+    if eog_inds is None:
+        eog_inds = eeg_pipeline.read_exclusions(task, name)
+    results = {}
+    ica = None
+    for float32 in (False, True):
+        options = eeg_pipeline.Options(lazy_load=lazy_load, sfreq=sfreq, float32=float32)
+        graph = eeg_pipeline.participant_stages(task, filepath, options)
+        if ica is None:
+            ica = graph.get("ica_fit")
+        else:
+            # no path, so the participant's saved ICA is left alone
+            graph.add("ica_fit", "ica", lambda: ica)
+        if eog_inds is None:
+            eog_inds = find_eog_components(graph.get("ica_fit"), graph.get("filter"),
+                                           decim=eeg_pipeline.SETTINGS["decim"])
+        eeg_pipeline.add_clean_stages(task, graph, eog_inds, options)
+        results[float32] = graph.get("epochs")[eeg_pipeline.task_lock(task)]
+
+    double, single = results[False], results[True]
+    if single["data"].dtype != DTYPE:
+        raise TypeError("The float32 path returned " + str(single["data"].dtype) + " epochs")
+    both = np.intersect1d(double["selection"], single["selection"])
+    diff = np.abs(single["data"][:, both].astype(np.float64) - double["data"][:, both])
+    rms = np.sqrt(np.mean(double["data"][:, both] ** 2))
+    config = eeg_pipeline.TASKS[task]
+    rois = [roi_table(e, config["roi_windows"], name.split("-")[0], config["conditions"])
+            for e in (double, single)]
+    roi = rois[0].merge(rois[1], on=["Trial_N", "electrode", "component"])
+    return {"participant": name, "components": list(eog_inds),
+            "max_diff": float(diff.max()), "rms": float(rms),
+            "relative": float(diff.max() / rms),
+            "roi_max_diff": float(np.abs(roi["mean_amp_x"] - roi["mean_amp_y"]).max()),
+            "same_trials": bool(np.array_equal(double["selection"], single["selection"])),
+            "equivalent": bool(diff.max() / rms < TOLERANCE)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the float32 and float64 pipelines.")
+    sub = parser.add_subparsers(dest="command")
+    check = sub.add_parser("check", help="process one participant both ways and compare")
+    check.add_argument("task")
+    check.add_argument("filepath", help="the participant's OpenSesame .csv file")
+    check.add_argument("--components", type=int, nargs="*",
+                       help="ICA components to exclude (default from the ledger)")
+    check.add_argument("--full-load", action="store_true",
+                       help="read the .bdf with MNE instead of the lazy reader")
+    check.add_argument("--sfreq", type=float, help="down-sample as eeg_batch.py --sfreq")
+    args = parser.parse_args(argv)
+    if args.command != "check":
+        parser.print_help()
+        return
+    result = compare(args.task, args.filepath, args.components, not args.full_load, args.sfreq)
+    for key in ("participant", "components", "max_diff", "rms", "relative",
+                "roi_max_diff", "same_trials", "equivalent"):
+        print("{:<14} {}".format(key, result[key]))
+    if not result["equivalent"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
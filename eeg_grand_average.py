@@ -0,0 +1,424 @@
+# -*- coding: utf-8 -*-
+"""
+Grand average ERPs of a task, one participant at a time.
+
+Grand-average-eriksen.R and Grand-average-gonogo.R write an ERP .csv per
+participant for one electrode and then read all of them back to average.
+Here each participant's epochs are read from the pipeline output (the .mat
+file or the epoch store), averaged over the trials of every condition and
+added to running (Welford) sums, so only one participant is ever in memory
+and every electrode is averaged at once. For every condition, electrode and
+sample the result holds
+
+    amplitude     grand average of the participant ERPs (uV)
+    sd            standard deviation of the participant ERPs
+    se            standard error of the grand average
+    participants  number of participants with at least one trial
+    trials        number of trials averaged, summed over participants
+
+The running sums are kept in Average_data/<task>_grand_average/ along with
+the ERPs of every participant, so a rerun only reads the participants that
+are new or were processed again, and a participant is taken out of the
+average by subtracting their ERPs. Participants with fewer than MIN_TRIALS
+trials in any condition are left out automatically.
+
+    python eeg_grand_average.py eriksen --output store
+    python eeg_grand_average.py eriksen --exclude 1014-eriksen
+
+@author: James Bartlett
+"""
+
+import argparse
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import scipy.io as sio
+
+import eeg_pipeline
+import eeg_store
+from eeg_batch import participant_files
+from eeg_epochs import epoch_rate
+
+# trials averaged into each condition's ERP, as a query on the OpenSesame file
+# (the same trials as eriksen_erp() and gonogo_erp() in EEG_functions.R)
+CONDITIONS = {
+    "eriksen": [("correct", "correct == 1 and Block != 'Practice'"),
+                ("incorrect", "correct == 0 and Block != 'Practice'")],
+    "gonogo": [("Go", "correct == 1 and Stim_type == 'Go' and Block != 'Practice'"),
+               ("NoGo", "correct == 1 and Stim_type == 'NoGo' and Block != 'Practice'")],
+    "smokingnogo": [("Go/smoking", "Stimulus == 'Go' and Cue_type == 'smoking'"),
+                    ("Go/neutral", "Stimulus == 'Go' and Cue_type == 'neutral'"),
+                    ("NoGo/smoking", "Stimulus == 'NoGo' and Cue_type == 'smoking'"),
+                    ("NoGo/neutral", "Stimulus == 'NoGo' and Cue_type == 'neutral'")],
+}
+
+# where the grand average of each task is written, and its running sums kept
+OUTPUT = "Average_data/{task}_grand_average.csv"
+STATE = "Average_data/{task}_grand_average"
+
+# participants need at least this many trials in every condition (> 7 as in
+# the R scripts)
+MIN_TRIALS = 8
+
+
+class RunningAverage(object):
+    """Welford running mean and variance of equally shaped arrays.
+
+    NaN entries (e.g. an electrode or condition without any trials) are
+    left out of the count of that entry only.
+    """
+
+    def __init__(self, shape):
+        self.n = np.zeros(shape, dtype=np.int64)
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+
+    def add(self, x):
+        seen = ~np.isnan(x)
+        self.n += seen
+        delta = np.where(seen, x - self.mean, 0.0)
+        self.mean += np.where(seen, delta / np.maximum(self.n, 1), 0.0)
+        self.m2 += np.where(seen, delta * (x - self.mean), 0.0)
+
+    def remove(self, x):
+        """Undo add(x) - Welford's update run backwards."""
+        seen = ~np.isnan(x)
+        self.n -= seen
+        delta = np.where(seen, x - self.mean, 0.0)
+        self.mean -= np.where(seen, delta / np.maximum(self.n, 1), 0.0)
+        self.m2 -= np.where(seen, delta * (x - self.mean), 0.0)
+        # back to exactly zero once nobody is left
+        empty = self.n == 0
+        self.mean[empty] = 0.0
+        self.m2[empty] = 0.0
+
+    def variance(self):
+        """Sample variance (NaN where fewer than two arrays were seen)."""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.n > 1, self.m2 / (self.n - 1), np.nan)
+
+
+def read_participant(task, name, output="mat"):
+    """(channels, trials, samples) epochs, channel names and times of a participant.
+
+    The trials are the epoched trials of the task (TASKS[task]["epoch_trials"]
+    of the OpenSesame file), rejected ones NaN.
+    """
+    if output == "store":
+        data, meta = eeg_store.read_epochs(eeg_pipeline.TASKS[task]["store"], participants=[name])
+        return np.moveaxis(data[0], 1, 0), meta["channels"], meta["times"]
+    paths = eeg_pipeline.output_paths(task, name)
+    if None not in paths:
+        raise ValueError("The .mat files of " + task + " only hold the retained trials of "
+                         "each condition - average the epoch store (--output store) instead")
+    mat = sio.loadmat(paths[None])
+    ch_names = [k for k in mat if not k.startswith("__")]
+    data = np.concatenate([mat[ch] for ch in ch_names], axis=0)
+    # the rate is whatever the epochs were saved at (see eeg_batch.py --sfreq)
+    tmin, tmax = eeg_pipeline.SETTINGS["tmin"], eeg_pipeline.SETTINGS["tmax"]
+    times = eeg_pipeline.epoch_times(tmin, tmax, epoch_rate(tmin, tmax, data.shape[2]))
+    return data, ch_names, times
+
+
+def participant_erps(task, filepath, output="mat"):
+    """ERP (uV) and trial count of every condition for one participant.
+
+    Returns a (conditions, channels, samples) array of ERPs, the matching
+    array of the number of trials averaged, the channel names and times.
+    """
+    name = eeg_pipeline.participant_name(filepath)
+    data, ch_names, times = read_participant(task, name, output)
+    rtdata = pd.read_csv(filepath, sep=',').iloc[eeg_pipeline.TASKS[task]["epoch_trials"]]
+    rtdata = rtdata.reset_index(drop=True)
+    erps = np.full((len(CONDITIONS[task]),) + (data.shape[0], data.shape[2]), np.nan)
+    counts = np.zeros(erps.shape, dtype=np.int64)
+    for i, (cond, query) in enumerate(CONDITIONS[task]):
+        trials = data[:, rtdata.query(query).index.values]
+        counts[i] = (~np.isnan(trials)).sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            erps[i] = np.nansum(trials, axis=1) / counts[i] * 1e6
+    return erps, counts, ch_names, times
+
+
+def source_signature(task, name, output="mat"):
+    """Changes whenever a participant's pipeline output is written again."""
+    if output == "store":
+        return "store:" + repr(eeg_store.written(eeg_pipeline.TASKS[task]["store"], name))
+    stats = [os.stat(path) for path in eeg_pipeline.output_paths(task, name).values()]
+    return "mat:" + repr([(st.st_size, st.st_mtime) for st in stats])
+
+
+class GrandAverage(object):
+    """Grand average kept on disk with the contribution of every participant.
+
+    directory holds average.npz (the running sums and trial counts of the
+    included participants) and participants/<name>.npz (each participant's
+    ERPs and trial counts, their channels and times, the signature of the
+    output they were read from and why they are excluded, if they are). If
+    average.npz is missing or older than a contribution (a run stopped
+    before save()) it is summed again from the contributions. Adding, replacing or excluding
+    a participant only touches that participant's arrays.
+    """
+
+    def __init__(self, directory, conditions):
+        self.directory = directory
+        self.conditions = list(conditions)
+        self.running = None
+        self.trials = None
+        self.ch_names = None
+        self.times = None
+        path = os.path.join(directory, "average.npz")
+        names = self.participants()
+        newest = max([os.path.getmtime(self.contribution_path(name)) for name in names] or [0.0])
+        if names and (not os.path.isfile(path) or os.path.getmtime(path) < newest):
+            # a run stopped before save(): sum the saved contributions again
+            self._rebuild()
+        elif os.path.isfile(path):
+            with np.load(path) as f:
+                if list(f["conditions"]) != self.conditions:
+                    raise ValueError(directory + " was made with other conditions - "
+                                     "rebuild it")
+                self.running = RunningAverage(f["n"].shape)
+                self.running.n, self.running.mean, self.running.m2 = f["n"], f["mean"], f["m2"]
+                self.trials = f["trials"]
+                self.ch_names = list(f["ch_names"])
+                self.times = f["times"]
+
+    def _rebuild(self):
+        for name in self.participants():
+            contribution = self.contribution(name)
+            if self.running is None:
+                self.running = RunningAverage(contribution["erps"].shape)
+                self.trials = np.zeros(contribution["erps"].shape, dtype=np.int64)
+            elif contribution["erps"].shape != self.running.n.shape:
+                raise ValueError(self.directory + " was made with other conditions - "
+                                 "rebuild it")
+            if self.ch_names is None and "ch_names" in contribution:
+                self.ch_names = contribution["ch_names"]
+                self.times = contribution["times"]
+            self._apply(contribution, 1)
+        if self.ch_names is None:
+            # contributions saved before they kept the channels and times
+            path = os.path.join(self.directory, "average.npz")
+            if not os.path.isfile(path):
+                raise ValueError(self.directory + " has no channels or times saved - "
+                                 "rebuild it")
+            with np.load(path) as f:
+                self.ch_names = list(f["ch_names"])
+                self.times = f["times"]
+
+    def contribution_path(self, name):
+        return os.path.join(self.directory, "participants", name + ".npz")
+
+    def contribution(self, name):
+        """Saved ERPs, counts, signature and exclusion reason of a participant, or None."""
+        path = self.contribution_path(name)
+        if not os.path.isfile(path):
+            return None
+        with np.load(path) as f:
+            contribution = {"erps": f["erps"], "counts": f["counts"],
+                            "signature": str(f["signature"]), "excluded": str(f["excluded"])}
+            if "ch_names" in f:
+                contribution["ch_names"] = list(f["ch_names"])
+                contribution["times"] = f["times"]
+        return contribution
+
+    def participants(self):
+        """Names of every participant with a saved contribution."""
+        folder = os.path.join(self.directory, "participants")
+        if not os.path.isdir(folder):
+            return []
+        return sorted(f[:-4] for f in os.listdir(folder) if f.endswith(".npz"))
+
+    def _save_contribution(self, name, contribution):
+        path = self.contribution_path(name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        np.savez(path + ".tmp.npz", **contribution)
+        os.replace(path + ".tmp.npz", path)
+
+    def _apply(self, contribution, sign):
+        if contribution["excluded"]:
+            return
+        if sign > 0:
+            self.running.add(contribution["erps"])
+            self.trials += contribution["counts"]
+        else:
+            self.running.remove(contribution["erps"])
+            self.trials -= contribution["counts"]
+
+    def add(self, name, erps, counts, ch_names, times, signature=""):
+        """Add a participant, replacing their old contribution if there is one.
+
+        A manual exclusion is kept; otherwise the participant is excluded
+        if any condition has fewer than MIN_TRIALS trials.
+        """
+        if self.running is None:
+            self.running = RunningAverage(erps.shape)
+            self.trials = np.zeros(erps.shape, dtype=np.int64)
+            self.ch_names = list(ch_names)
+            self.times = np.asarray(times)
+        elif list(ch_names) != self.ch_names or erps.shape != self.running.n.shape:
+            raise ValueError(name + " has other channels or samples than the grand average")
+        old = self.contribution(name)
+        if old is not None:
+            self._apply(old, -1)
+        excluded = ""
+        if old is not None and old["excluded"] == "manual":
+            excluded = "manual"
+        elif counts.reshape(len(counts), -1).max(axis=1).min() < MIN_TRIALS:
+            excluded = "trials"
+        new = {"erps": erps, "counts": counts, "signature": signature, "excluded": excluded,
+               "ch_names": list(ch_names), "times": np.asarray(times)}
+        self._apply(new, 1)
+        self._save_contribution(name, new)
+        return excluded
+
+    def exclude(self, name, reason="manual"):
+        """Take a participant out of the average, keeping their ERPs."""
+        contribution = self.contribution(name)
+        if contribution is None:
+            raise KeyError(name + " is not in the grand average")
+        self._apply(contribution, -1)
+        contribution["excluded"] = reason
+        self._save_contribution(name, contribution)
+
+    def include(self, name):
+        """Undo exclude() - the trial count rule still applies."""
+        contribution = self.contribution(name)
+        if contribution is None:
+            raise KeyError(name + " is not in the grand average")
+        if contribution["excluded"] == "manual":
+            contribution["excluded"] = ""
+            counts = contribution["counts"]
+            if counts.reshape(len(counts), -1).max(axis=1).min() < MIN_TRIALS:
+                contribution["excluded"] = "trials"
+            self._apply(contribution, 1)
+            self._save_contribution(name, contribution)
+
+    def remove(self, name):
+        """Forget a participant altogether (e.g. whose output was deleted)."""
+        contribution = self.contribution(name)
+        if contribution is not None:
+            self._apply(contribution, -1)
+            os.remove(self.contribution_path(name))
+
+    def save(self):
+        """Write the running sums - call after a batch of changes."""
+        if self.running is None:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = os.path.join(self.directory, "average.npz")
+        np.savez(path + ".tmp.npz", n=self.running.n, mean=self.running.mean,
+                 m2=self.running.m2, trials=self.trials, conditions=self.conditions,
+                 ch_names=self.ch_names, times=self.times)
+        os.replace(path + ".tmp.npz", path)
+        with open(os.path.join(self.directory, "participants.json"), "w") as f:
+            json.dump(dict((name, self.contribution(name)["excluded"] or "included")
+                           for name in self.participants()), f, indent=2, sort_keys=True)
+
+    def result(self):
+        """The grand average as a dictionary.
+
+        "mean", "sd", "se", "participants" and "trials" are (conditions,
+        channels, samples) arrays, along with "conditions", "ch_names" and
+        "times".
+        """
+        sd = np.sqrt(self.running.variance())
+        with np.errstate(invalid="ignore", divide="ignore"):
+            se = sd / np.sqrt(self.running.n)
+        return {"mean": self.running.mean, "sd": sd, "se": se,
+                "participants": self.running.n, "trials": self.trials,
+                "conditions": self.conditions, "ch_names": self.ch_names, "times": self.times}
+
+
+def update_average(task, filelist, output="mat", directory=None):
+    """Bring the saved grand average of a task up to date with filelist.
+
+    Only participants that are new or whose output changed since they were
+    added are read; participants no longer in filelist are taken out.
+    Returns the GrandAverage.
+    """
+    average = GrandAverage(directory or STATE.format(task=task),
+                           [cond for cond, query in CONDITIONS[task]])
+    names = dict((eeg_pipeline.participant_name(f), f) for f in filelist)
+    for name in average.participants():
+        if name not in names:
+            average.remove(name)
+            print("participant " + name + " removed.")
+    for name, filepath in sorted(names.items()):
+        signature = source_signature(task, name, output)
+        old = average.contribution(name)
+        if old is not None and old["signature"] == signature:
+            continue
+        erps, counts, ch_names, times = participant_erps(task, filepath, output)
+        excluded = average.add(name, erps, counts, ch_names, times, signature)
+        print("participant " + name + (" added." if old is None else " replaced.") +
+              (" Excluded: fewer than " + str(MIN_TRIALS) + " trials in a condition."
+               if excluded == "trials" else ""))
+    average.save()
+    return average
+
+
+def average_table(average):
+    """Long table of a grand average: condition, electrode, time (ms), mean, sd, se, counts."""
+    n_cond, n_channels, n_samples = average["mean"].shape
+    return pd.DataFrame({
+        "condition": np.repeat(average["conditions"], n_channels * n_samples),
+        "electrode": np.tile(np.repeat(average["ch_names"], n_samples), n_cond),
+        "time": np.tile(average["times"] * 1e3, n_cond * n_channels),
+        "amplitude": average["mean"].reshape(-1),
+        "sd": average["sd"].reshape(-1),
+        "se": average["se"].reshape(-1),
+        "participants": average["participants"].reshape(-1),
+        "trials": average["trials"].reshape(-1),
+    })
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Grand average ERPs of every electrode.")
+    parser.add_argument("task", choices=sorted(CONDITIONS))
+    parser.add_argument("--output", choices=["mat", "store"], default="mat",
+                        help="read the .mat files or the task's epoch store")
+    parser.add_argument("--group", choices=["1", "2"],
+                        help="only participants whose number starts with this digit "
+                             "(1 non-smokers, 2 smokers)")
+    parser.add_argument("--out", help="where to write the table (default " + OUTPUT + ")")
+    parser.add_argument("--state", help="folder of the saved running sums (default " + STATE +
+                        ", with the group appended)")
+    parser.add_argument("--exclude", nargs="+", default=[], metavar="NAME",
+                        help="take these participants out of the grand average")
+    parser.add_argument("--include", nargs="+", default=[], metavar="NAME",
+                        help="put excluded participants back in")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="forget the saved running sums and read every participant again")
+    args = parser.parse_args(argv)
+    filelist = [f for f in participant_files(args.task)
+                if eeg_pipeline.is_processed(args.task, eeg_pipeline.participant_name(f),
+                                             args.output)]
+    if args.group:
+        filelist = [f for f in filelist
+                    if eeg_pipeline.participant_name(f).startswith(args.group)]
+    state = args.state or STATE.format(task=args.task) + ("_" + args.group if args.group else "")
+    if args.rebuild:
+        shutil.rmtree(state, ignore_errors=True)
+    average = update_average(args.task, filelist, args.output, state)
+    for name in args.exclude:
+        average.exclude(name)
+    for name in args.include:
+        average.include(name)
+    average.save()
+    path = args.out or OUTPUT.format(task=args.task + ("_" + args.group if args.group else ""))
+    if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    result = average.result()
+    average_table(result).to_csv(path, index=False)
+    print("Grand average of " + str(int(result["participants"].max())) +
+          " participants written to " + path)
+
+
+if __name__ == "__main__":
+    main()
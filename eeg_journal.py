@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Checkpoint journal of the stages of every participant, to resume batches.
+
+A batch that dies part way through a participant (at the component
+prompt, out of memory, a bad value typed in) used to lose everything done
+for them: the only sign of progress was whether the final .mat file
+existed. With a journal directory every stage output is checkpointed as
+soon as it is computed (see eeg_cache.StageGraph), and its completion is
+logged in an SQLite database in the same directory:
+
+- stages - one row per (task, participant, stage) completed, with the key
+  of the stage (see eeg_cache.stage_key()), where its output is kept and
+  when it finished
+
+When the participant is run again, each stage is looked up in the journal
+before it is computed, so processing picks up after the last stage that
+finished: after the filter the recording is not read again, after the
+epochs only the files are written. A checkpoint is only used while its key
+still matches, so changed settings or components are recomputed as usual.
+The fitted ICA is kept in the ICA folder anyway and is logged with that
+location. Loading the recording (and re-referencing it) is as quick as
+reading it back, so those are neither saved nor logged.
+
+Once a participant's files are written their checkpoints and rows are
+deleted, so the journal only holds participants that are unfinished.
+
+    python eeg_journal.py DIR [--task TASK]
+
+lists them, where DIR is the directory given to eeg_batch.py --journal.
+
+@author: James Bartlett
+"""
+
+import argparse
+import contextlib
+import datetime
+import os
+import shutil
+import sqlite3
+
+from eeg_cache import FILENAMES, save_persistent, load_persistent, is_persistent
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stages (
+    task TEXT NOT NULL,
+    participant TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    key TEXT NOT NULL,
+    path TEXT NOT NULL,
+    finished TEXT NOT NULL,
+    PRIMARY KEY (task, participant, stage)
+);
+"""
+
+# stages as quick to compute again as to read back - neither saved nor logged
+NOT_SAVED = ("load", "reference")
+
+
+class StageJournal(object):
+    """Checkpoints and a log of the completed stages of every participant.
+
+    A new connection is opened for every call, so one journal can be used
+    by worker processes at the same time.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = os.path.join(directory, "journal.sqlite")
+        with self.connect() as con:
+            con.executescript(SCHEMA)
+
+    def connect(self):
+        # wait for other writers rather than failing straight away
+        con = sqlite3.connect(self.path, timeout=60.0, isolation_level=None)
+        con.execute("PRAGMA journal_mode=WAL")
+        return contextlib.closing(con)
+
+    def participant(self, task, participant):
+        """The journal of one participant, for eeg_cache.StageGraph."""
+        return ParticipantJournal(self, task, participant)
+
+    def checkpoint_path(self, task, participant, stage, kind):
+        """Where the output of a stage is checkpointed."""
+        return os.path.join(self.directory, task, participant, stage + "-" + FILENAMES[kind])
+
+    def record(self, task, participant, stage, key, path):
+        """Log a stage as completed, with where its output is kept."""
+        now = datetime.datetime.now().isoformat(timespec="seconds")
+        with self.connect() as con:
+            con.execute("INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?, ?)",
+                        (task, participant, stage, key, path, now))
+
+    def lookup(self, task, participant, stage):
+        """Key and location of a completed stage, or None."""
+        with self.connect() as con:
+            return con.execute("SELECT key, path FROM stages "
+                               "WHERE task = ? AND participant = ? AND stage = ?",
+                               (task, participant, stage)).fetchone()
+
+    def completed(self, task, participant):
+        """(stage, location, finished) of every logged stage of a participant, in order."""
+        with self.connect() as con:
+            return con.execute("SELECT stage, path, finished FROM stages "
+                               "WHERE task = ? AND participant = ? ORDER BY finished, rowid",
+                               (task, participant)).fetchall()
+
+    def participants(self, task=None):
+        """(task, participant) of everyone with completed stages, i.e. unfinished."""
+        with self.connect() as con:
+            if task is None:
+                rows = con.execute("SELECT DISTINCT task, participant FROM stages "
+                                   "ORDER BY task, participant").fetchall()
+            else:
+                rows = con.execute("SELECT DISTINCT task, participant FROM stages WHERE task = ? "
+                                   "ORDER BY participant", (task,)).fetchall()
+        return [tuple(row) for row in rows]
+
+    def finish(self, task, participant):
+        """Delete the checkpoints and log of a participant whose files are written."""
+        shutil.rmtree(os.path.join(self.directory, task, participant), ignore_errors=True)
+        with self.connect() as con:
+            con.execute("DELETE FROM stages WHERE task = ? AND participant = ?",
+                        (task, participant))
+
+
+class ParticipantJournal(object):
+    """The part of a StageJournal that belongs to one participant."""
+
+    def __init__(self, journal, task, participant):
+        self.journal = journal
+        self.task = task
+        self.participant = participant
+
+    def has(self, stage, key):
+        """Whether the stage is checkpointed for this key."""
+        row = self.journal.lookup(self.task, self.participant, stage)
+        return row is not None and row[0] == key and is_persistent(row[1], key)
+
+    def load(self, stage, kind, key):
+        """Checkpointed output of a stage, or None if there is none for this key."""
+        row = self.journal.lookup(self.task, self.participant, stage)
+        if row is None or row[0] != key:
+            return None
+        return load_persistent(row[1], kind, key)
+
+    def save(self, stage, kind, key, value, params=None, path=None):
+        """Checkpoint a computed stage and log it.
+
+        path is where the stage output is already kept (e.g. the fitted
+        ICA), in which case it is only logged.
+        """
+        if stage in NOT_SAVED:
+            return
+        if path is None:
+            path = self.journal.checkpoint_path(self.task, self.participant, stage, kind)
+            save_persistent(value, path, kind, key, stage, params or {})
+        self.journal.record(self.task, self.participant, stage, key, path)
+
+    def completed(self):
+        return self.journal.completed(self.task, self.participant)
+
+    def finish(self):
+        self.journal.finish(self.task, self.participant)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="List the unfinished participants of a journal.")
+    parser.add_argument("journal", help="the journal directory given to eeg_batch.py --journal")
+    parser.add_argument("--task")
+    args = parser.parse_args(argv)
+    journal = StageJournal(args.journal)
+    for task, participant in journal.participants(args.task):
+        stages = journal.completed(task, participant)
+        print(task + " " + participant + ": " + ", ".join(stage for stage, path, t in stages) +
+              " (last at " + stages[-1][2] + ")")
+
+
+if __name__ == "__main__":
+    main()
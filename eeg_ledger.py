@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Ledger of the ICA components excluded for each participant.
+
+The exclusion files (Eriksen.csv, Gonogo.csv, Smokingnogo.csv) were read
+with a linear search and rewritten in full for every new participant, which
+loses rows as soon as two workers add participants at the same time. The
+ledger is an SQLite database instead:
+
+- participants - one row per (task, participant) that has been reviewed,
+  even if no component was excluded, how the choice was made and the key
+  of the ICA fit the components were chosen on (see eeg_cache.stage_key())
+- components - the excluded components of each participant in order, so a
+  participant can have any number of them
+
+Both tables are indexed by task and participant, and set() replaces a
+participant's components in a single transaction, so any number of worker
+processes can read and write the ledger at once.
+
+The old CSV layout can still be imported and exported:
+    python eeg_ledger.py import eriksen Eriksen.csv
+    python eeg_ledger.py export eriksen Eriksen.csv
+
+@author: James Bartlett
+"""
+
+import argparse
+import datetime
+import sqlite3
+import pandas as pd
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS participants (
+    task TEXT NOT NULL,
+    participant TEXT NOT NULL,
+    method TEXT,
+    updated TEXT,
+    ica_key TEXT,
+    PRIMARY KEY (task, participant)
+);
+CREATE TABLE IF NOT EXISTS components (
+    task TEXT NOT NULL,
+    participant TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    component INTEGER NOT NULL,
+    PRIMARY KEY (task, participant, position)
+);
+"""
+
+# columns of the old exclusion files
+CSV_COLUMNS = ["Exclude0", "Exclude1", "Exclude2", "Exclude3", "Exclude4", "Exclude5", "ExcludeX"]
+
+
+class ExclusionLedger(object):
+    """SQLite store of excluded ICA components by task and participant.
+
+    A new connection is opened for every call, so one ledger object can be
+    handed to worker processes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self.connect() as con:
+            con.executescript(SCHEMA)
+            columns = [row[1] for row in con.execute("PRAGMA table_info(participants)")]
+            if "ica_key" not in columns:
+                # ledgers made before the ICA key was recorded
+                con.execute("ALTER TABLE participants ADD COLUMN ica_key TEXT")
+
+    def connect(self):
+        # wait for other writers rather than failing straight away
+        con = sqlite3.connect(self.path, timeout=60.0, isolation_level=None)
+        con.execute("PRAGMA journal_mode=WAL")
+        return _Connection(con)
+
+    def get(self, task, participant):
+        """Excluded components of a participant, or None if not reviewed yet."""
+        with self.connect() as con:
+            found = con.execute("SELECT 1 FROM participants WHERE task = ? AND participant = ?",
+                                (task, participant)).fetchone()
+            if found is None:
+                return None
+            rows = con.execute("SELECT component FROM components "
+                               "WHERE task = ? AND participant = ? ORDER BY position",
+                               (task, participant)).fetchall()
+        return [row[0] for row in rows]
+
+    def ica_key(self, task, participant):
+        """Key of the ICA fit a participant's components were chosen on.
+
+        None if the participant is not reviewed yet or was added without
+        one (imported from an old exclusion file or recorded before the
+        key was kept).
+        """
+        with self.connect() as con:
+            row = con.execute("SELECT ica_key FROM participants WHERE task = ? AND participant = ?",
+                              (task, participant)).fetchone()
+        return None if row is None else row[0]
+
+    def set(self, task, participant, components, method="manual", ica_key=None):
+        """Replace a participant's excluded components in one transaction.
+
+        ica_key is the key of the ICA fit they were chosen on.
+        """
+        now = datetime.datetime.now().isoformat(timespec="seconds")
+        with self.connect() as con:
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                con.execute("INSERT OR REPLACE INTO participants "
+                            "(task, participant, method, updated, ica_key) VALUES (?, ?, ?, ?, ?)",
+                            (task, participant, method, now, ica_key))
+                con.execute("DELETE FROM components WHERE task = ? AND participant = ?",
+                            (task, participant))
+                con.executemany("INSERT INTO components VALUES (?, ?, ?, ?)",
+                                [(task, participant, i, int(c))
+                                 for i, c in enumerate(components)])
+                con.execute("COMMIT")
+            except Exception:
+                con.execute("ROLLBACK")
+                raise
+
+    def delete(self, task, participant):
+        """Forget a participant so their components are chosen again."""
+        with self.connect() as con:
+            con.execute("BEGIN IMMEDIATE")
+            con.execute("DELETE FROM participants WHERE task = ? AND participant = ?",
+                        (task, participant))
+            con.execute("DELETE FROM components WHERE task = ? AND participant = ?",
+                        (task, participant))
+            con.execute("COMMIT")
+
+    def participants(self, task):
+        """Names of the reviewed participants of a task."""
+        with self.connect() as con:
+            rows = con.execute("SELECT participant FROM participants WHERE task = ? "
+                               "ORDER BY participant", (task,)).fetchall()
+        return [row[0] for row in rows]
+
+    def import_csv(self, task, path, replace=False):
+        """Add the participants of an old exclusion file.
+
+        Participants already in the ledger are kept unless replace is True.
+        Returns the number of participants imported.
+        """
+        excludelist = pd.read_csv(path, sep=',', dtype=str)
+        columns = [c for c in excludelist.columns if c.startswith("Exclude")]
+        known = set(self.participants(task))
+        n = 0
+        for _, row in excludelist.iterrows():
+            name = row['filename']
+            if name in known and not replace:
+                continue
+            # Exclude0, Exclude1, ... are filled in order until the first blank
+            components = []
+            for column in columns:
+                if pd.isnull(row[column]) or row[column] == "":
+                    break
+                components.append(int(float(row[column])))
+            self.set(task, name, components, method="csv")
+            n += 1
+        return n
+
+    def export_csv(self, task, path):
+        """Write the ledger of a task in the layout of the old exclusion files.
+
+        The Exclude0 ... ExcludeX columns are kept and more are added if a
+        participant has more components than fit in them.
+        """
+        rows = []
+        width = len(CSV_COLUMNS)
+        for name in self.participants(task):
+            components = self.get(task, name)
+            width = max(width, len(components))
+            rows.append((name, components))
+        columns = CSV_COLUMNS + ["Exclude" + str(i) for i in range(len(CSV_COLUMNS), width)]
+        table = pd.DataFrame([[str(c) for c in comps] + [""] * (width - len(comps)) + [name]
+                              for name, comps in rows],
+                             columns=columns + ["filename"])
+        table.to_csv(path, index=False)
+
+
+class _Connection(object):
+    """sqlite3 connection that is closed (not just committed) by a with block."""
+
+    def __init__(self, con):
+        self.con = con
+
+    def __enter__(self):
+        return self.con
+
+    def __exit__(self, *args):
+        self.con.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import or export the ICA exclusion ledger.")
+    parser.add_argument("action", choices=["import", "export"])
+    parser.add_argument("task")
+    parser.add_argument("csv")
+    parser.add_argument("--ledger", default="ICA_exclusions.sqlite")
+    parser.add_argument("--replace", action="store_true",
+                        help="on import, overwrite participants already in the ledger")
+    args = parser.parse_args(argv)
+    ledger = ExclusionLedger(args.ledger)
+    if args.action == "import":
+        n = ledger.import_csv(args.task, args.csv, replace=args.replace)
+        print("Imported " + str(n) + " participants into " + args.ledger)
+    else:
+        ledger.export_csv(args.task, args.csv)
+        print("Exported " + str(len(ledger.participants(args.task))) + " participants to " + args.csv)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,753 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-processing steps shared by the three batch scripts.
+
+batch_process_eriksen.py, batch_process_gonogo.py and
+batch_process_smokingnogo.py used to each hold a full copy of the pipeline.
+The parts that differ between the tasks now live in TASKS and
+process_participant() runs one participant end to end: read the .bdf,
+filter, optionally down-sample, fit ICA, epoch and write the .mat file(s)
+or the task's epoch store (see eeg_store.py), plus a table of per-trial
+ROI amplitudes (see eeg_roi.py).
+
+@author: James Bartlett
+"""
+
+import os
+import re
+from dataclasses import dataclass
+import numpy as np
+import pandas as pd
+import scipy.io as sio
+import mne
+from mne.preprocessing import ICA
+from eeg_cache import StageGraph, file_hash
+import bdf_reader
+import eeg_align
+import eeg_chunked
+import eeg_float32
+from eeg_journal import StageJournal
+from eeg_eog import find_eog_components
+from eeg_ledger import ExclusionLedger
+from eeg_epochs import extract_locked, epoch_times
+import eeg_store
+import eeg_reject
+from eeg_roi import roi_table, ERIKSEN_WINDOWS, GONOGO_WINDOWS
+from eeg_profile import StageProfiler, measure
+
+# EEG sampling rate of the Biosemi II
+BIOSEMI_HZ = 1024.0
+
+# Settings shared by every task
+SETTINGS = {
+    "l_freq": 0.15,  # 0.15 based on Rietdijk et al.
+    "h_freq": 30.0,
+    "n_components": 33,  # has to be the same number of components as number of electrodes
+    "method": "fastica",  # for comparison with EEGLAB try "extended-infomax" here
+    "decim": 3,  # we need sufficient statistics, not all time points -> saves time
+    "random_state": 23,  # equivalent to set.seed
+    "tmin": -0.2,
+    "tmax": 0.8,
+    "baseline": (-0.2, 0),
+    "reject": dict(eeg=100e-6),  # exclude anything above 100 micro volts
+    "trigger_code": 2,  # OpenSesame marker sent at the start of every trial
+}
+
+# ICA components excluded for each participant of every task, see eeg_ledger.py
+LEDGER = "ICA_exclusions.sqlite"
+
+# how trials are rejected: above SETTINGS["reject"], or above a threshold chosen
+# for each participant or each channel of each participant (see eeg_reject.py)
+REJECT_MODES = ("fixed", "participant", "channel")
+
+
+@dataclass
+class Options(object):
+    """How the participants of a batch are processed (the eeg_batch.py flags)."""
+    cache: object = None  # eeg_cache.StageCache
+    lazy_load: bool = False  # only decode the channels and time span needed (bdf_reader.py)
+    float32: bool = False  # single precision from the .bdf to the output (eeg_float32.py)
+    sfreq: float = None  # down-sample to this rate after filtering
+    chunk: float = None  # seconds processed at a time (eeg_chunked.py)
+    locks: list = None  # lock points epoched as well as the task's own (parse_lock())
+    journal: str = None  # checkpoint directory (eeg_journal.py)
+    auto_eog: bool = False  # choose new components automatically (eeg_eog.py)
+    output: str = "mat"  # .mat files or the task's epoch store ("store")
+    reject: str = "fixed"  # one of REJECT_MODES (eeg_reject.py)
+    reject_jobs: int = 1  # threads searching for an adaptive threshold
+    align: bool = True  # check the triggers against the OpenSesame trials (eeg_align.py)
+    profile: bool = False  # measure every stage (eeg_profile.py)
+
+# seconds kept either side of the triggers when only part of the recording is
+# read - enough for the 0.15 Hz high-pass filter to settle
+LAZY_MARGIN = 30.0
+
+# do not include marker or facial electrodes
+EXCLUDE_CHANNELS = ['Status', 'EXG2', 'EXG3', 'EXG4', 'EXG5', 'EXG6', 'EXG7', 'EXG8']
+
+# Everything that differs between the tasks.
+# conditions - (event name, event code, {csv column: value}) for each trial type
+# output - where the .mat is written, or one path per condition
+# store - the HDF5 epoch store holding every participant of the task
+# roi - where the per-trial ROI amplitudes of the windows in roi_windows are written
+# epoch_trials - which events are epoched (Smoking Go/NoGo ignores practice trials)
+# exclusions - old exclusion file, imported into the ledger on first use
+# timestamp - OpenSesame column with the time of the stimulus (ms), logged as
+#   time_<item name>, used to check the triggers against the trials (see eeg_align.py)
+# response_locked - time 0 of the task's own epochs is the response rather than
+#   stimulus onset (other lock points can be epoched as well, see parse_lock())
+# max_component - typing a number this high stops the component prompt
+# ica - folder for the fitted ICA of each participant
+TASKS = {
+    "eriksen": {
+        "behavioural": "Raw_data/Behavioural/Eriksen",
+        "eeg": "Raw_data/EEG/Eriksen",
+        "exclusions": "Eriksen.csv",
+        "n_events": 420,
+        "conditions": [("correct", 1, {"correct": 1}),
+                       ("incorrect", 2, {"correct": 0})],
+        "output": "Rdata/Eriksen/{name}.mat",
+        "ica": "Rdata/Eriksen/ICA",
+        "store": "Rdata/Eriksen/eriksen-epochs.h5",
+        "roi": "Rdata/Eriksen/ROI/{name}-roi.csv",
+        "roi_windows": ERIKSEN_WINDOWS,
+        "epoch_trials": slice(None),
+        "timestamp": "time_stimulus",
+        "response_locked": True,
+        "max_component": 20,
+    },
+    "gonogo": {
+        "behavioural": "Raw_data/Behavioural/Go-NoGo",
+        "eeg": "Raw_data/EEG/Go-NoGo",
+        "exclusions": "Gonogo.csv",
+        "n_events": 420,
+        "conditions": [("Go", 1, {"Stim_type": "Go"}),
+                       ("NoGo", 2, {"Stim_type": "NoGo"})],
+        "output": "Rdata/Go-NoGo/{name}.mat",
+        "ica": "Rdata/Go-NoGo/ICA",
+        "store": "Rdata/Go-NoGo/gonogo-epochs.h5",
+        "roi": "Rdata/Go-NoGo/ROI/{name}-roi.csv",
+        "roi_windows": GONOGO_WINDOWS,
+        "epoch_trials": slice(None),
+        "timestamp": "time_stimulus",
+        "response_locked": False,
+        "max_component": 20,
+    },
+    "smokingnogo": {
+        "behavioural": "Raw_data/Behavioural/Smoking-nogo",
+        "eeg": "Raw_data/EEG/Smoking-nogo",
+        "exclusions": "Smokingnogo.csv",
+        "n_events": 208,
+        "conditions": [("Go/smoking", 1, {"Stimulus": "Go", "Cue_type": "smoking"}),
+                       ("Go/neutral", 2, {"Stimulus": "Go", "Cue_type": "neutral"}),
+                       ("NoGo/smoking", 3, {"Stimulus": "NoGo", "Cue_type": "smoking"}),
+                       ("NoGo/neutral", 4, {"Stimulus": "NoGo", "Cue_type": "neutral"})],
+        "output": {"Go/smoking": "Kieron_data/Go_smoking/{name}_Go_smoking.mat",
+                   "Go/neutral": "Kieron_data/Go_neutral/{name}_Go_neutral.mat",
+                   "NoGo/smoking": "Kieron_data/Nogo_smoking/{name}_Nogo_smoking.mat",
+                   "NoGo/neutral": "Kieron_data/Nogo_neutral/{name}_Nogo_neutral.mat"},
+        "ica": "Kieron_data/ICA",
+        "store": "Kieron_data/smokingnogo-epochs.h5",
+        "roi": "Kieron_data/ROI/{name}-roi.csv",
+        "roi_windows": GONOGO_WINDOWS,
+        "epoch_trials": slice(32, 208),  # ignore practice trials
+        "timestamp": "time_stimulus",
+        "response_locked": False,
+        "max_component": 40,
+    },
+}
+
+
+def participant_name(filepath):
+    """Participant name from the OpenSesame .csv path, e.g. 1001-eriksen."""
+    return os.path.splitext(os.path.basename(filepath))[0]
+
+
+def task_lock(task):
+    """Lock point of the task's own epochs, "response" or "stimulus"."""
+    return "response" if TASKS[task]["response_locked"] else "stimulus"
+
+
+def parse_lock(lock):
+    """Event and shift in ms of a lock point such as "stimulus", "response" or "response-100".
+
+    The shift is added to the stimulus onset or to the response of every
+    trial, e.g. "stimulus+300" is 300 ms after stimulus onset.
+    """
+    match = re.match(r"^(stimulus|response)([+-]\d+(?:\.\d+)?)?$", lock)
+    if match is None:
+        raise ValueError("Unknown lock point " + repr(lock) + " - use stimulus or response, "
+                         "with an optional shift in ms such as response-100")
+    return match.group(1), float(match.group(2) or 0)
+
+
+def task_locks(task, locks=None):
+    """The task's own lock point followed by any other lock points in locks."""
+    own = task_lock(task)
+    for lock in locks or []:
+        parse_lock(lock)
+    return [own] + [lock for lock in dict.fromkeys(locks or []) if lock != own]
+
+
+def output_paths(task, name, lock=None):
+    """Dictionary of .mat paths for a participant - key None if all conditions share one file.
+
+    Epochs locked to anything but the task's own lock point go into a
+    "<lock>-locked" folder next to the task's .mat files.
+    """
+    output = TASKS[task]["output"]
+    if isinstance(output, dict):
+        paths = {cond: path.format(name=name) for cond, path in output.items()}
+    else:
+        paths = {None: output.format(name=name)}
+    if lock is not None and lock != task_lock(task):
+        paths = {cond: os.path.join(os.path.dirname(path), lock + "-locked",
+                                    os.path.basename(path)) for cond, path in paths.items()}
+    return paths
+
+
+def store_path(task, lock=None):
+    """The task's epoch store, or the store of the epochs of another lock point."""
+    path = TASKS[task]["store"]
+    if lock is not None and lock != task_lock(task):
+        root, ext = os.path.splitext(path)
+        return root + "-" + lock + ext
+    return path
+
+
+def ica_path(task, name):
+    """Where the fitted ICA of a participant is saved."""
+    return os.path.join(TASKS[task]["ica"], name + "-ica.fif")
+
+
+def is_processed(task, name, output="mat"):
+    """Only process a participant if their .mat file(s) (or store row) don't already exist."""
+    if output == "store":
+        return name in eeg_store.participants(TASKS[task]["store"])
+    return all(os.path.isfile(path) for path in output_paths(task, name).values())
+
+
+def trial_codes(task, rtdata):
+    """Label each trial of the OpenSesame file with its event code."""
+    codes = np.zeros(len(rtdata), dtype=np.int64)
+    for cond, code, criteria in TASKS[task]["conditions"]:
+        mask = np.ones(len(rtdata), dtype=bool)
+        for column, value in criteria.items():
+            mask &= (rtdata[column] == value).values
+        codes[mask] = code
+    return codes
+
+
+def exclusion_ledger(task):
+    """The ICA exclusion ledger, importing the task's old exclusion file on first use."""
+    ledger = ExclusionLedger(LEDGER)
+    csv = TASKS[task]["exclusions"]
+    if len(ledger.participants(task)) == 0 and os.path.isfile(csv):
+        ledger.import_csv(task, csv)
+    return ledger
+
+
+def full_ica_key(task, filepath):
+    """Key of the ICA fitted on the whole recording with the default options.
+
+    The components of the old exclusion files, and of ledger entries
+    recorded before the key was kept, were chosen on this ICA.
+    """
+    return participant_stages(task, filepath).key("ica_fit")
+
+
+def read_exclusions(task, name, ica_key=None, filepath=None):
+    """Look up the ICA components already chosen for a participant.
+
+    Returns None if the participant is not in the exclusion ledger yet.
+    With ica_key (of the "ica_fit" stage) it is also None if they were
+    chosen on another ICA fit, e.g. of a --lazy-load recording, as they
+    number that ICA's sources. Entries without a key are taken to be for
+    full_ica_key(task, filepath).
+    """
+    ledger = exclusion_ledger(task)
+    eog_inds = ledger.get(task, name)
+    if eog_inds is None or ica_key is None:
+        return eog_inds
+    chosen_on = ledger.ica_key(task, name) or full_ica_key(task, filepath)
+    return eog_inds if chosen_on == ica_key else None
+
+
+def prompt_components(task):
+    """Ask for the components to exclude, ending with a number >= max_component."""
+    max_component = TASKS[task]["max_component"]
+    eog_inds = []
+    exclude_component = int(input("Type single component to exclude: "))
+    while exclude_component < max_component:
+        eog_inds.append(exclude_component)
+        exclude_component = int(input("Type single component to exclude: "))
+    return eog_inds
+
+
+def add_exclusions(task, name, eog_inds, method="manual", ica_key=None):
+    """Record a participant's chosen components (of the ICA fit ica_key) in the exclusion ledger."""
+    exclusion_ledger(task).set(task, name, eog_inds, method=method, ica_key=ica_key)
+
+
+def find_events(task, eegpath, codes, rts, scale=1.0, locks=None, sfreq=BIOSEMI_HZ):
+    """Event arrays with one row per trial of the OpenSesame file, one per lock point.
+
+    The triggers are decoded straight from the Status channel of the .bdf
+    file (see bdf_reader.decode_triggers), so the data does not need to be
+    loaded and MNE's trouble with the negative Status values is avoided.
+    rts are in samples at the recorded rate sfreq. locks are the lock
+    points (see parse_lock(), default the task's own) and the result is a
+    (locks, trials, 3) array. The event samples are multiplied by scale (and
+    rounded once, at the end) when the data is down-sampled, see resample().
+    """
+    n_events = TASKS[task]["n_events"]
+    triggers = bdf_reader.read_triggers(eegpath)
+    onsets = triggers[triggers[:, 2] == SETTINGS["trigger_code"], 0]
+
+    # print to console how many events were found
+    print("Found " + str(len(triggers)) + " triggers and " + str(len(onsets)) + " trial onsets")
+
+    events = np.zeros((n_events, 3), dtype=np.int64)
+    events[:, 0] = onsets[:n_events]
+
+    # define event markers
+    labelled = np.where(codes > 0)[0]
+    events[labelled, 2] = codes[labelled]
+
+    # a copy of the events for every lock point - the stimulus onsets are left alone
+    locked = np.repeat(events[None], len(locks or [task_lock(task)]), axis=0)
+    for i, lock in enumerate(locks or [task_lock(task)]):
+        event, shift = parse_lock(lock)
+        onset = events[:, 0] + shift / 1000.0 * sfreq
+        if event == "response":
+            # time 0 is when the response was made, not stimulus onset
+            onset = onset + rts  # add reaction time to event marker
+        locked[i, :, 0] = np.round(onset * scale)
+    return locked
+
+
+def load_raw(eegpath, lazy=False, float32=False):
+    """Read the raw EEG data from the Biosemi .bdf file.
+
+    With lazy=True only the channels used by the pipeline (plus Status) and
+    the part of the recording around the triggers are decoded, see
+    bdf_reader.py. The average reference is then taken over those channels
+    only, without EXG2-EXG8. With float32=True the data is single precision
+    (see eeg_float32.py) - decoded as such by the lazy reader, converted
+    after loading by MNE otherwise.
+    """
+    if not lazy:
+        raw = mne.io.read_raw_bdf(eegpath, preload=True)
+        return eeg_float32.as_float32(raw) if float32 else raw
+    channels, start, stop = lazy_selection(eegpath)
+    return bdf_reader.read_raw_bdf(eegpath, channels, start, stop,
+                                   dtype=np.float32 if float32 else np.float64)
+
+
+def load_size(eegpath, lazy=False, float32=False):
+    """Bytes of the data load_raw() holds, at most - worked out from the header alone.
+
+    The lazy reader's time span is taken to be the whole recording, as
+    finding it means reading the Status channel.
+    """
+    header = bdf_reader.read_header(eegpath)
+    n_channels = header["n_channels"]
+    if lazy:
+        n_channels = len([ch for ch in header["labels"] if ch not in EXCLUDE_CHANNELS]) + 1
+    n_samples = header["n_records"] * int(header["n_samples"][0])
+    return n_channels * n_samples * (4 if float32 else 8)
+
+
+def lazy_selection(eegpath):
+    """Channels and sample range decoded by load_raw(lazy=True)."""
+    header = bdf_reader.read_header(eegpath)
+    channels = [ch for ch in header["labels"] if ch not in EXCLUDE_CHANNELS] + ['Status']
+    start, stop = bdf_reader.status_span(eegpath, LAZY_MARGIN, SETTINGS["tmax"], header=header)
+    return channels, start, stop
+
+
+def reference(raw):
+    """Average reference and electrode positions (modifies raw in place)."""
+    # define which reference to use - average of all electrodes
+    raw.set_eeg_reference('average', projection=True)
+
+    # We used a Biosemi II cap with 32 electrodes - predefined electrode positions on the head
+    montage = mne.channels.make_standard_montage('biosemi32')
+    # the EXG channels have no position
+    raw.set_montage(montage, on_missing='ignore')
+    return raw
+
+
+def band_pass(raw):
+    """Band-pass filter the data (modifies raw in place)."""
+    if raw._data.dtype == eeg_float32.DTYPE:
+        return eeg_float32.band_pass(raw, SETTINGS["l_freq"], SETTINGS["h_freq"])
+    raw.filter(l_freq=SETTINGS["l_freq"], h_freq=SETTINGS["h_freq"])
+    return raw
+
+
+def resample(raw, sfreq):
+    """Down-sample the filtered data to sfreq Hz (modifies raw in place).
+
+    A polyphase filter low-passes at the new Nyquist frequency before
+    down-sampling, so nothing aliases, in the precision of the data (see
+    eeg_float32.resample). The 30 Hz low-pass has to end below that
+    frequency. The data is resampled into a new Raw, which gets the
+    reference and montage of reference() again.
+    """
+    if sfreq >= raw.info['sfreq'] or sfreq / 2.0 <= SETTINGS["h_freq"]:
+        raise ValueError("Cannot resample " + str(raw.info['sfreq']) + " Hz data low-passed at " +
+                         str(SETTINGS["h_freq"]) + " Hz to " + str(sfreq) + " Hz")
+    return reference(eeg_float32.resample(raw, sfreq))
+
+
+def signal_stage(graph):
+    """Name of the stage the ICA is applied to - the down-sampled data if there is one."""
+    return "resample" if "resample" in graph.stages else "filter"
+
+
+def eeg_picks(raw):
+    """Pick channels by type and name."""
+    return mne.pick_types(raw.info, meg=False, eeg=True, eog=True,
+                          exclude=EXCLUDE_CHANNELS)
+
+
+def fit_ica(raw, picks, decim=None):
+    """Fit the ICA ocular correction with the settings above.
+
+    decim defaults to SETTINGS["decim"]; pass 1 for data that is already
+    decimated (see eeg_chunked.py).
+    """
+    ica = ICA(n_components=SETTINGS["n_components"],
+              method=SETTINGS["method"],
+              random_state=SETTINGS["random_state"])
+    print(ica)
+    ica.fit(raw, picks=picks, decim=decim or SETTINGS["decim"])
+    print(ica)
+    return ica
+
+
+def component_data(graph):
+    """Filtered data the ICA components are chosen on, and every how many samples to use.
+
+    The chunked stages only keep the sample the ICA was fitted on, which
+    is decimated already.
+    """
+    if "ica_sample" in graph.stages:
+        return graph.get("ica_sample"), 1
+    return graph.get("filter"), SETTINGS["decim"]
+
+
+def apply_ica(raw, ica, eog_inds):
+    """Remove the chosen ICA components from the signal (modifies raw in place)."""
+    if raw._data.dtype == eeg_float32.DTYPE:
+        return eeg_float32.apply_ica(raw, ica, eog_inds)
+    ica.exclude = list(eog_inds)
+    ica.apply(raw)
+    return raw
+
+
+def task_trials(task, events):
+    """Events of the trials the task epochs, their event codes and which to keep.
+
+    Only trials of the task's conditions are kept.
+    """
+    config = TASKS[task]
+    trials = events[:, config["epoch_trials"]]
+    codes = trials[0, :, 2]
+    keep = np.isin(codes, [code for cond, code, criteria in config["conditions"]])
+    return trials, codes, keep
+
+
+def make_epochs(task, raw, events, reject="fixed", jobs=1, locks=None):
+    """Epoch the cleaned data around the events of the task (see eeg_epochs.py).
+
+    events are the (locks, trials, 3) events of the lock points locks
+    (default the task's own), as returned by find_events(), and the epochs
+    of all of them are cut in one pass. The average reference is applied to
+    raw in place, over the picked channels as mne.Epochs(proj=True) does.
+    reject is one of REJECT_MODES, and jobs the threads searching for an
+    adaptive threshold.
+
+    Returns a dictionary with the epochs of every lock point: a dictionary
+    with the (channels, trials, samples) data, the indices of the retained
+    trials ("selection"), the event code of every trial, the channel names
+    and the epoch times, plus the threshold z of every channel ("reject_z")
+    with adaptive rejection.
+    """
+    trials, codes, keep = task_trials(task, events)
+    picks = eeg_picks(raw)
+    if np.all(np.diff(picks) == 1):
+        data = raw._data[picks[0]:picks[-1] + 1]  # a view, nothing is copied
+    else:
+        data = raw._data[picks]
+    data -= data.mean(axis=0)
+
+    fixed = SETTINGS["reject"]["eeg"] if reject == "fixed" else None
+    locked = extract_locked(data, trials[:, :, 0], SETTINGS["tmin"], SETTINGS["tmax"],
+                            raw.info['sfreq'], first_samp=raw.first_samp,
+                            baseline=SETTINGS["baseline"], reject=fixed, keep=keep)
+    return locked_epochs(task, locked, codes, [raw.ch_names[p] for p in picks],
+                         raw.info['sfreq'], reject, jobs, locks)
+
+
+def locked_epochs(task, locked, codes, ch_names, sfreq, reject="fixed", jobs=1, locks=None):
+    """The epochs dictionary of every lock point, as returned by make_epochs().
+
+    locked holds the epochs and retained trials of every lock point, as
+    returned by eeg_epochs.extract_locked(). With an adaptive reject mode
+    the rejected trials are set to NaN here.
+    """
+    locks = locks or [task_lock(task)]
+    result = {}
+    for lock, (eps, selection) in zip(locks, locked):
+        epochs = {"data": eps, "selection": selection, "codes": codes,
+                  "ch_names": np.array(ch_names),
+                  "times": epoch_times(SETTINGS["tmin"], SETTINGS["tmax"], sfreq)}
+        if reject != "fixed":
+            retained, thresholds = eeg_reject.adaptive_reject(
+                eps, selection, per_channel=reject == "channel", jobs=jobs,
+                seed=SETTINGS["random_state"])
+            eps[:, np.setdiff1d(selection, retained)] = np.nan
+            epochs["selection"], epochs["reject_z"] = retained, thresholds["z"]
+        result[lock] = epochs
+    return result
+
+
+def save_epochs(task, name, epochs, lock=None):
+    """Save the epochs as .mat file(s) for analysis in R.
+
+    Each channel is saved as a (1, trials, samples) matrix. Rejected trials
+    are NaN placeholders, except in the per-condition files which only
+    hold the retained trials of that condition. Epochs of another lock point
+    than the task's own are saved as output_paths() places them.
+    """
+    paths = output_paths(task, name, lock)
+    codes = dict((cond, code) for cond, code, criteria in TASKS[task]["conditions"])
+    eps = epochs["data"]
+    retained = np.zeros(eps.shape[1], dtype=bool)
+    retained[epochs["selection"]] = True
+    for cond, path in paths.items():
+        if cond is None:
+            # channels x trials x samples is already the layout R expects
+            d = {ch: eps[i:i + 1] for i, ch in enumerate(epochs["ch_names"])}
+        else:
+            trials = np.flatnonzero(retained & (epochs["codes"] == codes[cond]))
+            d = {ch: eps[i:i + 1, trials] for i, ch in enumerate(epochs["ch_names"])}
+
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        sio.savemat(path, mdict=d)
+    return list(paths.values())
+
+
+def save_roi(task, name, epochs):
+    """Write the per-trial ROI amplitudes of a participant as a long .csv table."""
+    config = TASKS[task]
+    table = roi_table(epochs, config["roi_windows"], name.split("-")[0],
+                      config["conditions"], first_trial=config["epoch_trials"].start or 0)
+    path = config["roi"].format(name=name)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    table.to_csv(path, index=False)
+    return path
+
+
+def store_epochs(task, name, epochs, reject="fixed", lock=None):
+    """Add the epochs to the task's epoch store (or a lock point's, see store_path())."""
+    settings = SETTINGS if reject == "fixed" else dict(SETTINGS, reject_mode=reject)
+    return [eeg_store.write_participant(store_path(task, lock), task, name, epochs, settings)]
+
+
+def participant_stages(task, filepath, options=None, profiler=None):
+    """Stage graph of one participant up to the fitted ICA.
+
+    The ICA apply and epoch stages are added by add_clean_stages() once the
+    components to exclude are known. options is an Options and profiler an
+    optional eeg_profile.StageProfiler.
+    """
+    options = options or Options()
+    cache, lazy_load, sfreq, float32, chunk, journal = (
+        options.cache, options.lazy_load, options.sfreq, options.float32, options.chunk,
+        options.journal)
+    config = TASKS[task]
+    name = participant_name(filepath)
+    eegpath = os.path.join(config["eeg"], name + '.bdf')
+    locks = task_locks(task, options.locks)
+
+    def events_stage():
+        # read .csv file and label the trial types
+        rtdata = pd.read_csv(filepath, sep=',')
+        codes = trial_codes(task, rtdata)
+        # convert response time variable to the sampling rate of the recording
+        recorded = bdf_reader.read_header(eegpath)["sfreq"]
+        rts = np.int64(rtdata['response_time'].values / 1000.0 * recorded)
+        return find_events(task, eegpath, codes, rts, scale=(sfreq or recorded) / recorded,
+                           locks=locks, sfreq=recorded)
+
+    if chunk and sfreq:
+        raise ValueError("The data cannot be down-sampled when it is processed in chunks")
+
+    if journal:
+        journal = StageJournal(journal).participant(task, name)
+    graph = StageGraph(cache, profiler, journal or None)
+    load_params = {"bdf": file_hash(eegpath)}
+    if lazy_load:
+        load_params["lazy"] = {"margin": LAZY_MARGIN, "tmax": SETTINGS["tmax"],
+                               "exclude": EXCLUDE_CHANNELS}
+    if float32:
+        load_params["dtype"] = "float32"
+    # Raw stage outputs are cached in the precision they are held in
+    raw_kind = "raw32" if float32 else "raw"
+    event_params = {"bdf": file_hash(eegpath), "csv": file_hash(filepath),
+                    "trigger_code": SETTINGS["trigger_code"],
+                    "n_events": config["n_events"],
+                    "conditions": config["conditions"],
+                    "locks": locks}
+    if sfreq:
+        event_params["sfreq"] = sfreq
+    graph.add("events", "array", events_stage, params=event_params)
+    ica_params = dict({k: SETTINGS[k] for k in ("n_components", "method", "decim",
+                                                 "random_state")},
+                      exclude_channels=EXCLUDE_CHANNELS)
+    if chunk:
+        recording = eeg_chunked.ChunkedRecording(eegpath, lazy_load,
+                                                 np.float32 if float32 else np.float64, chunk)
+        # what add_clean_stages() cuts the epochs from
+        graph.context["recording"] = recording
+        graph.add("ica_sample", raw_kind, recording.ica_sample,
+                  params=dict(load_params, max_samples=eeg_chunked.ICA_SAMPLES,
+                              decim=SETTINGS["decim"],
+                              **{k: SETTINGS[k] for k in ("l_freq", "h_freq")}))
+        # a key of its own, so components chosen on the ICA of the whole
+        # recording are not applied to this one
+        graph.add("ica_fit", "ica", lambda raw: fit_ica(raw, eeg_picks(raw), decim=1),
+                  deps=["ica_sample"], params=ica_params, path=ica_path(task, name))
+        return graph
+
+    graph.add("load", raw_kind, lambda: load_raw(eegpath, lazy_load, float32),
+              params=load_params)
+    graph.add("reference", raw_kind, reference, deps=["load"],
+              params={"ref": "average", "montage": "biosemi32"})
+    graph.add("filter", raw_kind, band_pass, deps=["reference"],
+              params={k: SETTINGS[k] for k in ("l_freq", "h_freq")})
+    # the fitted ICA is kept for every participant and only refitted when the
+    # filtered data or the ICA settings change
+    graph.add("ica_fit", "ica", lambda raw: fit_ica(raw, eeg_picks(raw)), deps=["filter"],
+              params=ica_params, path=ica_path(task, name))
+    if sfreq:
+        # after the ICA fit, which stays at the recorded rate (with decim) so the
+        # components in the exclusion ledger still apply
+        graph.add("resample", raw_kind, lambda raw: resample(raw, sfreq), deps=["filter"],
+                  params={"sfreq": sfreq})
+    return graph
+
+
+def add_clean_stages(task, graph, eog_inds, options=None):
+    """Add the ICA apply and epoch stages once the components are chosen.
+
+    options have to be the same as given to participant_stages().
+    """
+    options = options or Options()
+    reject, reject_jobs = options.reject, options.reject_jobs
+    config = TASKS[task]
+    locks = task_locks(task, options.locks)
+    params = dict({k: SETTINGS[k] for k in ("tmin", "tmax", "baseline", "reject")},
+                  epoch_trials=config["epoch_trials"], locks=locks)
+    if reject != "fixed":
+        params.update({"reject": reject, "grid": list(eeg_reject.GRID),
+                       "folds": eeg_reject.FOLDS, "random_state": SETTINGS["random_state"]})
+    if "recording" in graph.context:
+        # the ICA is applied chunk by chunk while the epochs are cut
+        recording = graph.context["recording"]
+        graph.add("epochs", "locks",
+                  lambda ica, events: recording.epochs(task, ica, eog_inds, events, reject,
+                                                       reject_jobs, locks),
+                  deps=["ica_fit", "events"], params=dict(params, exclude=sorted(eog_inds)))
+        return
+    # cached in the precision of the data it cleans
+    graph.add("ica_apply", graph.stages[signal_stage(graph)][0],
+              lambda raw, ica: apply_ica(raw, ica, eog_inds),
+              deps=[signal_stage(graph), "ica_fit"], params={"exclude": sorted(eog_inds)})
+    graph.add("epochs", "locks",
+              lambda raw, events: make_epochs(task, raw, events, reject, reject_jobs, locks),
+              deps=["ica_apply", "events"], params=params)
+
+
+def process_participant(task, filepath, options=None, interactive=True, record=True,
+                        prefetched=None, read_ahead=None):
+    """Run the whole pre-processing pipeline for one participant.
+
+    filepath is the participant's OpenSesame .csv file and options an
+    Options. If the participant's components are not in the exclusion
+    ledger for this ICA fit they are chosen automatically (options
+    auto_eog), or else plotted and typed in by hand, unless interactive is
+    False in which case a RuntimeError is raised; new choices are recorded
+    if record is True. prefetched holds stage outputs already worked out
+    (see eeg_batch.prefetch_participants()) and read_ahead is called once
+    the recording is filtered.
+    Returns a dictionary with the files written ("outputs"), the excluded
+    components ("components"), whether they were newly chosen
+    ("new_components") and the stage profile ("profile").
+    """
+    options = options or Options()
+    name = participant_name(filepath)
+    profiler = StageProfiler() if options.profile else None
+    if options.align:
+        # before anything heavy - a dropped trigger puts every later trial on the wrong epoch
+        with measure(profiler, "align"):
+            report = eeg_align.check_participant(task, filepath)
+        if not report["ok"]:
+            raise ValueError(name + ": the triggers do not match the trials - " +
+                             eeg_align.describe(report))
+    with measure(profiler, "hash"):
+        graph = participant_stages(task, filepath, options, profiler)
+    for stage, value in (prefetched or {}).items():
+        graph.provide(stage, value)
+    if read_ahead is not None and "filter" in graph.stages:
+        graph.on_output("filter", read_ahead)
+
+    # Stoyan's automated ICA component picker
+    ica_key = graph.key("ica_fit")
+    eog_inds = read_exclusions(task, name, ica_key, filepath)
+    new_components = eog_inds is None
+    if new_components:
+        # in the ledger, but for the sources of another ICA fit
+        other_fit = read_exclusions(task, name) is not None
+        if other_fit and (options.auto_eog or interactive):
+            print(name + ": the components in the exclusion ledger were chosen on another "
+                  "ICA fit - choosing them again")
+        if options.auto_eog:
+            ica, (raw, decim) = graph.get("ica_fit"), component_data(graph)
+            with measure(profiler, "eog"):
+                eog_inds = find_eog_components(ica, raw, decim=decim)
+        elif interactive:
+            graph.get("ica_fit").plot_components(picks=eeg_picks(component_data(graph)[0]))
+            eog_inds = prompt_components(task)
+        elif other_fit:
+            raise RuntimeError(name + "'s components in the exclusion ledger " + LEDGER +
+                               " were chosen on another ICA fit - run it on its own, with"
+                               " automatic EOG selection or with the options it was reviewed with")
+        else:
+            raise RuntimeError(name + " is not in the exclusion ledger " + LEDGER +
+                               " - run it on its own or with automatic EOG selection")
+        if record:
+            add_exclusions(task, name, eog_inds, method="auto" if options.auto_eog else "manual",
+                           ica_key=ica_key)
+
+    add_clean_stages(task, graph, eog_inds, options)
+    epochs = graph.get("epochs")
+    outputs = []
+    with measure(profiler, "save"):
+        for lock, locked in epochs.items():
+            if options.output == "store":
+                outputs += store_epochs(task, name, locked, options.reject, lock)
+            else:
+                outputs += save_epochs(task, name, locked, lock)
+    with measure(profiler, "roi"):
+        # the ROI windows are defined relative to the task's own lock point
+        outputs.append(save_roi(task, name, epochs[task_lock(task)]))
+    if graph.journal is not None:
+        graph.journal.finish()
+    return {"outputs": outputs, "components": eog_inds, "new_components": new_components,
+            "profile": profiler.records if profiler is not None else None}
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage resource use of the pipeline.
+
+With --profile FILE the batch driver appends one JSON line per participant
+to FILE, listing for every stage (load, filter, ica_fit, save, ...):
+
+    wall          elapsed seconds
+    cpu           CPU seconds of the process (user + system)
+    peak_rss      peak resident memory during the stage, in bytes
+    read_bytes    bytes read through system calls (file reads, not memory maps)
+    write_bytes   bytes written through system calls
+    disk_read     bytes fetched from the disk, including memory-mapped .bdf reads
+    disk_write    bytes sent to the disk
+    source        "computed", "cache" or "saved" (the fixed-path ICA)
+
+The peak memory and I/O counters come from /proc/self on Linux, where the
+peak is reset at the start of every stage. Elsewhere peak_rss is the peak
+of the whole process so far and the I/O counters are null.
+
+    python eeg_profile.py summary profile.jsonl
+
+prints the total and mean of every stage across the participants in the
+file, the hot stage first.
+
+@author: James Bartlett
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import time
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+_IO_FIELDS = {"rchar": "read_bytes", "wchar": "write_bytes",
+              "read_bytes": "disk_read", "write_bytes": "disk_write"}
+
+
+def _io_counters():
+    """I/O counters of this process from /proc/self/io, or {} if not available."""
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(":") for line in f.read().splitlines() if ":" in line)
+    except (IOError, OSError):
+        return {}
+    return dict((_IO_FIELDS[k], int(v)) for k, v in counters.items() if k in _IO_FIELDS)
+
+
+def _reset_peak():
+    """Restart the peak resident memory count (Linux 4.0 and later)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def _peak_rss():
+    """Peak resident memory in bytes since the last reset (or since the start)."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    if resource is not None:
+        # kB on Linux, bytes on macOS - only reached on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return None
+
+
+class StageProfiler(object):
+    """Collects one record per stage run inside stage()."""
+
+    def __init__(self):
+        self.records = []
+
+    @contextlib.contextmanager
+    def stage(self, name, **extra):
+        """Measure the block as stage name; extra fields are added to its record.
+
+        The yielded dictionary can be updated inside the block (e.g. with the
+        source of the stage output); setting record["skip"] drops the record.
+        """
+        record = {"stage": name}
+        record.update(extra)
+        _reset_peak()
+        io_start = _io_counters()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield record
+        finally:
+            record["wall"] = time.perf_counter() - wall
+            record["cpu"] = time.process_time() - cpu
+            record["peak_rss"] = _peak_rss()
+            io_stop = _io_counters()
+            for field in _IO_FIELDS.values():
+                record[field] = (io_stop[field] - io_start[field]) if field in io_stop else None
+            if not record.pop("skip", False):
+                self.records.append(record)
+
+
+def measure(profiler, name):
+    """profiler.stage(name), or a context that measures nothing if profiler is None."""
+    if profiler is None:
+        return contextlib.nullcontext({})
+    return profiler.stage(name)
+
+
+def write_records(path, participant, task, records, **extra):
+    """Append one participant's stage records to a JSON-lines file."""
+    line = {"participant": participant, "task": task,
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"), "stages": records}
+    line.update(extra)
+    folder = os.path.dirname(path)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+    with open(path, "a") as f:
+        f.write(json.dumps(line, sort_keys=True) + "\n")
+
+
+def read_records(path):
+    """Table with one row per participant and stage of a profile file."""
+    rows = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            for record in entry["stages"]:
+                row = dict(record)
+                row["participant"] = entry["participant"]
+                row["task"] = entry.get("task")
+                rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def summary(table):
+    """Total and mean of every stage across participants, slowest first."""
+    grouped = table.groupby("stage", sort=False)
+    out = pd.DataFrame({
+        "participants": grouped["participant"].nunique(),
+        "wall_total": grouped["wall"].sum(),
+        "wall_mean": grouped["wall"].mean(),
+        "cpu_mean": grouped["cpu"].mean(),
+        "peak_rss_max_mb": grouped["peak_rss"].max() / 1024.0 ** 2,
+        "read_mb": grouped["read_bytes"].sum() / 1024.0 ** 2,
+        "written_mb": grouped["write_bytes"].sum() / 1024.0 ** 2,
+        "disk_read_mb": grouped["disk_read"].sum() / 1024.0 ** 2,
+    })
+    out["wall_share"] = out["wall_total"] / out["wall_total"].sum()
+    return out.sort_values("wall_total", ascending=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarise a pipeline profile.")
+    parser.add_argument("command", choices=["summary"])
+    parser.add_argument("profile", help="JSON-lines file written with --profile")
+    parser.add_argument("--task", help="only this task")
+    args = parser.parse_args(argv)
+    table = read_records(args.profile)
+    if args.task:
+        table = table[table["task"] == args.task]
+    if len(table) == 0:
+        print("No stages in " + args.profile)
+        return
+    out = summary(table)
+    with pd.option_context("display.width", 200, "display.max_columns", None,
+                           "display.float_format", "{:.2f}".format):
+        print(out)
+    hot = out.index[0]
+    print("Hot stage: " + hot + " (" + str(int(round(100 * out["wall_share"].iloc[0]))) +
+          "% of the wall time, " + "{:.1f}".format(out["wall_mean"].iloc[0]) +
+          " s per participant)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive artifact rejection with thresholds chosen for every participant.
+
+The pipeline rejects a trial when its peak-to-peak amplitude is above a
+fixed 100 uV on any channel (EEG_process_GoNoGO.py does not reject at all).
+A fixed threshold is too strict for some participants and too lenient for
+others, so here every epoch of every channel is described by three
+measures, all worked out in one pass over the (channels, trials, samples)
+epochs:
+
+    ptp        peak-to-peak amplitude (large drifts and blinks)
+    gradient   largest sample-to-sample step (muscle bursts and electrode pops)
+    variance   variance over the epoch (broad noise)
+
+Each measure is turned into a robust z-score against the participant's own
+trials (the median and the median absolute deviation of the channel; the
+variance as its square root, so all three grow with the amplitude), and an
+epoch's score is the largest of its three z-scores. A trial is rejected
+when the score of any channel is above the threshold z.
+
+The threshold is picked from GRID by cross-validation, as in autoreject
+(Jas et al., 2017): the trials are split into FOLDS folds, and for each
+candidate the average of the retained trials of the other folds is compared
+with the median of the trials of the held-out fold (which outliers do not
+pull around). A threshold that is too lenient lets artifacts into the
+average, one too strict averages too few trials. The most lenient
+candidate whose root mean square difference is within one standard error
+(over the folds) of the smallest wins, so that thresholds no better than
+a more lenient one do not throw trials away. The last candidate rejects
+nothing, for participants whose artifacts cost less than their trials.
+With per_channel every channel gets its own threshold, chosen on that
+channel alone.
+
+The candidates are independent and are evaluated in parallel threads
+(numpy releases the GIL in the matrix products).
+
+@author: James Bartlett
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# candidate thresholds in robust standard deviations above the participant's median,
+# closer together where they matter most (and infinity - reject nothing)
+GRID = np.append(np.geomspace(2.0, 64.0, 21), np.inf)
+
+# cross-validation folds
+FOLDS = 5
+
+MEASURES = ("ptp", "gradient", "variance")
+
+# scales a median absolute deviation to a standard deviation of normal data
+MAD_SCALE = 1.4826
+
+
+def epoch_measures(data):
+    """Peak-to-peak, largest step and variance of every channel of every epoch.
+
+    data is the (channels, trials, samples) epochs. Returns a dictionary of
+    (channels, trials) arrays (NaN for NaN epochs).
+    """
+    return {"ptp": data.max(axis=2) - data.min(axis=2),
+            "gradient": np.abs(np.diff(data, axis=2)).max(axis=2),
+            "variance": data.var(axis=2)}
+
+
+def robust_scores(measures):
+    """Largest robust z-score of the measures of every channel and epoch.
+
+    Also returns the median and the scaled median absolute deviation of
+    every measure and channel, to turn a z threshold back into units.
+    """
+    scores, centres, spreads = [], {}, {}
+    for measure in MEASURES:
+        values = np.sqrt(measures[measure]) if measure == "variance" else measures[measure]
+        centre = np.nanmedian(values, axis=1)
+        spread = MAD_SCALE * np.nanmedian(np.abs(values - centre[:, None]), axis=1)
+        # a flat channel (no spread) is never what rejects a trial
+        spread = np.where(spread > 0, spread, np.inf)
+        scores.append((values - centre[:, None]) / spread[:, None])
+        centres[measure], spreads[measure] = centre, spread
+    return np.max(scores, axis=0), centres, spreads
+
+
+def fold_labels(n_trials, folds=FOLDS, seed=None):
+    """Fold of every trial, in random order but with the folds the same size."""
+    rng = np.random.default_rng(seed)
+    labels = np.empty(n_trials, dtype=int)
+    labels[rng.permutation(n_trials)] = np.arange(n_trials) % folds
+    return labels
+
+
+def threshold_errors(data, scores, threshold, labels, medians, per_channel=False):
+    """Cross-validated error of one threshold, for every fold and channel.
+
+    data is the (channels, trials, samples) epochs and scores their
+    (channels, trials) robust scores. medians holds the (channels, samples)
+    median of the trials of each fold. Returns the (folds, channels) root
+    mean square difference between the average of the retained training
+    trials and the median of the held-out trials.
+    """
+    if per_channel:
+        kept = scores <= threshold
+    else:
+        kept = np.broadcast_to((scores <= threshold).all(axis=0), scores.shape)
+    errors = np.empty((len(medians), data.shape[0]))
+    for fold, median in enumerate(medians):
+        weights = (kept & (labels != fold)).astype(data.dtype)
+        n = weights.sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            average = np.einsum("cts,ct->cs", data, weights) / n[:, None]
+        error = np.sqrt(np.mean((average - median) ** 2, axis=1))
+        # no trials left to average
+        errors[fold] = np.where(n > 0, error, np.inf)
+    return errors
+
+
+def search_threshold(data, scores, grid=GRID, folds=FOLDS, per_channel=False, jobs=1,
+                     seed=None):
+    """Most lenient threshold of the grid within one standard error of the best.
+
+    grid has to be in increasing order. Returns the threshold of every
+    channel (all the same unless per_channel) and the (candidates,
+    channels) table of mean cross-validated errors.
+    """
+    labels = fold_labels(data.shape[1], folds, seed)
+    medians = [np.median(data[:, labels == fold], axis=1) for fold in range(folds)]
+
+    def evaluate(threshold):
+        return threshold_errors(data, scores, threshold, labels, medians, per_channel)
+
+    if jobs == 1:
+        errors = [evaluate(t) for t in grid]
+    else:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            errors = list(pool.map(evaluate, grid))
+    # (candidates, folds, channels), or one column for the mean over channels
+    errors = np.array(errors)
+    if not per_channel:
+        errors = errors.mean(axis=2, keepdims=True)
+    with np.errstate(invalid="ignore"):
+        mean = errors.mean(axis=1)
+        error = errors.std(axis=1, ddof=1) / np.sqrt(folds)
+    smallest = np.argmin(mean, axis=0)
+    limit = (mean + error)[smallest, np.arange(mean.shape[1])]
+    # the last candidate within the limit of the smallest error
+    within = mean <= limit
+    best = len(grid) - 1 - np.argmax(within[::-1], axis=0)
+    best = np.broadcast_to(best, data.shape[0])
+    return np.asarray(grid)[best], np.broadcast_to(mean, (len(grid), data.shape[0]))
+
+
+def adaptive_reject(data, selection, per_channel=False, grid=GRID, folds=FOLDS, jobs=1,
+                    seed=None):
+    """Reject the artifact trials of one participant's epochs.
+
+    data is the (channels, trials, samples) epochs and selection the indices
+    of the trials still in the running (e.g. as returned by
+    eeg_epochs.extract_epochs() without reject). Returns the retained
+    indices, like epochs.selection, and a dictionary with the threshold z of
+    every channel and the same thresholds in the units of every measure.
+    """
+    selection = np.asarray(selection)
+    n_channels = data.shape[0]
+    if len(selection) < 2 * folds:
+        # too few trials to cross-validate - keep them all
+        thresholds = {"z": np.full(n_channels, np.inf)}
+        thresholds.update((m, np.full(n_channels, np.inf)) for m in MEASURES)
+        return selection, thresholds
+
+    trials = data[:, selection]
+    scores, centres, spreads = robust_scores(epoch_measures(trials))
+    z, errors = search_threshold(trials, scores, grid, folds, per_channel, jobs, seed)
+    retained = (scores <= z[:, None]).all(axis=0)
+    thresholds = {"z": z}
+    thresholds.update((m, centres[m] + z * spreads[m]) for m in MEASURES)
+    thresholds["variance"] = thresholds["variance"] ** 2
+    return selection[retained], thresholds
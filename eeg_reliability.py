@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Split-half and bootstrap reliability of per-trial ERP amplitudes.
+
+The Chapter Four .Rmd runs splithalf() (Parsons 2019) with 10000 random
+splits for every component, looping over permutations and participants in
+R. Here the per-trial amplitudes of all participants and electrodes are
+held in one (participants, trials, electrodes) array, padded with NaN, and
+a whole batch of random splits is drawn at once:
+
+- every trial of every participant gets a random key and the keys are
+  ranked, so the first half of each participant's trials (by rank) is one
+  random half and the rest the other
+- each half is a 0/1 weight over the trials, and the half means of every
+  participant, split and electrode are one batched matrix product
+
+The correlation of the two half means across participants is corrected to
+the full length with the Spearman-Brown formula 2r / (1 + r). The bootstrap
+also resamples the participants with replacement for every split (as
+weights in the correlation), so its interval includes the uncertainty from
+the sample of participants as well as from the random splits.
+
+Batches of splits can run in worker processes (jobs), each with its own
+random stream spawned from the seed, so the result does not depend on the
+number of jobs.
+
+    python eeg_reliability.py eriksen ERN --electrodes Fz Cz Pz
+
+@author: James Bartlett
+"""
+
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+import eeg_pipeline
+from eeg_batch import participant_files
+from eeg_grand_average import STATE
+
+# trials of the OpenSesame file used for each component, as in the .Rmd
+QUERIES = {
+    "eriksen": {"ERN": "correct == 0 and Block != 'Practice'",
+                "Pe": "correct == 0 and Block != 'Practice'"},
+    "gonogo": {"N2": "correct == 1 and Stim_type == 'NoGo' and Block != 'Practice'",
+               "P3": "correct == 1 and Stim_type == 'NoGo' and Block != 'Practice'"},
+    "smokingnogo": {"N2": "Stimulus == 'NoGo'",
+                    "P3": "Stimulus == 'NoGo'"},
+}
+
+# random splits drawn at a time - about 8 bytes x BATCH x participants x trials of weights
+BATCH = 200
+
+
+def roi_trials(task, filelist, component, query=None):
+    """ROI amplitudes of one component joined with the OpenSesame trial columns.
+
+    Reads the per-trial ROI tables written by the pipeline (see eeg_roi.py)
+    and keeps the trials matching query (default QUERIES[task][component]).
+    """
+    query = query or QUERIES[task][component]
+    tables = []
+    for filepath in filelist:
+        name = eeg_pipeline.participant_name(filepath)
+        roi = pd.read_csv(eeg_pipeline.TASKS[task]["roi"].format(name=name))
+        roi = roi[roi["component"] == component]
+        rtdata = pd.read_csv(filepath, sep=',')
+        rtdata = rtdata.drop(columns=[c for c in ("subject_nr",) if c in rtdata.columns])
+        rtdata["Trial_N"] = np.arange(1, len(rtdata) + 1)
+        trials = roi.merge(rtdata, on="Trial_N", how="left")
+        tables.append(trials.query(query))
+    return pd.concat(tables, ignore_index=True)
+
+
+def trial_array(table, electrodes=None, value="mean_amp"):
+    """(participants, trials, electrodes) array of a long per-trial table.
+
+    Only trials with a value at every electrode are kept, and participants
+    with fewer than two of them are left out. Participants with fewer trials
+    than the longest are padded with NaN at the end. Returns
+    the array, the number of trials of each participant, the participant
+    names and the electrodes.
+    """
+    table = table.dropna(subset=[value])
+    if electrodes is None:
+        electrodes = list(pd.unique(table["electrode"]))
+    table = table[table["electrode"].isin(electrodes)]
+    wide = table.pivot_table(index=["subject_nr", "Trial_N"], columns="electrode",
+                             values=value, aggfunc="first")[list(electrodes)].dropna()
+    # a participant needs a trial in each half
+    counts = wide.groupby(level=0).size()
+    wide = wide[wide.index.get_level_values(0).isin(counts.index[counts >= 2])]
+    subjects = wide.index.get_level_values(0)
+    names, n_trials = np.unique(subjects, return_counts=True)
+    data = np.full((len(names), n_trials.max(), len(electrodes)), np.nan)
+    # position of each trial within its participant
+    position = np.arange(len(wide)) - np.repeat(np.cumsum(n_trials) - n_trials, n_trials)
+    data[np.searchsorted(names, subjects), position] = wide.values
+    return data, n_trials, list(names), list(electrodes)
+
+
+def spearman_brown(r):
+    """Reliability of the full-length score from the correlation of two halves."""
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return 2 * r / (1 + r)
+
+
+def _correlate(a, b, weights=None):
+    """Pearson correlation over participants (axis 1) of (splits, participants, electrodes).
+
+    weights (splits, participants) counts each participant that many times.
+    """
+    if weights is None:
+        weights = np.ones(a.shape[:2])
+    w = weights[:, :, None] / weights.sum(axis=1)[:, None, None]
+    a = a - (w * a).sum(axis=1, keepdims=True)
+    b = b - (w * b).sum(axis=1, keepdims=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return ((w * a * b).sum(axis=1) /
+                np.sqrt((w * a * a).sum(axis=1) * (w * b * b).sum(axis=1)))
+
+
+def _weights_split(rng, n_splits, n_trials, width):
+    """0/1 weights of the two random halves of every participant's trials."""
+    keys = rng.random((n_splits, len(n_trials), width))
+    padding = np.arange(width)[None, :] >= n_trials[:, None]
+    keys[:, padding] = 2.0  # padding ranks last
+    rank = keys.argsort(axis=2).argsort(axis=2)
+    half = (n_trials // 2)[None, :, None]
+    first = rank < half
+    second = (rank >= half) & ~padding[None]
+    return first.astype(float), second.astype(float)
+
+
+def _weights_participants(rng, n_splits, n_participants):
+    """How often each participant is drawn in a bootstrap resample, for every split."""
+    draws = rng.integers(0, n_participants, (n_splits, n_participants))
+    offset = np.arange(n_splits)[:, None] * n_participants
+    counts = np.bincount((offset + draws).ravel(), minlength=n_splits * n_participants)
+    return counts.reshape(n_splits, n_participants).astype(float)
+
+
+def _batch(data, n_trials, n_splits, seed, method):
+    """Reliability of every electrode for one batch of random splits."""
+    rng = np.random.default_rng(seed)
+    width = data.shape[1]
+    first, second = _weights_split(rng, n_splits, n_trials, width)
+    participants = None
+    if method == "bootstrap":
+        participants = _weights_participants(rng, n_splits, len(n_trials))
+    values = np.nan_to_num(data)  # padding has zero weight anyway
+    # (participants, splits, trials) @ (participants, trials, electrodes)
+    mean_a = np.matmul(first.transpose(1, 0, 2), values) / first.sum(axis=2).T[:, :, None]
+    mean_b = np.matmul(second.transpose(1, 0, 2), values) / second.sum(axis=2).T[:, :, None]
+    return _correlate(mean_a.transpose(1, 0, 2), mean_b.transpose(1, 0, 2), participants)
+
+
+def reliability(data, n_trials, n_splits=5000, method="split", seed=23112019, jobs=1,
+                batch=BATCH):
+    """Distribution of the reliability of every electrode over random splits.
+
+    data and n_trials are as returned by trial_array(). method is "split"
+    for random split halves, or "bootstrap" to also resample the
+    participants for every split. Returns the (n_splits, electrodes) half
+    correlations and their Spearman-Brown corrected values.
+    """
+    n_trials = np.asarray(n_trials)
+    sizes = [min(batch, n_splits - start) for start in range(0, n_splits, batch)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    if jobs == 1:
+        parts = [_batch(data, n_trials, size, s, method) for size, s in zip(sizes, seeds)]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            parts = list(pool.map(_batch, [data] * len(sizes), [n_trials] * len(sizes),
+                                  sizes, seeds, [method] * len(sizes)))
+    r = np.concatenate(parts, axis=0)
+    return r, spearman_brown(r)
+
+
+def summary(r, corrected, n_participants, electrodes):
+    """Median and 95% interval of every electrode, laid out like splithalf()'s estimates."""
+    low, mid, high = np.nanpercentile(r, [2.5, 50, 97.5], axis=0)
+    sb_low, sb_mid, sb_high = np.nanpercentile(corrected, [2.5, 50, 97.5], axis=0)
+    return pd.DataFrame({"condition": electrodes, "n": n_participants,
+                         "splithalf": mid, "95_low": low, "95_high": high,
+                         "spearmanbrown": sb_mid, "SB_low": sb_low, "SB_high": sb_high})
+
+
+def included_participants(task):
+    """Participants included in the saved grand average (see eeg_grand_average.py)."""
+    path = os.path.join(STATE.format(task=task), "participants.json")
+    with open(path) as f:
+        return [name for name, status in json.load(f).items() if status == "included"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Split-half reliability of ROI amplitudes.")
+    parser.add_argument("task", choices=sorted(QUERIES))
+    parser.add_argument("component")
+    parser.add_argument("--electrodes", nargs="+", default=["Pz", "Cz", "Fz"])
+    parser.add_argument("--query", help="trials to use, as a query on the OpenSesame file")
+    parser.add_argument("--permutations", type=int, default=10000)
+    parser.add_argument("--method", choices=["split", "bootstrap"], default="split")
+    parser.add_argument("--seed", type=int, default=23112019)
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="worker processes the splits are spread over")
+    parser.add_argument("--included-only", action="store_true",
+                        help="only the participants included in the saved grand average")
+    parser.add_argument("--out", help="write the distributions to this .csv")
+    args = parser.parse_args(argv)
+
+    filelist = [f for f in participant_files(args.task)
+                if os.path.isfile(eeg_pipeline.TASKS[args.task]["roi"].format(
+                    name=eeg_pipeline.participant_name(f)))]
+    if args.included_only:
+        included = set(included_participants(args.task))
+        filelist = [f for f in filelist if eeg_pipeline.participant_name(f) in included]
+    table = roi_trials(args.task, filelist, args.component, args.query)
+    data, n_trials, names, electrodes = trial_array(table, args.electrodes)
+    r, corrected = reliability(data, n_trials, args.permutations, args.method,
+                               args.seed, args.jobs)
+    print(summary(r, corrected, len(names), electrodes).to_string(index=False))
+    if args.out:
+        pd.DataFrame(corrected, columns=electrodes).to_csv(args.out, index=False)
+
+
+if __name__ == "__main__":
+    main()
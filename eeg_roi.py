@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Per-trial amplitudes in the ERP windows of interest (ROIs).
+
+The R scripts read the full trials x samples matrix of an electrode only to
+average it over a time window. Here the windows are measured while the
+epochs are still in memory, for every retained trial and every electrode at
+once, and written as a long table with one row per trial, electrode and
+component:
+
+    subject_nr, Trial_N, condition, electrode, component,
+    mean_amp, peak_amp, peak_latency
+
+Amplitudes are in micro volts (as eriksen_erp() returns them) and latencies
+in ms. The peak is the most negative sample for negative components (ERN,
+N2) and the most positive for positive ones (Pe, P3). Trial_N is the row of
+the trial in the OpenSesame file, counting from 1 as in R.
+
+@author: James Bartlett
+"""
+
+import numpy as np
+import pandas as pd
+
+# name: (start, end in seconds, polarity of the peak)
+ERIKSEN_WINDOWS = {"ERN": (0.025, 0.075, -1), "Pe": (0.200, 0.400, 1)}
+GONOGO_WINDOWS = {"N2": (0.175, 0.250, -1), "P3": (0.300, 0.500, 1)}
+
+
+def window_measures(data, times, tmin, tmax, polarity):
+    """Mean amplitude, peak amplitude and peak latency of every channel and trial.
+
+    data is (channels, trials, samples) with the times of the samples in
+    seconds. Returns three (channels, trials) arrays, the latency in seconds.
+    """
+    lo = int(np.searchsorted(times, tmin - 1e-9))
+    hi = int(np.searchsorted(times, tmax + 1e-9))
+    window = data[:, :, lo:hi]  # a view
+    mean = window.mean(axis=2)
+    if polarity < 0:
+        peak_idx = window.argmin(axis=2)
+    else:
+        peak_idx = window.argmax(axis=2)
+    peak = np.take_along_axis(window, peak_idx[:, :, None], axis=2)[:, :, 0]
+    return mean, peak, times[lo + peak_idx]
+
+
+def roi_table(epochs, windows, subject, conditions, first_trial=0):
+    """Long table of the window measures of the retained trials of a participant.
+
+    epochs is the dictionary returned by eeg_pipeline.make_epochs(), windows
+    maps component names to (start, end, polarity), conditions is the task's
+    list of (name, code, criteria) and first_trial the row of the first
+    epoched trial in the OpenSesame file.
+    """
+    selection = epochs["selection"]
+    data = epochs["data"][:, selection]
+    names = dict((code, cond) for cond, code, criteria in conditions)
+    ch_names = [str(ch) for ch in epochs["ch_names"]]
+    n_channels, n_trials = data.shape[:2]
+
+    tables = []
+    for component, (tmin, tmax, polarity) in windows.items():
+        mean, peak, latency = window_measures(data, epochs["times"], tmin, tmax, polarity)
+        # channels x trials flattened in C order: electrode repeats, trial tiles
+        tables.append(pd.DataFrame({
+            "subject_nr": subject,
+            "Trial_N": np.tile(first_trial + selection + 1, n_channels),
+            "condition": np.tile([names.get(c, "") for c in epochs["codes"][selection]],
+                                 n_channels),
+            "electrode": np.repeat(ch_names, n_trials),
+            "component": component,
+            "mean_amp": mean.reshape(-1) * 1e6,
+            "peak_amp": peak.reshape(-1) * 1e6,
+            "peak_latency": latency.reshape(-1) * 1e3,
+        }))
+    return pd.concat(tables, ignore_index=True)
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+One HDF5 epoch store per task instead of a .mat file per participant.
+
+Each .mat file holds 33 per-channel matrices and has to be read whole, even
+when only one electrode is analysed (electrode = "Cz" in the grand average
+scripts). The store keeps every participant of a task in one chunked,
+compressed array
+
+    epochs    (participant, trial, channel, sample)
+
+with a chunk of 64 trials x 1 channel x 256 samples, so reading one
+electrode or one time window only decompresses the chunks it touches. The
+metadata sits next to it:
+
+    participants  (participant,)         participant names, e.g. 1001-eriksen
+    codes         (participant, trial)   event code of every trial
+    retained      (participant, trial)   False for rejected trials (NaN epochs)
+    written       (participant,)         when each participant was last written
+    channels      (channel,)             channel names
+    times         (sample,)              epoch time of every sample in seconds
+
+Rejected trials are NaN as in the .mat files. Workers add participants one
+at a time under a lock file, and re-processing a participant overwrites
+their row.
+
+    epochs, meta = read_epochs("Rdata/Eriksen/eriksen-epochs.h5", channels=["Cz"],
+                               tmin=0.0, tmax=0.1)
+
+@author: James Bartlett
+"""
+
+import contextlib
+import errno
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+import h5py
+
+# trials x channels x samples of one chunk - about 128 kB of float64
+CHUNK = (64, 1, 256)
+
+# gzip level 4 with the byte shuffle filter - NaN rows of rejected trials cost almost nothing
+COMPRESSION = {"compression": "gzip", "compression_opts": 4, "shuffle": True}
+
+# a lock file older than this (seconds) was left behind by a worker that died
+LOCK_STALE = 600.0
+
+
+@contextlib.contextmanager
+def store_lock(path, timeout=600.0):
+    """Hold <path>.lock while writing, so one worker writes to the store at a time."""
+    lock = path + ".lock"
+    waited = 0.0
+    while True:
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            try:
+                if time.time() - os.path.getmtime(lock) > LOCK_STALE:
+                    os.remove(lock)
+                    continue
+            except OSError:
+                continue
+            if waited > timeout:
+                raise RuntimeError("Timed out waiting for " + lock)
+            time.sleep(0.1)
+            waited += 0.1
+    try:
+        os.write(fd, str(os.getpid()).encode("ascii"))
+        os.close(fd)
+        yield
+    finally:
+        os.remove(lock)
+
+
+def _strings(values):
+    return np.array([str(v).encode("utf-8") for v in values], dtype=h5py.string_dtype())
+
+
+def _decode(values):
+    return [v.decode("utf-8") if isinstance(v, bytes) else str(v) for v in values]
+
+
+def _create(f, task, epochs, settings):
+    """Lay out an empty store for epochs shaped like this participant's (settings as JSON)."""
+    n_channels, n_trials, n_samples = epochs["data"].shape
+    chunks = (1,) + tuple(min(c, n) for c, n in zip(CHUNK, (n_trials, n_channels, n_samples)))
+    f.attrs["task"] = task
+    f.attrs["settings"] = settings
+    f.create_dataset("epochs", shape=(0, n_trials, n_channels, n_samples),
+                     maxshape=(None, n_trials, n_channels, n_samples),
+                     dtype=epochs["data"].dtype, chunks=chunks, fillvalue=np.nan,
+                     **COMPRESSION)
+    f.create_dataset("participants", shape=(0,), maxshape=(None,), dtype=h5py.string_dtype())
+    f.create_dataset("codes", shape=(0, n_trials), maxshape=(None, n_trials), dtype=np.int64)
+    f.create_dataset("retained", shape=(0, n_trials), maxshape=(None, n_trials), dtype=bool)
+    f.create_dataset("written", shape=(0,), maxshape=(None,), dtype=np.float64)
+    f.create_dataset("channels", data=_strings(epochs["ch_names"]))
+    f.create_dataset("times", data=np.asarray(epochs["times"]))
+
+
+def write_participant(path, task, name, epochs, settings):
+    """Add (or replace) one participant's epochs, as returned by make_epochs().
+
+    settings are the pipeline settings the epochs were made with. They are
+    recorded in the store, and a participant made with different settings
+    (e.g. another tmax) has to go into a new store.
+    """
+    folder = os.path.dirname(path)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder, exist_ok=True)
+    settings = json.dumps(settings, sort_keys=True, default=repr)
+    data = epochs["data"]
+    with store_lock(path):
+        with h5py.File(path, "a") as f:
+            if "epochs" not in f:
+                _create(f, task, epochs, settings)
+            elif (f.attrs["settings"] != settings or f["epochs"].dtype != data.dtype or
+                  f["epochs"].shape[1:] != (data.shape[1], data.shape[0], data.shape[2]) or
+                  _decode(f["channels"][:]) != list(epochs["ch_names"])):
+                raise ValueError(path + " holds epochs made with other settings - "
+                                 "move it away to start a new store")
+            if "written" not in f:
+                # stores made before the write times were kept
+                f.create_dataset("written", data=np.zeros(len(f["participants"])),
+                                 maxshape=(None,))
+            names = _decode(f["participants"][:])
+            if name in names:
+                row = names.index(name)
+            else:
+                row = len(names)
+                for dataset in ("epochs", "participants", "codes", "retained", "written"):
+                    f[dataset].resize(row + 1, axis=0)
+                f["participants"][row] = name
+            # one channel at a time, matching the chunks and the (channels, trials,
+            # samples) layout of the epochs
+            for ch in range(data.shape[0]):
+                f["epochs"][row, :, ch, :] = data[ch]
+            retained = np.zeros(data.shape[1], dtype=bool)
+            retained[epochs["selection"]] = True
+            f["codes"][row] = epochs["codes"]
+            f["retained"][row] = retained
+            f["written"][row] = time.time()
+    return path
+
+
+def participants(path):
+    """Names of the participants in a store (empty if it does not exist yet)."""
+    if not os.path.isfile(path):
+        return []
+    with h5py.File(path, "r") as f:
+        if "participants" not in f:
+            return []
+        return _decode(f["participants"][:])
+
+
+def written(path, name):
+    """When a participant was last written to the store (0 if not known)."""
+    with h5py.File(path, "r") as f:
+        row = _decode(f["participants"][:]).index(name)
+        return float(f["written"][row]) if "written" in f else 0.0
+
+
+def read_metadata(path):
+    """Table with one row per participant and trial: participant, trial, code, retained."""
+    with h5py.File(path, "r") as f:
+        names = _decode(f["participants"][:])
+        codes = f["codes"][:]
+        retained = f["retained"][:]
+    n_trials = codes.shape[1]
+    return pd.DataFrame({"participant": np.repeat(names, n_trials),
+                         "trial": np.tile(np.arange(n_trials), len(names)),
+                         "code": codes.reshape(-1),
+                         "retained": retained.reshape(-1)})
+
+
+def read_epochs(path, participants=None, channels=None, tmin=None, tmax=None):
+    """Read part of a store, only decompressing the chunks that are needed.
+
+    participants and channels are lists of names (default all) and tmin,
+    tmax limit the epoch to a time window in seconds. Returns the
+    (participant, trial, channel, sample) array and a dictionary with the
+    participants, channels, times, codes and retained arrays of the part
+    that was read.
+    """
+    with h5py.File(path, "r") as f:
+        names = _decode(f["participants"][:])
+        ch_names = _decode(f["channels"][:])
+        times = f["times"][:]
+        rows = (np.arange(len(names)) if participants is None else
+                np.array([names.index(p) for p in participants], dtype=int))
+        cols = (np.arange(len(ch_names)) if channels is None else
+                np.array([ch_names.index(c) for c in channels], dtype=int))
+        lo = 0 if tmin is None else int(np.searchsorted(times, tmin - 1e-9))
+        hi = len(times) if tmax is None else int(np.searchsorted(times, tmax + 1e-9))
+
+        dset = f["epochs"]
+        out = np.empty((len(rows), dset.shape[1], len(cols), hi - lo), dtype=dset.dtype)
+        # h5py hyperslabs only take one list index, so read a participant and channel at a time
+        for i, row in enumerate(rows):
+            for j, col in enumerate(cols):
+                out[i, :, j, :] = dset[row, :, col, lo:hi]
+        meta = {"participants": [names[r] for r in rows],
+                "channels": [ch_names[c] for c in cols],
+                "times": times[lo:hi],
+                "codes": f["codes"][:][rows],
+                "retained": f["retained"][:][rows]}
+    return out, meta
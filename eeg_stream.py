@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+"""
+Online ERPs during a session, from a stream of Biosemi samples.
+
+The batch scripts only show the ERPs once a session is over. Here the
+samples arrive over a local TCP socket, a block at a time, and every block
+goes through the same steps as in eeg_pipeline.py, in a form that only
+looks at samples that have already arrived:
+
+- the 24 bit samples are scaled to V as bdf_reader.py does
+- a causal Butterworth band-pass (SETTINGS l_freq to h_freq), carrying its
+  state from block to block - the offline zero-phase filter needs samples
+  from the future, so the online ERPs come out a few ms later
+- the ICA cleaning of the participant's fitted ICA, as one precomputed
+  (channels x channels) matrix (see eeg_float32.ica_operator())
+- the average reference over the EEG channels, into a ring buffer holding
+  the last BUFFER seconds
+- trial onsets are decoded from the Status channel as they arrive, and a
+  trial is epoched, baseline corrected, rejected above SETTINGS["reject"]
+  or added to the running average of its condition as soon as the buffer
+  reaches tmax after its lock point
+
+The trial labels (condition code and response time) come from the
+experiment as markers, as OpenSesame sends them to a lab streaming layer
+outlet when a trial is over. Response-locked epochs (Eriksen) wait for the
+response time, so every trial is averaged tmax after its lock point plus
+the time it takes to process one block.
+
+The stream is a series of frames, each a kind byte and a 4 byte
+little-endian length followed by the payload:
+
+    H   JSON header: labels, units, physical and digital ranges, sfreq
+    D   a block of samples, (samples, channels) 3 byte little-endian integers
+        as the Biosemi ActiView TCP server sends them
+    M   JSON marker of a trial: {"trial": i, "code": code, "rt": ms}
+    E   end of the stream
+
+replay streams a recording and its OpenSesame file in this format, at the
+speed of the recording or faster, to try the online mode without a
+participant:
+
+    python eeg_stream.py replay eriksen Raw_data/Behavioural/Eriksen/1001-eriksen.csv --speed 4
+    python eeg_stream.py online eriksen 1001-eriksen --save online.npz
+
+@author: James Bartlett
+"""
+
+import argparse
+import json
+import os
+import socket
+import struct
+import time
+import numpy as np
+import pandas as pd
+import scipy.signal
+import mne
+
+import bdf_reader
+import eeg_float32
+import eeg_pipeline
+from eeg_epochs import epoch_samples, epoch_times
+from eeg_grand_average import RunningAverage
+
+PORT = 8765
+
+# samples per data frame - 1/16 s at 1024 Hz
+BLOCK = 64
+
+# seconds of cleaned data kept for epoching - how late a trial's marker may come
+BUFFER = 10.0
+
+# orders of the causal high-pass and low-pass Butterworth filters
+HIGHPASS_ORDER = 2
+LOWPASS_ORDER = 4
+
+
+def send_frame(sock, kind, payload=b""):
+    sock.sendall(kind + struct.pack("<I", len(payload)) + payload)
+
+
+def _receive(sock, n):
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise EOFError("The stream closed in the middle of a frame")
+        data += chunk
+    return bytes(data)
+
+
+def receive_frame(sock):
+    """Kind and payload of the next frame."""
+    head = _receive(sock, 5)
+    return head[:1], _receive(sock, struct.unpack("<I", head[1:])[0])
+
+
+def encode_block(ints):
+    """(channels, samples) integers as (samples, channels) 3 byte little-endian bytes."""
+    values = np.ascontiguousarray((np.asarray(ints).T & 0xFFFFFF).astype("<u4"))
+    return values.view(np.uint8).reshape(values.shape + (4,))[..., :3].tobytes()
+
+
+def decode_block(payload, n_channels):
+    """(channels, samples) int32 array of a data frame."""
+    block = np.frombuffer(payload, dtype=np.uint8).reshape(-1, n_channels, 3)
+    return bdf_reader._decode_int24(block).T
+
+
+def causal_filter(sfreq, l_freq, h_freq):
+    """Second-order sections of the causal band-pass."""
+    high = scipy.signal.butter(HIGHPASS_ORDER, l_freq, "highpass", fs=sfreq, output="sos")
+    low = scipy.signal.butter(LOWPASS_ORDER, h_freq, "lowpass", fs=sfreq, output="sos")
+    return np.vstack([high, low])
+
+
+class OnlineERP(object):
+    """Running ERPs of the conditions of a task, updated a block of samples at a time.
+
+    header is the stream header (the .bdf header fields). With an ICA the
+    components eog_inds are removed from the data as in the batch.
+    """
+
+    def __init__(self, task, header, ica=None, eog_inds=(), buffer_seconds=BUFFER):
+        settings = eeg_pipeline.SETTINGS
+        self.task = task
+        self.config = eeg_pipeline.TASKS[task]
+        self.sfreq = float(header["sfreq"])
+        labels = header["labels"]
+        header = dict(header, n_channels=len(labels),
+                      **{k: np.asarray(header[k], dtype=float)
+                         for k in ("phys_min", "phys_max", "dig_min", "dig_max")})
+        self.n_channels = len(labels)
+        # the channels of the lazy loader, and the Status channel
+        self.picks = np.array([i for i, ch in enumerate(labels)
+                               if ch not in eeg_pipeline.EXCLUDE_CHANNELS])
+        self.ch_names = [labels[i] for i in self.picks]
+        self.status = labels.index("Status")
+        gain, base, raw_int = bdf_reader.scaling(header)
+        self.gain, self.base = gain[self.picks, None], base[self.picks, None]
+
+        self.sos = causal_filter(self.sfreq, settings["l_freq"], settings["h_freq"])
+        self.zi = None
+        self.operator = None
+        if ica is not None:
+            info = mne.create_info(self.ch_names, self.sfreq, "eeg")
+            self.operator = eeg_float32.ica_operator(ica, info, eog_inds, dtype=np.float64)
+
+        self.buffer = np.zeros((len(self.picks), int(buffer_seconds * self.sfreq)))
+        self.received = 0  # samples so far
+        self.last_code = 0
+        self.onsets = []  # sample of every trial trigger
+        self.markers = {}  # trial: (code, rt in samples) of trials not epoched yet
+        self.start, self.n_samples = epoch_samples(settings["tmin"], settings["tmax"], self.sfreq)
+        self.times = epoch_times(settings["tmin"], settings["tmax"], self.sfreq)
+        baseline = (self.times >= settings["baseline"][0]) & (self.times <= settings["baseline"][1])
+        self.baseline = slice(np.flatnonzero(baseline)[0], np.flatnonzero(baseline)[-1] + 1)
+        self.reject = settings["reject"]["eeg"]
+        self.epoched = np.arange(self.config["n_events"])[self.config["epoch_trials"]]
+        self.codes = [code for cond, code, criteria in self.config["conditions"]]
+        self.averages = dict((code, RunningAverage((len(self.picks), self.n_samples)))
+                             for code in self.codes)
+        self.counts = {"averaged": 0, "rejected": 0, "late": 0}
+        self.latencies = []
+
+    def add_marker(self, trial, code, rt):
+        """Label a trial with its condition code and response time (ms)."""
+        if trial in self.epoched and code in self.codes:
+            self.markers[trial] = (code, np.int64(rt / 1000.0 * self.sfreq))
+
+    def add_block(self, ints, arrived=None):
+        """Process a (channels, samples) block of integers; returns the trials averaged.
+
+        arrived is the time.perf_counter() the block came in, to measure how
+        long the trials it completes take to reach the averages.
+        """
+        arrived = time.perf_counter() if arrived is None else arrived
+        n = ints.shape[1]
+
+        # trial onsets - the first sample of every run of the trial code
+        code = ints[self.status] & bdf_reader.TRIGGER_MASK
+        previous = np.concatenate([[self.last_code], code[:-1]])
+        trigger = eeg_pipeline.SETTINGS["trigger_code"]
+        self.onsets.extend(self.received + np.flatnonzero((code == trigger) & (previous != trigger)))
+        self.last_code = code[-1]
+
+        data = ints[self.picks] * self.gain + self.base
+        if self.zi is None:
+            # start the filter as if the first sample had always been there
+            self.zi = scipy.signal.sosfilt_zi(self.sos)[:, None, :] * data[None, :, :1]
+        data, self.zi = scipy.signal.sosfilt(self.sos, data, axis=1, zi=self.zi)
+        if self.operator is not None:
+            picks, matrix, offset = self.operator
+            data[picks] = np.matmul(matrix, data[picks]) + offset[:, None]
+        data -= data.mean(axis=0)
+        positions = np.arange(self.received, self.received + n) % self.buffer.shape[1]
+        self.buffer[:, positions] = data
+        self.received += n
+        return self._epoch(arrived)
+
+    def _epoch(self, arrived):
+        """Average every labelled trial whose epoch is complete."""
+        done = []
+        response_locked = eeg_pipeline.task_lock(self.task) == "response"
+        for trial, (code, rt) in sorted(self.markers.items()):
+            if trial >= len(self.onsets):
+                continue  # its trigger is still to come
+            first = self.onsets[trial] + (rt if response_locked else 0) + self.start
+            if first + self.n_samples > self.received:
+                continue
+            del self.markers[trial]
+            if first < self.received - self.buffer.shape[1]:
+                self.counts["late"] += 1  # already out of the buffer
+                continue
+            epoch = self.buffer[:, np.arange(first, first + self.n_samples) % self.buffer.shape[1]]
+            epoch -= epoch[:, self.baseline].mean(axis=1, keepdims=True)
+            if (epoch.max(axis=1) - epoch.min(axis=1) > self.reject).any():
+                self.counts["rejected"] += 1
+                continue
+            self.averages[code].add(epoch)
+            self.counts["averaged"] += 1
+            self.latencies.append(time.perf_counter() - arrived)
+            done.append((trial, code))
+        return done
+
+    def window_means(self, electrode):
+        """Mean amplitude (uV) of every condition in every ROI window at one electrode."""
+        ch = self.ch_names.index(electrode)
+        means = {}
+        for component, (start, end, polarity) in self.config["roi_windows"].items():
+            window = (self.times >= start) & (self.times <= end)
+            means[component] = dict(
+                (code, float(self.averages[code].mean[ch, window].mean() * 1e6)
+                 if self.averages[code].n[ch, 0] else np.nan) for code in self.codes)
+        return means
+
+    def save(self, path):
+        """Write the running averages, replacing the file in one step for anyone reading it."""
+        tmp = path + ".tmp.npz"
+        np.savez(tmp, codes=np.array(self.codes), ch_names=np.array(self.ch_names),
+                 times=self.times, mean=np.array([self.averages[c].mean for c in self.codes]),
+                 trials=np.array([self.averages[c].n[0, 0] for c in self.codes]))
+        os.replace(tmp, path)
+
+
+def stream_erp(task, ica=None, eog_inds=(), host="localhost", port=PORT, save=None,
+               electrode="Fz", quiet=False):
+    """Connect to a stream and keep the running ERPs until it ends; returns the OnlineERP."""
+    names = dict((code, cond) for cond, code, criteria in eeg_pipeline.TASKS[task]["conditions"])
+    with socket.create_connection((host, port)) as sock:
+        kind, payload = receive_frame(sock)
+        if kind != b"H":
+            raise ValueError("The stream did not start with a header")
+        header = json.loads(payload.decode("utf-8"))
+        online = OnlineERP(task, header, ica, eog_inds)
+        while True:
+            kind, payload = receive_frame(sock)
+            if kind == b"E":
+                break
+            elif kind == b"M":
+                marker = json.loads(payload.decode("utf-8"))
+                online.add_marker(marker["trial"], marker["code"], marker["rt"])
+            elif kind == b"D":
+                arrived = time.perf_counter()
+                done = online.add_block(decode_block(payload, online.n_channels), arrived)
+                if done and save:
+                    online.save(save)
+                if done and not quiet:
+                    trials = ", ".join(names[code] + " " + str(online.averages[code].n[0, 0])
+                                       for code in online.codes)
+                    means = ", ".join(
+                        component + " " + " / ".join("{:.1f}".format(v) for v in m.values())
+                        for component, m in online.window_means(electrode).items())
+                    print("trial " + str(done[-1][0] + 1) + ": " + trials + " trials | " +
+                          electrode + " " + means + " uV")
+    return online
+
+
+def replay(task, filepath, host="localhost", port=PORT, speed=1.0, block=BLOCK):
+    """Stream a participant's recording and trial markers to one client.
+
+    speed 1 sends the samples as fast as they were recorded, 4 four times
+    as fast and 0 as fast as possible. The marker of every trial is sent
+    once the stream has passed its response, as OpenSesame would.
+    """
+    config = eeg_pipeline.TASKS[task]
+    name = eeg_pipeline.participant_name(filepath)
+    eegpath = os.path.join(config["eeg"], name + '.bdf')
+    header = bdf_reader.read_header(eegpath)
+    sfreq = header["sfreq"]
+    rtdata = pd.read_csv(filepath, sep=',')
+    codes = eeg_pipeline.trial_codes(task, rtdata)
+    rts = rtdata["response_time"].values
+    triggers = bdf_reader.read_triggers(eegpath, header=header)
+    onsets = triggers[triggers[:, 2] == eeg_pipeline.SETTINGS["trigger_code"], 0]
+    # the marker of trial i goes out with the first block past its response
+    due = onsets[:len(codes)] + np.int64(rts[:len(onsets)] / 1000.0 * sfreq)
+    n_total = header["n_records"] * int(header["n_samples"][0])
+
+    with socket.create_server((host, port)) as server:
+        print("Waiting for a client on " + host + ":" + str(port))
+        sock, address = server.accept()
+        with sock:
+            send_frame(sock, b"H", json.dumps(
+                {"labels": header["labels"], "units": header["units"], "sfreq": sfreq,
+                 "phys_min": list(header["phys_min"]), "phys_max": list(header["phys_max"]),
+                 "dig_min": list(header["dig_min"]), "dig_max": list(header["dig_max"])}
+            ).encode("utf-8"))
+            started = time.perf_counter()
+            sent = 0
+            # decode a few records at a time, and send them a block at a time
+            chunk = block * max(1, int(sfreq) // block)
+            for first in range(0, n_total, chunk):
+                ints = bdf_reader.read_ints(eegpath, header["labels"], first,
+                                            first + chunk, header=header)
+                for lo in range(0, ints.shape[1], block):
+                    if speed:
+                        wait = started + (first + lo + block) / sfreq / speed - time.perf_counter()
+                        if wait > 0:
+                            time.sleep(wait)
+                    send_frame(sock, b"D", encode_block(ints[:, lo:lo + block]))
+                    end = first + lo + ints[:, lo:lo + block].shape[1]
+                    for trial in np.flatnonzero((due >= sent) & (due < end)):
+                        send_frame(sock, b"M", json.dumps(
+                            {"trial": int(trial), "code": int(codes[trial]),
+                             "rt": float(rts[trial])}).encode("utf-8"))
+                    sent = end
+            send_frame(sock, b"E")
+    return sent
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Online ERPs from a stream of samples.")
+    sub = parser.add_subparsers(dest="command")
+    online = sub.add_parser("online", help="average the trials of a stream as they arrive")
+    online.add_argument("task", choices=sorted(eeg_pipeline.TASKS))
+    online.add_argument("name", nargs="?",
+                        help="participant whose fitted ICA and components to use, e.g. 1001-eriksen")
+    online.add_argument("--ica", help="fitted ICA .fif file (default the participant's)")
+    online.add_argument("--components", type=int, nargs="*",
+                        help="ICA components to remove (default from the ledger)")
+    online.add_argument("--electrode", default="Fz", help="electrode of the printed ROI means")
+    online.add_argument("--save", metavar="FILE", help="keep the running averages in this .npz")
+    online.add_argument("--host", default="localhost")
+    online.add_argument("--port", type=int, default=PORT)
+    play = sub.add_parser("replay", help="stream a recording as if it was being recorded")
+    play.add_argument("task", choices=sorted(eeg_pipeline.TASKS))
+    play.add_argument("filepath", help="the participant's OpenSesame .csv file")
+    play.add_argument("--speed", type=float, default=1.0,
+                      help="times real time, 0 for as fast as possible (default %(default)s)")
+    play.add_argument("--block", type=int, default=BLOCK, help="samples per data frame")
+    play.add_argument("--host", default="localhost")
+    play.add_argument("--port", type=int, default=PORT)
+    args = parser.parse_args(argv)
+
+    if args.command == "replay":
+        replay(args.task, args.filepath, args.host, args.port, args.speed, args.block)
+    elif args.command == "online":
+        ica, eog_inds = None, args.components or []
+        path = args.ica or (args.name and eeg_pipeline.ica_path(args.task, args.name))
+        if path:
+            ica = mne.preprocessing.read_ica(path)
+            if args.components is None and args.name:
+                eog_inds = eeg_pipeline.read_exclusions(args.task, args.name) or []
+        result = stream_erp(args.task, ica, eog_inds, args.host, args.port, args.save,
+                            args.electrode)
+        latency = np.array(result.latencies or [np.nan]) * 1e3
+        print("Averaged " + str(result.counts["averaged"]) + " trials, rejected " +
+              str(result.counts["rejected"]) + ", " + str(result.counts["late"]) +
+              " too late for the buffer; update latency median {:.1f} ms, "
+              "largest {:.1f} ms".format(np.median(latency), latency.max()))
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
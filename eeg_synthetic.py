@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic Biosemi recordings for testing and benchmarking the pipeline.
+
+The participants' recordings cannot be shared, so this writes .bdf and
+OpenSesame .csv pairs laid out like ours:
+
+- 32 EEG channels in the Biosemi 32 order, EXG1-EXG8 and Status, 1024 Hz,
+  one second data records of 24 bit samples
+- the Status channel has the Biosemi system bits set above the trigger
+  code, so it reads as negative numbers (the reason the old scripts
+  decoded the markers with eventscalc)
+- a start marker (code 1) followed by one trial marker (code 2) per trial,
+  420 trials for Eriksen and Go/NoGo and 208 for Smoking Go/NoGo
+- trials that last until the response plus a random interval, and the
+  stimulus onset logged in the .csv by the behavioural PC's clock, which
+  starts at another time and runs slightly fast or slow (see eeg_align.py)
+- mixed Laplacian background activity, eye blinks that are largest at the
+  frontal channels and EXG1, and a response-locked ERN/Pe or stimulus-locked
+  N2/P3 on error or NoGo trials
+
+The .bdf is written a block of records at a time, so long recordings do
+not need to fit in memory.
+
+    python eeg_synthetic.py eriksen synthetic --participants 4 --minutes 20
+
+@author: James Bartlett
+"""
+
+import argparse
+import os
+import numpy as np
+import pandas as pd
+
+import eeg_pipeline
+
+SFREQ = 1024
+
+CHANNELS = ['Fp1', 'AF3', 'F7', 'F3', 'FC1', 'FC5', 'T7', 'C3', 'CP1', 'CP5', 'P7', 'P3',
+            'Pz', 'PO3', 'O1', 'Oz', 'O2', 'PO4', 'P4', 'P8', 'CP6', 'CP2', 'C4', 'T8',
+            'FC6', 'FC2', 'F4', 'F8', 'AF4', 'Fp2', 'Fz', 'Cz']
+LABELS = CHANNELS + ['EXG' + str(i) for i in range(1, 9)] + ['Status']
+
+# Biosemi system bits (CMS in range, speed mode) set above the 16 trigger bits
+STATUS_BASE = 0xF00000
+
+# +-262144 uV over the 24 bit range, as the Biosemi II
+PHYS_RANGE = 262144
+
+# records written at a time
+BLOCK_RECORDS = 64
+
+# seconds before the first and after the last trial
+LEAD_IN = 10.0
+
+# largest random part of the interval between a response and the next trial, in s
+JITTER = 0.3
+
+# largest drift of the behavioural PC's clock against the amplifier's, in ppm
+CLOCK_DRIFT = 50.0
+
+FRONTAL = ['Fp1', 'Fp2', 'AF3', 'AF4', 'EXG1']
+
+
+def trial_table(task, n_trials, subject, rng):
+    """OpenSesame trials with the columns the pipeline and R scripts use."""
+    n_practice = eeg_pipeline.TASKS[task]["epoch_trials"].start or 20
+    table = pd.DataFrame({
+        "correct": (rng.rand(n_trials) > 0.12).astype(int),
+        "response_time": rng.randint(250, 600, n_trials),
+        "Block": ["Practice"] * n_practice + ["Exp"] * (n_trials - n_practice),
+        "subject_nr": subject,
+    })
+    if task == "eriksen":
+        table["Congruency"] = rng.choice(["congruent", "incongruent"], n_trials)
+    elif task == "gonogo":
+        table["Stim_type"] = rng.choice(["Go", "NoGo"], n_trials, p=[0.75, 0.25])
+    else:
+        table["Stimulus"] = rng.choice(["Go", "NoGo"], n_trials, p=[0.75, 0.25])
+        table["Cue_type"] = rng.choice(["smoking", "neutral"], n_trials)
+    return table
+
+
+def _header(n_records):
+    """The 256 * (1 + channels) byte .bdf header."""
+    def field(values, width):
+        return b"".join(str(v)[:width].ljust(width).encode("ascii") for v in values)
+    n = len(LABELS)
+    eeg = n - 1
+    header = (b"\xffBIOSEMI" + b" " * 80 + b" " * 80 + b"01.01.18" + b"10.00.00" +
+              str(256 * (n + 1)).ljust(8).encode("ascii") + b"24BIT".ljust(44) +
+              str(n_records).ljust(8).encode("ascii") + b"1".ljust(8) +
+              str(n).ljust(4).encode("ascii"))
+    header += field(LABELS, 16)
+    header += field(["Active Electrode"] * eeg + ["Triggers and Status"], 80)
+    header += field(["uV"] * eeg + ["Boolean"], 8)
+    header += field([-PHYS_RANGE] * eeg + [-8388608], 8)
+    header += field([PHYS_RANGE - 1] * eeg + [8388607], 8)
+    header += field([-8388608] * n, 8)
+    header += field([8388607] * n, 8)
+    header += field(["HP:DC; LP:417 Hz"] * n, 80)
+    header += field([SFREQ] * n, 8)
+    header += field([""] * n, 32)
+    return header
+
+
+def _erp(task, times):
+    """ERP waveform (uV) added at the event of an error or NoGo trial."""
+    if task == "eriksen":
+        # ERN 25-75 ms and Pe 200-400 ms after the response
+        return (-8.0 * np.exp(-((times - 0.05) / 0.02) ** 2) +
+                10.0 * np.exp(-((times - 0.3) / 0.08) ** 2))
+    # N2 175-250 ms and P3 300-500 ms after the stimulus
+    return (-5.0 * np.exp(-((times - 0.21) / 0.03) ** 2) +
+            9.0 * np.exp(-((times - 0.4) / 0.08) ** 2))
+
+
+def write_participant(task, folder, subject, minutes=None, seed=None, drop=0):
+    """Write <folder>/<eeg>/<name>.bdf and <folder>/<behavioural>/<name>.csv.
+
+    minutes sets the length of the recording (the trials are spread over
+    it), otherwise trials are 1.5 s apart on average. drop leaves out the
+    trigger of that many random trials, as a flaky parallel port would.
+    Returns the participant name.
+    """
+    config = eeg_pipeline.TASKS[task]
+    n_trials = config["n_events"]
+    rng = np.random.RandomState(subject if seed is None else seed)
+    name = str(subject) + "-" + task
+    trials = trial_table(task, n_trials, subject, rng)
+
+    isi = 1.5 if minutes is None else (minutes * 60.0 - 2 * LEAD_IN) / n_trials
+    if isi < 1.0:
+        raise ValueError("Recording too short for " + str(n_trials) + " trials")
+    # each trial lasts until the response, then a fixed and a random interval
+    rt = trials["response_time"].values / 1000.0
+    durations = isi - rt.mean() - JITTER / 2 + rt + rng.uniform(0, JITTER, n_trials)
+    seconds = LEAD_IN + np.concatenate([[0], np.cumsum(durations[:-1])])
+    onsets = (seconds * SFREQ).astype(np.int64)
+    n_records = int(np.ceil((onsets[-1] / float(SFREQ)) + LEAD_IN))
+    n_total = n_records * SFREQ
+    # the onsets as the behavioural PC logs them, in ms since it started
+    drift = 1.0 + rng.uniform(-CLOCK_DRIFT, CLOCK_DRIFT) * 1e-6
+    clock = rng.uniform(2.0, 10.0) + (seconds - seconds[0]) * drift
+    trials[eeg_pipeline.TASKS[task]["timestamp"]] = np.round(clock * 1000.0, 1)
+    triggered = np.delete(onsets, rng.choice(n_trials, drop, replace=False))
+
+    # events the ERP is locked to - the response for Eriksen, else the stimulus
+    rts = (trials["response_time"].values / 1000.0 * SFREQ).astype(np.int64)
+    if task == "eriksen":
+        erp_at = onsets[trials["correct"].values == 0] + rts[trials["correct"].values == 0]
+    else:
+        column = "Stim_type" if task == "gonogo" else "Stimulus"
+        erp_at = onsets[trials[column].values == "NoGo"]
+    erp = _erp(task, np.arange(int(0.8 * SFREQ)) / float(SFREQ))
+    # largest at the midline, as the real components
+    erp_gain = np.array([1.0 if ch in ("Fz", "Cz", "Pz", "FC1", "FC2", "CP1", "CP2") else 0.4
+                         for ch in CHANNELS])
+    blinks = np.sort(rng.randint(0, n_total - SFREQ, max(n_records // 4, 1)))
+    blink = np.hanning(int(0.2 * SFREQ)) * 80.0
+    blink_gain = np.array([1.0 if ch in FRONTAL else 0.1 for ch in LABELS[:-1]])
+    mixing = rng.randn(len(LABELS) - 1, len(LABELS) - 1) / 6.0
+
+    for path in (config["eeg"], config["behavioural"]):
+        if not os.path.isdir(os.path.join(folder, path)):
+            os.makedirs(os.path.join(folder, path))
+    trials.to_csv(os.path.join(folder, config["behavioural"], name + ".csv"), index=False)
+
+    with open(os.path.join(folder, config["eeg"], name + ".bdf"), "wb") as f:
+        f.write(_header(n_records))
+        for block_start in range(0, n_records, BLOCK_RECORDS):
+            block_stop = min(block_start + BLOCK_RECORDS, n_records)
+            first, last = block_start * SFREQ, block_stop * SFREQ
+            data = mixing.dot(rng.laplace(size=(len(LABELS) - 1, last - first)) * 5.0)
+            # slow drift, removed by the high-pass filter
+            data += 20.0 * np.sin(2 * np.pi * 0.05 * np.arange(first, last) / SFREQ)
+            for b in blinks[(blinks > first - len(blink)) & (blinks < last)]:
+                lo, hi = max(b, first), min(b + len(blink), last)
+                data[:, lo - first:hi - first] += np.outer(blink_gain, blink[lo - b:hi - b])
+            for e in erp_at[(erp_at > first - len(erp)) & (erp_at < last)]:
+                lo, hi = max(e, first), min(e + len(erp), last)
+                data[:32, lo - first:hi - first] += np.outer(erp_gain, erp[lo - e:hi - e])
+
+            status = np.full(last - first, STATUS_BASE, dtype=np.int64)
+            if first <= SFREQ < last:
+                status[SFREQ - first:SFREQ - first + 8] += 1  # start of the experiment
+            for o in triggered[(triggered >= first) & (triggered < last)]:
+                status[o - first:o - first + 8] += eeg_pipeline.SETTINGS["trigger_code"]
+
+            digital = np.clip(np.round(data / PHYS_RANGE * 8388608), -8388608, 8388607)
+            values = np.vstack([digital.astype(np.int64), status[None]]) & 0xFFFFFF
+            # (records, channels, samples) of little-endian 3 byte integers
+            records = values.reshape(len(LABELS), block_stop - block_start, SFREQ)
+            records = records.transpose(1, 0, 2).astype("<u4")
+            f.write(records.view(np.uint8).reshape(records.shape + (4,))[..., :3].tobytes())
+    return name
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write synthetic .bdf and .csv files.")
+    parser.add_argument("task", choices=sorted(eeg_pipeline.TASKS))
+    parser.add_argument("folder", help="the Raw_data folders are made in here")
+    parser.add_argument("--participants", type=int, default=1)
+    parser.add_argument("--minutes", type=float,
+                        help="length of each recording (default: trials 1.5 s apart)")
+    parser.add_argument("--first", type=int, default=1001, help="number of the first participant")
+    parser.add_argument("--drop", type=int, default=0,
+                        help="triggers to leave out of every recording")
+    args = parser.parse_args(argv)
+    for subject in range(args.first, args.first + args.participants):
+        print("Wrote " + write_participant(args.task, args.folder, subject, args.minutes,
+                                           drop=args.drop))
+
+
+if __name__ == "__main__":
+    main()
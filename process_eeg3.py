@@ -91,7 +91,7 @@ ica.exclude.extend(eog_inds)
 ica.apply(raw) #Changes raw data set 
 
 
-events2 = events 
+events2 = events.copy() # a copy, so events stays stimulus-locked
 events2[:,0] = events2[:,0] + rts
 
 
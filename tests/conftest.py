@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+"""
+The pipeline modules live at the top of the repository, not in a package.
+
+@author: James Bartlett
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the matching of the OpenSesame trials to the trial triggers.
+
+@author: James Bartlett
+"""
+
+import numpy as np
+
+from eeg_align import align_trials
+
+
+def session(n=200, seed=0, drift_ppm=0.0):
+    """Trigger onsets, logged stimulus times and response times (s) of n trials."""
+    rng = np.random.RandomState(seed)
+    rts = rng.uniform(0.25, 0.6, n)
+    # each trial lasts until the response, then a fixed and a random interval
+    durations = rts + 0.8 + rng.uniform(0, 0.3, n)
+    onsets = 10.0 + np.concatenate([[0], np.cumsum(durations[:-1])])
+    timestamps = 4.0 + (onsets - onsets[0]) * (1.0 + drift_ppm * 1e-6)
+    return onsets, timestamps, rts
+
+
+def test_clean_run_is_ok():
+    onsets, timestamps, rts = session()
+    report = align_trials(onsets, timestamps, rts)
+    assert report["ok"] and report["method"] == "timestamps"
+    assert report["lag"] == 0 and report["missing"] == [] and report["extra"] == []
+    assert report["late"] == 0
+
+
+def test_dropped_triggers_are_found():
+    onsets, timestamps, rts = session()
+    for dropped, lag in ((0, -1), (120, 0), (199, 0)):
+        report = align_trials(np.delete(onsets, dropped), timestamps, rts)
+        assert not report["ok"]
+        assert report["missing"] == [dropped + 1] and report["extra"] == []
+        # the lag is that of the longest run of trials
+        assert report["lag"] == lag
+
+
+def test_extra_trigger_is_found():
+    onsets, timestamps, rts = session()
+    report = align_trials(np.insert(onsets, 50, onsets[49] + 0.5), timestamps, rts)
+    assert not report["ok"]
+    assert report["missing"] == [] and report["extra"] == [51]
+
+
+def test_clock_drift_is_fitted():
+    # 200 ppm adds up to 60 ms over the session, more than the tolerance
+    onsets, timestamps, rts = session(drift_ppm=200.0)
+    report = align_trials(onsets, timestamps, rts)
+    assert report["ok"]
+    # the fitted line maps the .csv clock onto the recording's
+    assert abs(report["drift_ppm"] + 200.0) < 5.0
+    assert report["residual"] < 1e-6
+
+
+def test_response_times_without_timestamps():
+    onsets, timestamps, rts = session()
+    report = align_trials(onsets, rts=rts)
+    assert report["ok"] and report["method"] == "response_time" and report["lag"] == 0
+    report = align_trials(onsets[1:], rts=rts)
+    assert not report["ok"] and report["lag"] == -1
+    # trials of a fixed length do not correlate with the response times
+    fixed = 10.0 + 1.5 * np.arange(len(rts))
+    report = align_trials(fixed, rts=rts)
+    assert report["ok"] and report["lag"] == 0 and report["correlation"] < 0.3
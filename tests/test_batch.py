@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of reading the next participants ahead in a serial batch.
+
+@author: James Bartlett
+"""
+
+from concurrent.futures import Future
+
+import eeg_batch
+import eeg_pipeline
+from eeg_cache import StageGraph
+
+FILES = ["Behavioural/" + str(subject) + "-eriksen.csv" for subject in range(1001, 1006)]
+
+
+class InlineExecutor(object):
+    """Runs what is submitted straight away, so the order of the reads is fixed."""
+
+    def __init__(self, max_workers=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def submit(self, function, *args):
+        future = Future()
+        try:
+            future.set_result(function(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+def stub_prefetch(monkeypatch, sizes, fail=()):
+    """Recording sizes by participant, and a prefetch that logs who it loads."""
+    loaded = []
+
+    def prefetch_stages(task, filepath, options=None):
+        name = eeg_pipeline.participant_name(filepath)
+        loaded.append(name)
+        if name in fail:
+            raise OSError("unreadable " + name)
+        return {"load": name}
+    monkeypatch.setattr(eeg_batch, "ThreadPoolExecutor", InlineExecutor)
+    monkeypatch.setattr(eeg_batch, "prefetch_stages", prefetch_stages)
+    monkeypatch.setattr(eeg_pipeline, "load_size",
+                        lambda eegpath, lazy=False, float32=False:
+                        sizes[FILES.index("Behavioural/" + eegpath[-16:-4] + ".csv")])
+    return loaded
+
+
+def test_prefetch_stays_within_the_budget(monkeypatch):
+    # the fourth recording is over the budget on its own
+    loaded = stub_prefetch(monkeypatch, [10, 10, 10, 30, 10])
+    batch = eeg_batch.prefetch_participants("eriksen", FILES, max_bytes=25)
+    filepath, prefetched, read_ahead = next(batch)
+    assert prefetched == {} and loaded == []
+    read_ahead()
+    # the second and third fit together, the fourth is too big on its own
+    assert loaded == ["1002-eriksen", "1003-eriksen"]
+    filepath, prefetched, read_ahead = next(batch)
+    assert prefetched == {"load": "1002-eriksen"}
+    read_ahead()
+    assert loaded == ["1002-eriksen", "1003-eriksen", "1005-eriksen"]
+    rest = [prefetched for filepath, prefetched, read_ahead in batch]
+    assert rest == [{"load": "1003-eriksen"}, {}, {"load": "1005-eriksen"}]
+
+
+def test_nothing_is_read_ahead_when_chunked(monkeypatch):
+    loaded = stub_prefetch(monkeypatch, [10] * 5)
+    options = eeg_pipeline.Options(chunk=60.0)
+    for filepath, prefetched, read_ahead in eeg_batch.prefetch_participants("eriksen", FILES,
+                                                                            options):
+        read_ahead()
+        assert prefetched == {}
+    assert loaded == []
+
+
+def test_failed_prefetch_is_loaded_as_usual(monkeypatch):
+    stub_prefetch(monkeypatch, [10] * 5, fail=["1003-eriksen"])
+    prefetched = [p for f, p, r in eeg_batch.prefetch_participants("eriksen", FILES)]
+    assert prefetched == [{}, {"load": "1002-eriksen"}, {}, {"load": "1004-eriksen"},
+                          {"load": "1005-eriksen"}]
+
+
+def test_read_ahead_starts_after_the_filter():
+    order = []
+    graph = StageGraph()
+    graph.add("load", "array", lambda: order.append("load") or 1)
+    graph.add("filter", "array", lambda raw: order.append("filter") or raw, ["load"])
+    graph.add("ica_fit", "array", lambda raw: order.append("ica_fit") or raw, ["filter"])
+    graph.provide("load", 1)
+    graph.on_output("filter", lambda: order.append("read_ahead"))
+    graph.get("ica_fit")
+    graph.get("filter")
+    # prefetched load not computed again, and the next participants read only once
+    assert order == ["filter", "read_ahead", "ica_fit"]
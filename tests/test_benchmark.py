@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+"""
+Smoke run of the benchmark suite on one short synthetic participant.
+
+@author: James Bartlett
+"""
+
+import json
+
+import eeg_benchmark
+
+
+def test_benchmark_runs_every_stage(tmp_path):
+    results = str(tmp_path / "results.jsonl")
+    # Smoking Go/NoGo has the fewest trials, so the shortest recording
+    rows = eeg_benchmark.run("smokingnogo", [4.0], 1, results=results, memory=False)
+    stages = [row["stage"] for row in rows]
+    assert stages == ["align", "hash", "load", "events", "reference", "filter", "ica_fit",
+                      "eog", "ica_apply", "epochs", "save", "roi"]
+    with open(results) as f:
+        assert len([json.loads(line) for line in f]) == len(rows)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the stage cache and the stage outputs saved at fixed paths.
+
+@author: James Bartlett
+"""
+
+import os
+
+import numpy as np
+
+from eeg_cache import StageCache, StageGraph, is_persistent
+
+
+def counted_graph(path, calls):
+    graph = StageGraph()
+
+    def compute():
+        calls.append(1)
+        return np.arange(5.0)
+    graph.add("ica_fit", "array", compute, params={"n": 5}, path=path)
+    return graph
+
+
+def test_saved_output_is_reused(tmp_path):
+    path = str(tmp_path / "1001-ica.npy")
+    calls = []
+    counted_graph(path, calls).get("ica_fit")
+    np.testing.assert_array_equal(counted_graph(path, calls).get("ica_fit"), np.arange(5.0))
+    assert len(calls) == 1
+
+
+def test_deleted_output_is_saved_again(tmp_path):
+    path = str(tmp_path / "1001-ica.npy")
+    calls = []
+    graph = counted_graph(path, calls)
+    graph.get("ica_fit")
+    os.remove(path)
+    counted_graph(path, calls).get("ica_fit")
+    assert len(calls) == 2
+    assert is_persistent(path, graph.key("ica_fit"))
+    # and used from then on
+    counted_graph(path, calls).get("ica_fit")
+    assert len(calls) == 2
+
+
+def test_unreadable_output_is_saved_again(tmp_path):
+    path = str(tmp_path / "1001-ica.npy")
+    calls = []
+    graph = counted_graph(path, calls)
+    graph.get("ica_fit")
+    with open(path, "wb") as f:
+        f.write(b"not a numpy file")
+    counted_graph(path, calls).get("ica_fit")
+    assert len(calls) == 2
+    np.testing.assert_array_equal(counted_graph(path, calls).get("ica_fit"), np.arange(5.0))
+    assert len(calls) == 2
+
+
+def test_cache_scans_only_when_full(tmp_path, monkeypatch):
+    # 800 bytes of data plus the .npy header per entry
+    cache = StageCache(str(tmp_path), max_bytes=3000)
+    scans = []
+    entries = StageCache.entries
+    monkeypatch.setattr(StageCache, "entries", lambda self: scans.append(1) or entries(self))
+    for i in range(3):
+        cache.put("%064x" % i, "array", np.zeros(100))
+    assert len(scans) == 1
+    assert len(cache.entries()) == 3
+    scans[:] = []
+    cache.put("%064x" % 3, "array", np.zeros(100))
+    # past max_bytes: scanned and the least recently used entry deleted
+    assert len(scans) == 1
+    assert not cache.has("%064x" % 0, "array")
+    assert cache.has("%064x" % 3, "array")
+    assert cache.total <= 3000
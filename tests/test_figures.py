@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the per-participant ERP figures.
+
+@author: James Bartlett
+"""
+
+import os
+
+import numpy as np
+import scipy.io as sio
+
+import eeg_figures
+import eeg_pipeline
+
+NAME = "2001-smokingnogo"
+
+
+def write_conditions(trials):
+    """Per-condition .mat files of two channels with trials[cond] epochs of value cond's code."""
+    for cond, code, criteria in eeg_pipeline.TASKS["smokingnogo"]["conditions"]:
+        path = eeg_pipeline.output_paths("smokingnogo", NAME)[cond]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = np.full((1, trials[cond], 1025), float(code))
+        sio.savemat(path, {"Fz": data, "Cz": data})
+
+
+def test_empty_condition_is_left_out(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_conditions({"Go/smoking": 3, "Go/neutral": 0, "NoGo/smoking": 2, "NoGo/neutral": 2})
+    averages, ch_names, times = eeg_figures.condition_averages("smokingnogo", NAME)
+    assert sorted(averages) == [1, 3, 4]
+    assert len(times) == 1025
+
+    drawn = []
+    monkeypatch.setattr(eeg_figures, "draw",
+                        lambda task, name, electrode, lines, times, dpi: drawn.append(lines))
+    eeg_figures.render_participant("smokingnogo", NAME, electrodes=["Fz"])
+    (go, go_wave, go_n), (nogo, nogo_wave, nogo_n) = drawn[0]
+    # Go is Go/smoking alone, NoGo the mean of both NoGo conditions
+    assert go_n == 3 and nogo_n == 4
+    np.testing.assert_allclose(go_wave, 1.0)
+    np.testing.assert_allclose(nogo_wave, 3.5)
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the grand average kept on disk.
+
+@author: James Bartlett
+"""
+
+import numpy as np
+
+from eeg_grand_average import GrandAverage
+
+CONDITIONS = ["Correct", "Incorrect"]
+CH_NAMES = ["Fz", "Cz", "Pz"]
+TIMES = np.linspace(-0.2, 0.8, 6)
+
+
+def participants(n, seed=0):
+    """ERPs (conditions, channels, samples) and trial counts of n participants."""
+    rng = np.random.RandomState(seed)
+    shape = (len(CONDITIONS), len(CH_NAMES), len(TIMES))
+    return [(rng.normal(size=shape), np.full(shape, 50)) for i in range(n)]
+
+
+def build(directory, erps):
+    average = GrandAverage(str(directory), CONDITIONS)
+    for i, (erp, counts) in enumerate(erps):
+        average.add("p%d" % i, erp, counts, CH_NAMES, TIMES)
+    return average
+
+
+def assert_same(average, erps):
+    result = average.result()
+    stacked = np.array([erp for erp, counts in erps])
+    np.testing.assert_allclose(result["mean"], stacked.mean(axis=0))
+    np.testing.assert_allclose(result["sd"], stacked.std(axis=0, ddof=1))
+    np.testing.assert_array_equal(result["participants"], len(erps))
+    np.testing.assert_array_equal(result["trials"], 50 * len(erps))
+
+
+def test_add_remove_include_matches_a_fresh_build(tmp_path):
+    erps = participants(5)
+    average = build(tmp_path / "updated", erps)
+    average.remove("p1")
+    average.exclude("p3")
+    assert_same(average, [erps[0], erps[2], erps[4]])
+    average.include("p3")
+    fresh = build(tmp_path / "fresh", [erps[0], erps[2], erps[3], erps[4]])
+    np.testing.assert_allclose(average.result()["mean"], fresh.result()["mean"])
+    np.testing.assert_allclose(average.result()["sd"], fresh.result()["sd"])
+    assert_same(average, [erps[0], erps[2], erps[3], erps[4]])
+
+
+def test_rebuilt_from_contributions_without_save(tmp_path):
+    erps = participants(3)
+    build(tmp_path, erps)
+    # a run that stopped before save()
+    average = GrandAverage(str(tmp_path), CONDITIONS)
+    assert_same(average, erps)
+    assert average.ch_names == CH_NAMES
+    np.testing.assert_allclose(average.times, TIMES)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the adaptive artifact rejection on synthetic epochs.
+
+@author: James Bartlett
+"""
+
+import numpy as np
+
+import eeg_reject
+from eeg_reject import adaptive_reject, fold_labels, robust_scores, epoch_measures, search_threshold
+
+ARTIFACTS = [3, 17, 42, 58, 71, 90]
+
+
+def epochs(artifacts=(), channels=(0, 1, 2, 3), seed=0):
+    """(4 channels, 100 trials, 128 samples) of an ERP in noise, with blinks in some trials."""
+    rng = np.random.RandomState(seed)
+    times = np.linspace(0, 1, 128)
+    erp = 5.0 * np.exp(-((times - 0.3) / 0.05) ** 2)
+    data = erp + 3.0 * rng.randn(4, 100, 128)
+    blink = 150.0 * np.hanning(40)
+    for trial in artifacts:
+        start = rng.randint(0, 88)
+        data[list(channels), trial, start:start + 40] += blink
+    return data
+
+
+def test_artifact_trials_are_rejected():
+    data = epochs(ARTIFACTS)
+    selection = np.arange(100)
+    for per_channel in (False, True):
+        kept, thresholds = adaptive_reject(data, selection, per_channel, seed=1)
+        assert not set(ARTIFACTS) & set(kept)
+        # the threshold is not so strict that it throws the clean trials away
+        assert len(kept) >= 85
+        assert np.isfinite(thresholds["z"]).all()
+        assert thresholds["ptp"].shape == (4,)
+
+
+def test_clean_trials_keep_the_lenient_candidate():
+    data = epochs()
+    scores = robust_scores(epoch_measures(data))[0]
+    for per_channel in (False, True):
+        z, errors = search_threshold(data, scores, per_channel=per_channel, seed=1)
+        assert np.isinf(z).all()
+        assert errors.shape == (len(eeg_reject.GRID), 4)
+    kept, thresholds = adaptive_reject(data, np.arange(100), seed=1)
+    np.testing.assert_array_equal(kept, np.arange(100))
+
+
+def test_per_channel_thresholds():
+    # blinks on the first channel alone
+    data = epochs(ARTIFACTS, channels=[0])
+    scores = robust_scores(epoch_measures(data))[0]
+    z, errors = search_threshold(data, scores, per_channel=True, seed=1)
+    assert np.isfinite(z[0]) and np.isinf(z[1:]).all()
+    # over all the channels at once, every channel gets the same threshold
+    z, errors = search_threshold(data, scores, seed=1)
+    assert len(set(z)) == 1
+
+
+def test_most_lenient_threshold_within_one_standard_error(monkeypatch):
+    grid = np.array([1.0, 2.0, 3.0, np.inf])
+    # the folds spread by 0.2 around each mean, a standard error of 0.2 / sqrt(5)
+    means = {1.0: 1.2, 2.0: 1.0, 3.0: 1.05, np.inf: 1.5}
+    spread = np.array([-0.2, 0.2, 0.0, -0.2, 0.2])[:, None]
+
+    def errors(data, scores, threshold, labels, medians, per_channel=False):
+        return np.full((len(medians), data.shape[0]), means[threshold]) + spread
+    monkeypatch.setattr(eeg_reject, "threshold_errors", errors)
+    data = epochs()
+    z, mean = search_threshold(data, np.zeros(data.shape[:2]), grid, seed=1)
+    # not the smallest error (2), but the most lenient close enough to it
+    np.testing.assert_array_equal(z, [3.0] * 4)
+    np.testing.assert_allclose(mean[:, 0], [1.2, 1.0, 1.05, 1.5])
+
+
+def test_cross_validation_folds():
+    labels = fold_labels(103, 5, seed=4)
+    assert sorted(np.bincount(labels)) == [20, 20, 21, 21, 21]
+    np.testing.assert_array_equal(labels, fold_labels(103, 5, seed=4))
+    # a threshold that leaves no trials to average is never chosen
+    data = epochs()
+    scores = robust_scores(epoch_measures(data))[0]
+    medians = [np.median(data[:, labels[:100] == f], axis=1) for f in range(5)]
+    errors = eeg_reject.threshold_errors(data, scores, -np.inf, labels[:100], medians)
+    assert np.isinf(errors).all()
+
+
+def test_too_few_trials_are_all_kept():
+    data = epochs(ARTIFACTS)
+    kept, thresholds = adaptive_reject(data, np.arange(8))
+    np.testing.assert_array_equal(kept, np.arange(8))
+    assert np.isinf(thresholds["z"]).all()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the batched split-half and bootstrap reliability.
+
+@author: James Bartlett
+"""
+
+import numpy as np
+
+from eeg_reliability import _batch, _weights_participants, _weights_split, reliability
+
+
+def trial_data(seed=5):
+    """(participants, trials, electrodes) amplitudes padded with NaN, and the trial counts."""
+    rng = np.random.RandomState(seed)
+    n_trials = np.array([9, 12, 7, 12, 10, 8])
+    # a participant effect, so the halves correlate
+    data = rng.randn(len(n_trials), 12, 3) + 2.0 * rng.randn(len(n_trials), 1, 3)
+    data[np.arange(12)[None, :] >= n_trials[:, None]] = np.nan
+    return data, n_trials
+
+
+def looped(data, n_trials, n_splits, seed, method):
+    """_batch() one split and one participant at a time, from the same random draws."""
+    rng = np.random.default_rng(seed)
+    first, second = _weights_split(rng, n_splits, n_trials, data.shape[1])
+    counts = np.ones((n_splits, len(n_trials)), dtype=int)
+    if method == "bootstrap":
+        counts = _weights_participants(rng, n_splits, len(n_trials)).astype(int)
+    r = np.empty((n_splits, data.shape[2]))
+    for s in range(n_splits):
+        mean_a = np.array([data[p][first[s, p] == 1].mean(axis=0) for p in range(len(n_trials))])
+        mean_b = np.array([data[p][second[s, p] == 1].mean(axis=0) for p in range(len(n_trials))])
+        # a participant drawn k times is k rows of the resample
+        mean_a, mean_b = np.repeat(mean_a, counts[s], 0), np.repeat(mean_b, counts[s], 0)
+        for e in range(data.shape[2]):
+            r[s, e] = np.corrcoef(mean_a[:, e], mean_b[:, e])[0, 1]
+    return r
+
+
+def test_batch_matches_a_loop_over_splits():
+    data, n_trials = trial_data()
+    for method in ("split", "bootstrap"):
+        np.testing.assert_allclose(_batch(data, n_trials, 20, 7, method),
+                                   looped(data, n_trials, 20, 7, method), atol=1e-10)
+
+
+def test_halves_split_every_trial():
+    data, n_trials = trial_data()
+    first, second = _weights_split(np.random.default_rng(3), 20, n_trials, data.shape[1])
+    np.testing.assert_array_equal(first.sum(axis=2), np.broadcast_to(n_trials // 2, (20, 6)))
+    np.testing.assert_array_equal((first + second).sum(axis=2), np.broadcast_to(n_trials, (20, 6)))
+    assert (first * second).sum() == 0
+
+
+def test_jobs_do_not_change_the_result():
+    data, n_trials = trial_data()
+    for method in ("split", "bootstrap"):
+        r, corrected = reliability(data, n_trials, 50, method, seed=11, jobs=1, batch=15)
+        r_jobs, corrected_jobs = reliability(data, n_trials, 50, method, seed=11, jobs=2,
+                                             batch=15)
+        np.testing.assert_array_equal(r, r_jobs)
+        np.testing.assert_array_equal(corrected, corrected_jobs)
+        assert r.shape == (50, 3)